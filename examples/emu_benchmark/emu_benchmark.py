@@ -0,0 +1,63 @@
+import sys
+sys.path.insert(1, '../../src/')
+from emulator.emulator import emulatedHw
+import firmware.firmware as firm
+import time, tracemalloc
+import numpy as np
+
+# Architecture used by all benchmarks (N and M are swept)
+IB_DEPTH=16384
+FUVRF_SIZE=4
+VVVRF_SIZE=8
+TB_SIZE=64
+MAX_CHAINS=8
+BUILDING_BLOCKS=['InputBuffer','FilterReduceUnit','VectorVectorALU','VectorScalarReduce','DataPacker','TraceBuffer']
+
+WARMUP_CYCLES=500
+MEASURED_CYCLES=5000
+
+def firmwares(N,M):
+    return {'distribution': lambda cp: firm.distribution(cp,bins=2*M,M=M),
+            'summaryStats': lambda cp: firm.summaryStats(cp),
+            'spatialSparsity': lambda cp: firm.spatialSparsity(cp,N),
+            'correlation': lambda cp: firm.correlation(cp)}
+
+# Measures the memory allocated while stepping a processor that already reached steady state
+# Retained bytes are the ones still allocated after stepping, while the peak also includes temporaries freed along the way
+# Neither should grow with the number of cycles or with N and M (the few bytes left are the Python ints of the cycle and queue counters)
+def benchAllocations(N,M,fw_name,fw_function):
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    if fw_name=='spatialSparsity':
+        proc.fu.vrf=list(np.concatenate(([0.,float('inf')],list(reversed(range(FUVRF_SIZE*M-2))))))
+    else:
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+    proc.config(fw_function(proc.compiler))
+    proc.probe([])
+    np.random.seed(0)
+    proc.push_many(np.random.rand(IB_DEPTH,N)*2*M-M,np.random.rand(IB_DEPTH)>0.9)
+    proc.run(steps=WARMUP_CYCLES)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    start_bytes, _ = tracemalloc.get_traced_memory()
+    proc.run(steps=MEASURED_CYCLES)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    emulator_only = [tracemalloc.Filter(True,'*emulator.py')]
+    growth = after.filter_traces(emulator_only).compare_to(before.filter_traces(emulator_only),'lineno')
+    retained = sum(stat.size_diff for stat in growth)
+
+    # Time the same number of cycles without tracing
+    start = time.perf_counter()
+    proc.run(steps=MEASURED_CYCLES)
+    elapsed = time.perf_counter()-start
+    return retained, peak_bytes-start_bytes, MEASURED_CYCLES/elapsed
+
+print(f"Memory allocated over {MEASURED_CYCLES} cycles")
+print(f"{'N':>4} {'M':>4} {'firmware':>16} {'retained B':>11} {'peak B':>8} {'cycles/s':>10}")
+for N, M in [(8,4),(64,32),(256,64)]:
+    for fw_name, fw_function in firmwares(N,M).items():
+        retained, peak, speed = benchAllocations(N,M,fw_name,fw_function)
+        print(f"{N:>4} {M:>4} {fw_name:>16} {retained:>11} {peak:>8} {speed:>10.0f}")
@@ -1,9 +1,18 @@
 import sys
 sys.path.insert(1, '../../src/')
-from emulator.emulator import emulatedHw
-from hardware.hardware import rtlHw
+from emulator.emulator import emulatedHw, CONDITION_FAILS
+from emulator.multiEmulator import multiEmulatedHw
+from emulator.shardedEmulator import shardedEmulatedHw
+from firmware.compiler import compiler, encodeCond, firmwareCost, COND_BITS, fullUpload, deltaUpload, uploadTime, CMD_UPDATE_ALL, CMD_UPDATE_BLOCK
+from firmware.statistics import statistics
+from firmware.cache import firmwareCache
+from firmware.traceDecoder import traceDecoder, loadTrace
+from misc.misc import encode, decode, encodeArray, decodeArray, tensorStream
+from hardware.hardware import rtlHw, runMany
+from containers.modelsim.modelsimContainer import localContainer, modelsimSession
 import firmware.firmware as firm
-import math, yaml
+import hardware.hardware as hardware
+import math, os, yaml, tracemalloc, asyncio, tempfile
 import numpy as np
 
 # Read YAML configuration file and declare those as global variables
@@ -176,4 +185,955 @@ def testVectorChange():
 
     print("Passed test #6")
 
-testVectorChange()
\ No newline at end of file
+testVectorChange()
+
+def testBatchedExecution():
+
+    # Firmware that exercise the filter, caches, minicache, conditions and data packer
+    firmware = [lambda cp: firm.distribution(cp,bins=2*M,M=M),
+                lambda cp: firm.summaryStats(cp),
+                lambda cp: firm.spatialSparsity(cp,N),
+                lambda cp: firm.correlation(cp),
+                lambda cp: firm.vectorChange(cp),
+                lambda cp: firm.minicache(cp),
+                lambda cp: firm.conditions(cp),
+                lambda cp: firm.multipleChains(cp),
+                lambda cp: firm.activationPredictiveness(cp)]
+
+    num_input_vectors=12
+    np.random.seed(0)
+    input_vectors=np.random.rand(num_input_vectors,N)*8-2
+    eof1=np.random.rand(num_input_vectors)>0.6
+    eof2=eof1 & (np.random.rand(num_input_vectors)>0.5)
+
+    for fw_idx, fw_function in enumerate(firmware):
+        for building_blocks in [BUILDING_BLOCKS,['InputBuffer','FilterReduceUnit','VectorScalarReduce','VectorVectorALU','DataPacker','TraceBuffer']]:
+            results=[]
+            for batched in [False,True]:
+                proc = emulatedHw(N,M,num_input_vectors,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,building_blocks)
+                proc.fu.vrf=list(range(FUVRF_SIZE*M))
+                proc.config(fw_function(proc.compiler))
+                if batched:
+                    proc.runBatch(input_vectors,eof1,eof2)
+                else:
+                    for i in range(num_input_vectors):
+                        proc.push([input_vectors[i],eof1[i],eof2[i]])
+                    proc.run(steps=num_input_vectors*MAX_CHAINS+20)
+                results.append((np.copy(proc.tb.mem),proc.tb.size,np.copy(proc.vvalu.vrf)))
+            assert np.allclose(results[0][0],results[1][0]), f"Batched trace buffer differs for firmware #{fw_idx}"
+            assert results[0][1]==results[1][1], f"Batched trace buffer size differs for firmware #{fw_idx}"
+            assert np.allclose(results[0][2],results[1][2]), f"Batched scratchpad differs for firmware #{fw_idx}"
+    print("Passed test #7")
+
+testBatchedExecution()
+
+def testRunUntilDrained():
+
+    # Instantiate processors
+    results=[]
+    for steps in [50,None]:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        fw = firm.distribution(proc.compiler,bins=2*M,M=M)
+
+        # Feed values to input buffer
+        np.random.seed(42)
+        for i in range(4):
+            proc.push([np.random.rand(N)*8,i%2==1])
+
+        # Run either for a fixed number of steps or until all values are processed
+        proc.config(fw)
+        proc.run(steps=steps)
+        assert proc.drained(), "Processor was not drained"
+        results.append((np.copy(proc.tb.mem),proc.cycle))
+
+    assert np.allclose(results[0][0],results[1][0]), "Drain mode changed the trace buffer"
+    assert results[0][1]==50, "Idle cycles were not accounted for"
+    assert results[1][1]<50, "Drain mode did not stop once the processor was drained"
+    print("Passed test #8")
+
+testRunUntilDrained()
+
+def testPushMany():
+
+    # Push vectors one at a time and in bulk, making sure the circular input buffer wraps around
+    np.random.seed(0)
+    input_vectors=np.random.rand(3*IB_DEPTH,N)*8
+    eof1=np.arange(3*IB_DEPTH)%3==2
+    results=[]
+    for bulk in [False,True]:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        proc.config(firm.distribution(proc.compiler,bins=2*M,M=M))
+        for i in range(0,3*IB_DEPTH,IB_DEPTH//2):
+            if bulk:
+                proc.push_many(input_vectors[i:i+IB_DEPTH//2],eof1[i:i+IB_DEPTH//2])
+            else:
+                for j in range(i,i+IB_DEPTH//2):
+                    proc.push([input_vectors[j],eof1[j]])
+            proc.run(steps=IB_DEPTH)
+        proc.run(steps=None)
+        results.append(np.copy(proc.tb.mem))
+    assert np.allclose(results[0],results[1]), "Bulk push failed"
+    print("Passed test #9")
+
+testPushMany()
+
+def testSteadyStateAllocations():
+
+    # Blocks write their results in place, so stepping the processor should not keep any new memory around
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    proc.fu.vrf=list(range(FUVRF_SIZE*M))
+    proc.config(firm.distribution(proc.compiler,bins=2*M,M=M))
+    proc.probe([])
+    np.random.seed(0)
+    proc.push_many(np.random.rand(IB_DEPTH,N)*8,np.arange(IB_DEPTH)%2==1)
+    proc.run(steps=MAX_CHAINS)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    proc.run(steps=(IB_DEPTH-2)*MAX_CHAINS)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    emulator_only = [tracemalloc.Filter(True,'*emulator.py')]
+    growth = after.filter_traces(emulator_only).compare_to(before.filter_traces(emulator_only),'lineno')
+    assert sum(stat.size_diff for stat in growth)==0, "Stepping the processor allocated memory"
+    print("Passed test #10")
+
+testSteadyStateAllocations()
+
+def testConditionMasks():
+
+    # Condition masks are shared with the hardware, so check them against the meaning of each condition
+    no_cond={'last':False,'notlast':False,'first':False,'notfirst':False}
+    for flags in range(16):
+        eof, bof = [bool(flags&1),bool(flags&2)], [bool(flags&4),bool(flags&8)]
+        for i in range(2):
+            expected={'last':eof[i],'notlast':not eof[i],'first':bof[i],'notfirst':not bof[i]}
+            for name, holds in expected.items():
+                conds=[dict(no_cond),dict(no_cond)]
+                conds[i][name]=True
+                assert (encodeCond(*conds) & CONDITION_FAILS[flags]==0)==holds, "Condition mask failed"
+        assert encodeCond(no_cond,no_cond) & CONDITION_FAILS[flags]==0, "Empty condition mask failed"
+
+    # The hardware and the emulator only agree on instructions with a single condition
+    cp=compiler(N,M,MAX_CHAINS)
+    cp.begin_chain()
+    try:
+        cp.vv_add(0,'notfirst','last')
+        assert False
+    except AssertionError as e:
+        assert "single condition" in str(e)
+
+    # Static cost estimates fire an instruction when any condition of its mask holds, like the hardware
+    cost=firmwareCost(N,1,[])
+    last, notfirst = 1<<COND_BITS['last'], 1<<COND_BITS['notfirst']
+    assert cost.conditionRate(0,4)==1 and cost.conditionRate(last,4)==0.25 and cost.conditionRate(notfirst<<4,4,2)==0.5
+    assert cost.conditionRate(last|notfirst<<4,4,2)==1-0.75*0.5 and cost.conditionRate(last|notfirst,4)==0.75
+    assert cost.conditionRate(last)==0 and cost.conditionRate(notfirst<<4)==1
+    print("Passed test #11")
+
+testConditionMasks()
+
+def testProbeLog():
+
+    # Probe the ALU and data packer, keeping only a few samples
+    np.random.seed(0)
+    input_vectors=np.random.rand(IB_DEPTH,N)*8
+    results=[]
+    for window, interval in [(1000,1),(5,1),(4,3)]:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        proc.config(firm.summaryStats(proc.compiler))
+        proc.probe(['vvalu','dp'],fields=['v','chainId','valid'],window=window,interval=interval)
+        proc.push_many(input_vectors)
+        log = proc.run(steps=None)
+        assert 'tb' not in log and 'eof' not in log['vvalu'].keys(), "Unexpected probes"
+        results.append((log['vvalu']['cycle'],log['vvalu']['v'],log['vvalu']['chainId'],log['dp']['valid']))
+
+    # Bounded logs keep the most recent samples of the full log
+    cycles, values, chains, valid = results[0]
+    assert np.array_equal(cycles,np.arange(1,len(cycles)+1)), "Samples should be taken every cycle"
+    assert np.array_equal(results[1][0],cycles[-5:]) and np.allclose(results[1][1],values[-5:]), "Window does not hold the last samples"
+    sampled = np.nonzero(cycles%3==0)[0][-4:]
+    assert np.array_equal(results[2][0],cycles[sampled]) and np.array_equal(results[2][2],chains[sampled]), "Sampling interval failed"
+    assert np.allclose(log['vvalu'][-1],results[2][1][-1]), "Indexing a block should return its first field"
+
+    # Until something is probed, nothing is copied while stepping and the log reads the current trace buffer
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    proc.fu.vrf=list(range(FUVRF_SIZE*M))
+    proc.config(firm.raw(proc.compiler))
+    proc.push_many(input_vectors)
+    log = proc.run(steps=None)
+    assert not log.sampling(proc.cycle) and list(log.keys())==['tb'] and len(log['tb'])==1
+    mem = log['tb'][-1]
+    assert np.array_equal(mem,proc.tb.mem) and not np.shares_memory(mem,proc.tb.mem) and log['tb']['size'][0]==proc.tb.size
+    assert log['tb']['cycle'][0]==proc.cycle
+    print("Passed test #12")
+
+testProbeLog()
+
+def testMultipleProcessors():
+
+    # Each processor has its own firmware, FUVRF and input schedule
+    firmware = [lambda cp: firm.distribution(cp,bins=2*M,M=M),
+                lambda cp: firm.summaryStats(cp),
+                lambda cp: firm.spatialSparsity(cp,N),
+                lambda cp: firm.correlation(cp),
+                lambda cp: firm.minicache(cp),
+                lambda cp: firm.conditions(cp)]
+    B=len(firmware)
+    fu_vrfs=[list(range(FUVRF_SIZE*M)) if b!=2 else list(np.concatenate(([0.,float('inf')],list(reversed(range(FUVRF_SIZE*M-2)))))) for b in range(B)]
+    multi_proc = multiEmulatedHw(B,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    multi_proc.fu.vrf=fu_vrfs
+    multi_proc.config([fw_function(compiler(N,M,MAX_CHAINS)) for fw_function in firmware])
+    procs=[]
+    for b in range(B):
+        procs.append(emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS))
+        procs[b].fu.vrf=fu_vrfs[b]
+        procs[b].config(firmware[b](procs[b].compiler))
+
+    # Push a different number of vectors to each processor and step all of them at once
+    np.random.seed(0)
+    for b in range(B):
+        num_input_vectors=b+2
+        input_vectors=np.random.rand(num_input_vectors,N)*8-2
+        eof1=np.random.rand(num_input_vectors)>0.5
+        multi_proc.push_many(b,input_vectors,eof1)
+        procs[b].push_many(input_vectors,eof1)
+    multi_proc.run(steps=None)
+    for b in range(B):
+        procs[b].run(steps=None)
+        assert np.allclose(multi_proc.tb.mem[b],procs[b].tb.mem), f"Processor #{b} differs from the single processor emulator"
+        assert np.allclose(multi_proc.vvalu.vrf[b],procs[b].vvalu.vrf), f"Scratchpad of processor #{b} differs"
+    print("Passed test #13")
+
+testMultipleProcessors()
+
+def testShardedEmulation():
+
+    # Sharded runs must match a single processor that receives the whole stream
+    np.random.seed(0)
+    num_input_vectors=61
+    input_vectors=np.random.rand(num_input_vectors,N)*8-2
+    eof1=np.random.rand(num_input_vectors)>0.8
+    for fw_function, args in [(firm.distribution,(2*M,M)),(firm.summaryStats,()),(firm.sumAll,()),(firm.multipleChains,())]:
+        sharded_proc = shardedEmulatedHw(N,M,FUVRF_SIZE,VVVRF_SIZE,MAX_CHAINS,BUILDING_BLOCKS,workers=2)
+        sharded_proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        sharded_proc.config(fw_function,*args)
+        rows=sharded_proc.run(input_vectors,eof1,shards=5)
+
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,num_input_vectors*MAX_CHAINS,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        proc.config(fw_function(proc.compiler,*args))
+        proc.runBatch(input_vectors,eof1)
+        assert len(rows)==proc.tb.size, f"Sharded {fw_function.__name__} committed a different number of rows"
+        assert np.allclose(rows,proc.tb.mem[:proc.tb.size]), f"Sharded {fw_function.__name__} differs from a single processor"
+        assert len(sharded_proc.pending)==(proc.dp.v_out_size if proc.dp.v_out_size<N else 0)
+
+    # Firmware that depends on previous vectors cannot be sharded
+    for fw_function in [firm.correlation,firm.vectorChange]:
+        try:
+            sharded_proc.config(fw_function)
+            assert False, f"{fw_function.__name__} should not be shardable"
+        except AssertionError as e:
+            assert "merge rule" in str(e)
+    print("Passed test #14")
+
+testShardedEmulation()
+
+def testBitAccurateDataTypes():
+
+    # Integer sums wrap around at DATA_WIDTH bits like the adder tree
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE='int',DATA_WIDTH=8)
+    proc.config(firm.sumAll(proc.compiler))
+    proc.push_many(np.full((N,N),100))
+    proc.run(steps=None)
+    assert proc.tb.mem.dtype==np.int64
+    assert list(proc.tb.mem[0])==N*[(N*100)%256]
+
+    # Fixed-point accumulations saturate when encoded and wrap around when accumulated
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE='fixed_point',DATA_WIDTH=8)
+    proc.config(firm.vvalu_simple(proc.compiler))
+    proc.push_many([N*[5.0],N*[100.0]])
+    proc.run(steps=None)
+    assert list(proc.fmt.decode(proc.tb.mem[0]))==N*[5.0]
+    assert list(proc.fmt.decode(proc.tb.mem[1]))==N*[5.0+127/16-16]
+
+    # Fixed-point products are shifted back into Q4.4 and max compares signed words, while integer max compares unsigned words
+    fmt = proc.fmt
+    assert list(fmt.encode([-3.2,1.5,100.0]))==[encode(x,8) for x in [-3.2,1.5,100.0]]
+    assert fmt.decode(fmt.alu(2,fmt.encode([-1.5]),fmt.encode([2.0])))[0]==-3.0
+    assert fmt.decode(fmt.alu(4,fmt.encode([-1.0]),fmt.encode([0.5])))[0]==0.5
+    fmt = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE='int',DATA_WIDTH=8).fmt
+    assert fmt.alu(4,fmt.encode([-1]),fmt.encode([3]))[0]==255
+    print("Passed test #15")
+
+testBitAccurateDataTypes()
+
+def testFixedPointCodec():
+
+    # Whole arrays are encoded and decoded like the scalar functions used for the hardware
+    np.random.seed(0)
+    values=np.concatenate((np.random.rand(100)*40-20,[1e9,-1e9,0.25,-0.25]))
+    for DATA_WIDTH in [8,16,32]:
+        words=encodeArray(values,DATA_WIDTH)
+        assert words.dtype==np.uint64
+        assert list(words)==[encode(v,DATA_WIDTH) for v in values]
+        assert list(decodeArray(words,DATA_WIDTH))==[decode(w,DATA_WIDTH) for w in words]
+
+    # Words can be decoded straight from raw buffers and from the strings printed by the simulator
+    buffer=encodeArray([-1.5,2.75],16).astype(np.uint16).tobytes()
+    assert list(decodeArray(np.frombuffer(buffer,dtype=np.uint16),16))==[-1.5,2.75]
+    assert list(decodeArray(['65512','44'],16))==[-0.09375,0.171875]
+
+    # 64-bit words and custom integer/fraction splits saturate without losing precision
+    assert list(encodeArray([1e30,-1e30],64))==[2**63-1,2**63+1]
+    assert list(decodeArray(encodeArray([-3.125,1e30],64,frac_bits=3),64,frac_bits=3))==[-3.125,(2**63-1)/8]
+    print("Passed test #16")
+
+testFixedPointCodec()
+
+def testTensorStream():
+
+    # Tensors are split into N-wide tiles that view the tensor, and the last tile of each tensor is zero padded
+    activations=np.arange(3*2*N+3*3,dtype=float).reshape(3,2*N+3)
+    tiles=list(tensorStream(activations,N))
+    assert len(tiles)==3*3
+    assert np.shares_memory(tiles[0][0],activations) and not np.shares_memory(tiles[2][0],activations)
+    assert list(tiles[2][0])==list(activations[0,2*N:])+(N-3)*[0]
+    assert [t[1] for t in tiles]==3*[False,False,True]
+    assert [t[2] for t in tiles]==8*[False]+[True]
+
+    # An iterator of unbatched tensors ends a batch after every tensor
+    tiles=list(tensorStream((np.ones((2,N)) for _ in range(2)),N,batched=False))
+    assert [(t[1],t[2]) for t in tiles]==2*[(False,False),(True,True)]
+
+    # Arrays without a batch axis are a single tensor, and non-contiguous tensors are copied
+    tiles=list(tensorStream(np.arange(3.),N))
+    assert len(tiles)==1 and list(tiles[0][0])==[0,1,2]+(N-3)*[0] and tiles[0][1] and tiles[0][2]
+    tiles=list(tensorStream(np.array(5.),N))
+    assert len(tiles)==1 and list(tiles[0][0])==[5]+(N-1)*[0] and tiles[0][1] and tiles[0][2]
+    transposed=np.arange(2*N,dtype=float).reshape(2,N).T
+    tiles=list(tensorStream(transposed,N,batched=False))
+    assert len(tiles)==2 and list(tiles[0][0])==list(transposed.ravel()[:N]) and not np.shares_memory(tiles[0][0],transposed)
+    for empty in [np.ones((2,0)),np.ones((0,N))]:
+        try:
+            list(tensorStream([np.ones((2,N)),empty],N))
+            assert False
+        except AssertionError as e:
+            assert "Cannot stream an empty" in str(e)
+
+    # Streaming a layer with more vectors than the input buffer can hold steps the processor as needed
+    layer=np.random.rand(4,IB_DEPTH*N+1)
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    proc.fu.vrf=list(range(FUVRF_SIZE*M))
+    proc.config(firm.summaryStats(proc.compiler))
+    proc.pushTensors(layer)
+    proc.run(steps=None)
+    ref_proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    ref_proc.fu.vrf=list(range(FUVRF_SIZE*M))
+    ref_proc.config(firm.summaryStats(ref_proc.compiler))
+    vectors, eof1, eof2 = zip(*tensorStream(layer,N))
+    ref_proc.runBatch(vectors,eof1,eof2)
+    assert proc.tb.size==ref_proc.tb.size==1 and np.allclose(proc.tb.mem,ref_proc.tb.mem)
+    print("Passed test #17")
+
+testTensorStream()
+
+def testOverflowPolicies():
+
+    # Pushes a burst of vectors numbered from 0 to the input buffer and returns the numbers that were processed
+    def burst(policy,num_input_vectors=3*IB_DEPTH,**kwargs):
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.config(firm.raw(proc.compiler))
+        proc.overflowPolicy(policy,**kwargs)
+        proc.run(steps=1)
+        proc.push_many(np.repeat(np.arange(num_input_vectors)[:,None],N,axis=1))
+        proc.run(steps=None)
+        return list(proc.tb.mem[:proc.tb.size,0]), proc.ib
+
+    # Dropping the newest vectors mirrors the RTL, which does not enqueue vectors while it is full
+    processed, ib = burst('drop_newest')
+    assert processed==list(range(IB_DEPTH)) and ib.dropped==2*IB_DEPTH
+    processed, ib = burst('drop_oldest')
+    assert processed==list(range(2*IB_DEPTH,3*IB_DEPTH)) and ib.dropped==2*IB_DEPTH
+    processed, ib = burst('sample',num_input_vectors=IB_DEPTH+6,interval=2)
+    assert processed==list(range(3,IB_DEPTH))+[IB_DEPTH+1,IB_DEPTH+3,IB_DEPTH+5] and ib.dropped==6
+
+    # The vector being dispatched is never dropped
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    proc.config(firm.raw(proc.compiler))
+    proc.overflowPolicy('drop_oldest')
+    proc.push_many(np.repeat(np.arange(IB_DEPTH)[:,None],N,axis=1))
+    proc.run(steps=2)
+    proc.push_many(np.repeat(np.arange(100,103)[:,None],N,axis=1))
+    proc.run(steps=None)
+    assert list(proc.tb.mem[:proc.tb.size,0])==[0,1]+list(range(4,IB_DEPTH))+[100,101,102]
+
+    # Blocking producers wait while the processor steps, so all vectors are processed
+    processed, ib = burst('block')
+    assert processed==list(range(3*IB_DEPTH)) and ib.dropped==0 and ib.stalled>0
+
+    # A producer coroutine is resumed as the buffer drains
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    proc.config(firm.raw(proc.compiler))
+    proc.overflowPolicy('block')
+    async def producer():
+        for i in range(3*IB_DEPTH):
+            await proc.pushAsync([np.full(N,i),False,False])
+    async def emulate():
+        await asyncio.gather(producer(),proc.runAsync(steps=None))
+    asyncio.run(emulate())
+    assert list(proc.tb.mem[:proc.tb.size,0])==list(range(3*IB_DEPTH)) and proc.ib.stalled>0
+    print("Passed test #18")
+
+testOverflowPolicies()
+
+def testPerformanceReport():
+
+    # Each vector occupies the input buffer for one cycle per chain, so the sustainable rate is 1/chains vectors per cycle
+    num_input_vectors=100
+    for bins, rate in [(M,1),(4*M,1),(4*M,0.2)]:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        proc.config(firm.distribution(proc.compiler,bins,M))
+        proc.overflowPolicy('block')
+        report=proc.runSchedule(np.random.rand(num_input_vectors,N),(np.arange(num_input_vectors)/rate).astype(int))
+        chains=bins//M
+        assert report.vectors==num_input_vectors and report.cycles_per_vector==chains
+        assert report.cycles==sum(report.ib_occupancy)
+        assert abs(report.vectors_per_cycle/min(rate,1/chains)-1)<0.1
+
+        # Vectors only wait in the input buffer (and producers only stall) when they arrive faster than they are dispatched
+        if rate>1/chains:
+            assert report.stalled>0 and report.ib_occupancy[IB_DEPTH]>0 and report.latency.max>report.latency.min
+        else:
+            assert report.stalled==0 and report.ib_occupancy[IB_DEPTH]==0 and report.latency.max==report.latency.min
+    print("Passed test #19")
+
+testPerformanceReport()
+
+def testStaticCost():
+
+    # The static estimate must match what the emulator commits, the latency it measures and when the trace buffer wraps
+    num_input_vectors, frame = 60, 5
+    eof1=np.arange(num_input_vectors)%frame==frame-1
+    firmwares=[(firm.distribution,(2*M,M)),(firm.summaryStats,()),(firm.raw,()),(firm.sumAll,()),(firm.conditions,())]
+    for fw_function, args in firmwares:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,num_input_vectors*MAX_CHAINS,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        fw=fw_function(proc.compiler,*args)
+        cost=fw['cost']
+        proc.config(fw)
+        proc.runBatch(np.random.rand(num_input_vectors,N),eof1)
+        assert proc.tb.size*N+proc.dp.v_out_size==round(cost.valuesPerVector(frame)*num_input_vectors)
+
+        # Vectors pushed far apart never wait in the input buffer
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.config(fw_function(proc.compiler,*args))
+        report=proc.runSchedule(np.random.rand(10,N),np.arange(10)*20)
+        assert report.latency.min==report.latency.max==cost.latency
+        assert report.cycles_per_vector==cost.cycles_per_vector
+        words=cost.wordsPerVector(frame)
+        assert math.isclose(cost.cyclesUntilWrap(frame,TB_SIZE=TB_SIZE),TB_SIZE*cost.cycles_per_vector/words) if words else cost.cyclesUntilWrap(frame,TB_SIZE=TB_SIZE)==float('inf')
+
+    # Frame-level commits never happen if the frame is never closed
+    cost=firm.summaryStats(compiler(N,M,MAX_CHAINS,TB_SIZE))['cost']
+    assert cost.valuesPerVector()==0 and cost.cyclesUntilWrap()==float('inf') and cost.fitsTraceBuffer(10**9)
+    print("Passed test #20")
+
+testStaticCost()
+
+def testChainOptimizer():
+
+    # Firmware with a dead chain and two chains that compute the same vector as a chain that commits it
+    def redundant(cp):
+        cp.begin_chain()
+        cp.vv_add(1)
+        cp.end_chain()
+
+        cp.begin_chain()
+        cp.vv_filter(0)
+        cp.m_reduce('M')
+        cp.v_commit(M,'last')
+        cp.end_chain()
+
+        cp.begin_chain()
+        cp.v_commit(N)
+        cp.end_chain()
+
+        cp.begin_chain()
+        cp.vv_filter(0)
+        cp.m_reduce('M')
+        cp.v_cache(0,'notfirst')
+        cp.end_chain()
+
+        cp.begin_chain()
+        cp.v_mc_load()
+        cp.vv_add(0)
+        cp.v_mc_save()
+        cp.end_chain()
+        return cp.compile()
+
+    # Every firmware must commit the same values once optimized, whatever the order of the building blocks
+    num_input_vectors=40
+    vectors=np.random.rand(num_input_vectors,N)*4
+    eof1, eof2 = np.arange(num_input_vectors)%4==3, np.arange(num_input_vectors)%8==7
+    firmwares=[redundant,lambda cp: firm.distribution(cp,2*M,M),firm.summaryStats,firm.vectorChange,firm.correlation,firm.passThrough,
+               firm.conditions,firm.minicache,firm.activationPredictiveness,firm.multipleChains]
+    for blocks in [BUILDING_BLOCKS,['InputBuffer','FilterReduceUnit','VectorScalarReduce','VectorVectorALU','DataPacker','TraceBuffer']]:
+        for fw_function in firmwares:
+            proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,blocks)
+            proc.fu.vrf=list(range(FUVRF_SIZE*M))
+            cp=compiler(N,M,MAX_CHAINS,optimize=True)
+            fw=fw_function(cp)
+            assert fw['valid_chains']<=cp.unoptimized['valid_chains']
+            assert proc.equivalent(cp.unoptimized,fw,vectors,eof1,eof2)
+
+    # The dead chain is removed and the cache of the fourth chain is merged into the second one, so 3 of the 5 chains are left
+    fw=redundant(compiler(N,M,MAX_CHAINS,optimize=True))
+    assert fw['valid_chains']==3 and fw['cost'].cycles_per_vector==3
+    assert fw['vvalu'][0].cache==1 and fw['dp'][0].size==M and fw['vvalu'][2].minicache==3
+    print("Passed test #21")
+
+testChainOptimizer()
+
+def testStatistics():
+
+    # Frame statistics are ordered by commit size, and only the sum is widened so that the commits of a frame fill whole rows
+    num_input_vectors, frame = 20, 5
+    vectors=np.random.rand(num_input_vectors,N)*4
+    eof1=np.arange(num_input_vectors)%frame==frame-1
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    prog=statistics(proc.compiler,FUVRF_SIZE,VVVRF_SIZE)
+    prog.histogram(0,4,2*M)
+    prog.runningSum()
+    prog.maxOverBatch()
+    proc.config(prog.compile())
+    proc.fu.vrf=prog.fu_vrf
+    proc.runBatch(vectors,eof1)
+    assert [(output.name,output.size) for output in prog.outputs]==[('runningSum',N),('maxOverBatch',N),('histogram',M),('histogram',M)]
+    rows=proc.tb.mem[:proc.tb.size].reshape(-1,3,N)
+    assert len(rows)==num_input_vectors//frame
+    for f, frame_rows in enumerate(rows):
+        frame_vectors=vectors[f*frame:(f+1)*frame]
+        counts=np.histogram(frame_vectors,bins=2*M,range=(0,4))[0]
+        assert np.isclose(frame_rows[0,0],np.sum(frame_vectors)) and not frame_rows[0,1:].any()
+        assert np.allclose(frame_rows[1],np.max(frame_vectors,axis=0)) and np.array_equal(frame_rows[2],counts)
+
+    # Commits that fire at different vectors are padded separately, and chains that belong together are not split
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    prog=statistics(proc.compiler,FUVRF_SIZE,VVVRF_SIZE)
+    prog.runningSum()
+    prog.histogram(0,4,M)
+    prog.sumOfSquares()
+    proc.config(prog.compile())
+    proc.fu.vrf=prog.fu_vrf
+    proc.runBatch(vectors,eof1)
+    assert [(output.name,output.size) for output in prog.outputs]==[('runningSum',M),('histogram',M),('sumOfSquares',M)]
+    assert [chain.name for chain in prog.chains]==['runningSum','histogram','sumOfSquares','sumOfSquares']
+    assert proc.tb.size*N+proc.dp.v_out_size==(num_input_vectors+2*num_input_vectors//frame)*M
+
+    # A histogram only needs an address that continues its ranges if another one follows that does not continue them
+    prog=statistics(compiler(N,M,MAX_CHAINS),FUVRF_SIZE,VVVRF_SIZE)
+    prog.histogram(0,4,M)
+    prog.histogram(4,8,M)
+    prog.histogram(0,1,M)
+    prog.compile()
+    assert [reg.addr for reg in prog.fuvrf]==[0,1,3] and np.array_equal(prog.fu_vrf[:3*M],np.arange(3*M)*4/M)
+
+    # Vector statistics reuse the VVVRF address of the squared vector for the difference with the previous vector
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    prog=statistics(proc.compiler,FUVRF_SIZE,3)
+    prog.sumOfSquares()
+    prog.dotWithPrevious()
+    prog.distanceToPrevious()
+    proc.config(prog.compile())
+    proc.runBatch(vectors)
+    assert len(prog.vvvrf)==4 and max(reg.addr for reg in prog.vvvrf)==2
+    values=np.concatenate((proc.tb.mem[:proc.tb.size].ravel(),proc.dp.v_out[:proc.dp.v_out_size])).reshape(-1,3)
+    previous=np.vstack((np.zeros(N),vectors[:-1]))
+    expected=np.stack((np.sum(vectors**2,axis=1),np.sum(vectors*previous,axis=1),np.sum((vectors-previous)**2,axis=1)),axis=1)
+    assert np.allclose(values,expected)
+
+    # Running out of registers or chains fails at compile time
+    for VVVRF, repeat in [(2,1),(VVVRF_SIZE,4)]:
+        prog=statistics(compiler(N,M,MAX_CHAINS),FUVRF_SIZE,VVVRF)
+        for _ in range(repeat):
+            prog.sumOfSquares()
+            prog.dotWithPrevious()
+            prog.distanceToPrevious()
+        try:
+            prog.compile()
+            assert False
+        except AssertionError as e:
+            assert "Statistics need" in str(e)
+    print("Passed test #22")
+
+testStatistics()
+
+def testCompileCache():
+
+    # A compiler that is reset compiles the same firmware as a new one
+    cp=compiler(N,M,MAX_CHAINS)
+    firm.distribution(cp,2*M,M)
+    cp.reset()
+    assert str(firm.summaryStats(cp))==str(firm.summaryStats(compiler(N,M,MAX_CHAINS)))
+
+    # Identical firmware is only compiled once, and entries are reused from disk by other caches
+    with tempfile.TemporaryDirectory() as directory:
+        cache=firmwareCache(directory)
+        for bins in [M,2*M,M,2*M]:
+            entry=cache.compile(cp,firm.distribution,bins,M)
+            assert entry.firmware['valid_chains']==bins//M and entry.rtl['IB']==bins//M
+        for fw_function in [lambda cp: firm.raw(cp), lambda cp: firm.sumAll(cp)]:
+            cache.compile(cp,fw_function)
+        assert cache.misses==4 and cache.hits==2
+
+        disk_cache=firmwareCache(directory)
+        entry=disk_cache.compile(compiler(N,M,MAX_CHAINS),firm.distribution,2*M,M)
+        assert disk_cache.hits==1 and disk_cache.misses==0
+        disk_cache.compile(compiler(N,M,MAX_CHAINS-1),firm.distribution,2*M,M)
+        assert disk_cache.misses==1
+
+        # Cached firmware gives the same results as firmware compiled from scratch
+        vectors=np.random.rand(10,N)*FUVRF_SIZE*M
+        results=[]
+        for fw in [entry.firmware,firm.distribution(compiler(N,M,MAX_CHAINS),2*M,M)]:
+            proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+            proc.fu.vrf=list(range(FUVRF_SIZE*M))
+            proc.config(fw)
+            results.append(proc.runBatch(vectors,np.arange(10)%5==4).copy())
+        assert np.array_equal(*results) and entry.rtl==cp.rtlFirmware(fw)
+    print("Passed test #23")
+
+testCompileCache()
+
+def testFirmwareImage():
+
+    # Model of a reconfig unit that routes the bytes it receives to the blocks (reconfig_unit.sv only implements command 42)
+    def receive(image,upload):
+        image=dict(image)
+        sizes=[len(image[config_id]) for config_id in sorted(image)]
+        i=0
+        while i<len(upload):
+            if upload[i]==CMD_UPDATE_ALL:
+                for config_id, size in enumerate(sizes):
+                    image[config_id]=upload[i+1:i+1+size]
+                    i+=size
+                i+=1
+            else:
+                assert upload[i]==CMD_UPDATE_BLOCK
+                config_id, size = upload[i+1], upload[i+2]<<8 | upload[i+3]
+                image[config_id]=upload[i+4:i+4+size]+image[config_id][size:]
+                i+=4+size
+        return image
+
+    # The image holds every firmware register of each block, followed by the packed FUVRF contents
+    fu_vrf=np.arange(FUVRF_SIZE*M)/4
+    cp=compiler(N,M,MAX_CHAINS)
+    fw=firm.distribution(cp,2*M,M)
+    image=cp.image(fw,fu_vrf,DATA_WIDTH=32)
+    assert [len(image[i]) for i in range(5)]==[1,3*MAX_CHAINS+FUVRF_SIZE*M*4,7*MAX_CHAINS,MAX_CHAINS,2*MAX_CHAINS]
+    assert image[0][0]==2 and list(image[1][MAX_CHAINS:MAX_CHAINS+2])==[0,1] and list(image[2][:3])==[1,1,0]
+    first_address=int.from_bytes(image[1][3*MAX_CHAINS:3*MAX_CHAINS+4*M],'big')
+    assert [first_address>>(32*i) & (2**32-1) for i in range(M)]==encodeArray(fu_vrf[:M],32).tolist()
+    upload=fullUpload(image)
+    assert len(upload)==1+sum(len(b) for b in image.values()) and receive(image,upload)==image
+
+    # Switching firmware only sends the blocks (and the bytes of each block) that changed
+    cp.reset()
+    new_fw=firm.distribution(cp,M,M)
+    new_image=cp.image(new_fw,fu_vrf,DATA_WIDTH=32)
+    delta=deltaUpload(image,new_image)
+    assert receive(image,delta)==new_image and len(delta)<len(fullUpload(new_image))/2
+    assert deltaUpload(new_image,new_image)==b'' and uploadTime(delta)<uploadTime(upload)
+
+    # Changing the first FUVRF address only sends the filter reduce unit bytes up to that address
+    fu_vrf[:M]+=1
+    delta=deltaUpload(new_image,cp.image(new_fw,fu_vrf,DATA_WIDTH=32))
+    assert 4+3*MAX_CHAINS<len(delta)<=4+3*MAX_CHAINS+4*M and delta[1]==1
+    print("Passed test #24")
+
+testFirmwareImage()
+
+def testTraceDecoder():
+
+    # Histograms of frames that were not overwritten are recovered from a trace buffer that wrapped around
+    num_input_vectors, frame, small_tb = 40, 4, 3
+    vectors=np.random.rand(num_input_vectors,N)*FUVRF_SIZE*M
+    eof1=np.arange(num_input_vectors)%frame==frame-1
+    rows=[]
+    for tb_size in [small_tb,TB_SIZE]:
+        proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,tb_size,MAX_CHAINS,BUILDING_BLOCKS)
+        proc.fu.vrf=list(range(FUVRF_SIZE*M))
+        fw=firm.distribution(proc.compiler,2*M,M)
+        proc.config(fw)
+        proc.runBatch(vectors,eof1)
+        rows.append((proc.tb.mem,proc.tb.size))
+    decoder=traceDecoder(fw,N,names=['histogram']*2)
+    results=decoder.decode(rows[0][0],eof1,tb_size=rows[0][1])
+    frames=decoder.vectors['histogram']//frame
+    assert list(frames)==list(range(10-small_tb,10)) and np.array_equal(results['histogram'],rows[1][0][frames])
+
+    # The RTL dumps unsigned words as strings, which are converted to signed integers or fixed-point values
+    for DATA_TYPE, words, scale in [('int',encodeArray(-rows[0][0],32,frac_bits=0),-1),('fixed_point',encodeArray(-rows[0][0]/8,32),-1/8)]:
+        mem_data=[[str(w) for w in row] for row in words]
+        decoded=decoder.decode(mem_data,eof1,tb_size=rows[0][1],DATA_WIDTH=32,DATA_TYPE=DATA_TYPE)
+        assert decoded['histogram'].dtype.kind in 'if' and np.array_equal(decoded['histogram'],results['histogram']*scale)
+
+    # Commits of different sizes are decoded from a memory-mapped dump, leaving out values still in the data packer
+    proc = emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    prog=statistics(proc.compiler,FUVRF_SIZE,VVVRF_SIZE)
+    prog.runningSum()
+    prog.dotWithPrevious()
+    fw=prog.compile()
+    proc.config(fw)
+    vectors, eof1 = vectors[:-1], np.arange(num_input_vectors-1)%5==4
+    proc.runBatch(vectors,eof1)
+    with tempfile.TemporaryDirectory() as directory:
+        path=os.path.join(directory,'trace.npy')
+        np.save(path,proc.tb.mem)
+        decoder=traceDecoder(fw,N,names=[output.name for output in prog.outputs])
+        results=decoder.decode(loadTrace(path,N),eof1)
+        sums, dots = results['runningSum'][:,0], results['dotWithPrevious'][:,0]
+        assert np.allclose(sums,np.sum(vectors[:35].reshape(-1,5,N),axis=(1,2))[:len(sums)])
+        previous=np.vstack((np.zeros(N),vectors[:-1]))
+        assert np.allclose(dots,np.sum(vectors*previous,axis=1)[decoder.vectors['dotWithPrevious']])
+        assert len(sums)+len(dots)==proc.tb.size*N and proc.dp.v_out_size>0
+        del results, sums, dots
+    print("Passed test #25")
+
+testTraceDecoder()
+
+# Writes shell stand-ins for simulator commands, which log how they are called to commands.log
+# The simulate command writes empty results, or copies the signals dumped from a given file
+def fakeSimulator(directory,commands,simulate,dump=None):
+    bin_folder=os.path.join(directory,'bin')
+    os.mkdir(bin_folder)
+    for command in commands:
+        with open(os.path.join(bin_folder,command),'w') as f:
+            f.write('#!/bin/sh\necho "$(basename $0) $*" >> '+directory+'/commands.log\n')
+            if command==simulate:
+                f.write((': > simulation_results.bin' if dump is None else 'cp '+dump+' simulation_results.bin')+'\n: > simulation_results_tb.txt\n')
+        os.chmod(os.path.join(bin_folder,command),0o755)
+    return bin_folder
+
+def testSimulationSession():
+
+    # Shell stand-ins for the ModelSim commands
+    with tempfile.TemporaryDirectory() as directory:
+        bin_folder=fakeSimulator(directory,['vlib','vlog','vsim'],'vsim')
+        path=os.environ['PATH']
+        os.environ['PATH']=bin_folder+os.pathsep+path
+        os.mkdir(os.path.join(directory,'container'))
+        try:
+            hw_proc = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,32,MAX_CHAINS,BUILDING_BLOCKS,'fixed_point','Cyclone V')
+            hw_proc.config(firm.raw(hw_proc.compiler))
+            container=localContainer(os.path.join(directory,'container'),log=False)
+            with modelsimSession(container) as session:
+                hw_proc.run(steps=10,log=False,session=session)
+                hw_proc.run(steps=10,log=False,session=session)
+                hw_proc.push([np.zeros(N),False,False])
+                results=hw_proc.run(steps=20,log=False,session=session)
+                hw_proc.compiler.reset()
+                hw_proc.config(firm.sumAll(hw_proc.compiler))
+                hw_proc.run(steps=20,log=False,session=session)
+                assert container.running and results['tb']['mem_data']==[]
+            with open(os.path.join(directory,'commands.log')) as f:
+                commands=[line.split()[0]+' '+line.split()[-1] for line in f]
+        finally:
+            os.environ['PATH']=path
+
+        # The vendor libraries are compiled once, and the testbench only when the hardware changes (not its inputs)
+        assert commands==['vlib work','vlog altera_lnsim.sv','vlog testbench.sv','vsim +STEPS=10','vsim +STEPS=10','vsim +STEPS=20','vlog testbench.sv','vsim +STEPS=20']
+        assert session.compilations==[['altera_mf.v','altera_lnsim.sv'],['testbench.sv'],['testbench.sv']]
+        assert not container.running and os.listdir(os.path.join(directory,'container'))==[]
+    print("Passed test #26")
+
+testSimulationSession()
+
+def testLocalSimulator():
+
+    # Unknown simulators are rejected
+    try:
+        rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,32,MAX_CHAINS,BUILDING_BLOCKS,'fixed_point','Cyclone V',SIMULATOR='xsim')
+        assert False
+    except AssertionError as e:
+        assert "Unknown simulator" in str(e)
+
+    # Icarus Verilog compiles the testbench on the host, with a behavioral ram initialized from hex files
+    with tempfile.TemporaryDirectory() as directory:
+        bin_folder=fakeSimulator(directory,['iverilog','vvp'],'vvp')
+        path=os.environ['PATH']
+        os.environ['PATH']=bin_folder+os.pathsep+path
+        try:
+            hw_proc = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,32,MAX_CHAINS,BUILDING_BLOCKS,'int','Cyclone V',SIMULATOR='icarus')
+            hw_proc.top.mod.filterReduceUnit.mem['furf']['init_values']=np.arange(FUVRF_SIZE*M).reshape(FUVRF_SIZE,M).tolist()
+            hw_proc.config(firm.raw(hw_proc.compiler))
+            results=hw_proc.run(steps=10,log=False,folder=os.path.join(directory,'rtl'))
+            with open(os.path.join(directory,'commands.log')) as f:
+                commands=[line.split()[0] for line in f]
+            with open(os.path.join(directory,'rtl','ram_dual_port.sv')) as f:
+                ram=f.read()
+            with open(os.path.join(directory,'rtl','furf.mif.hex')) as f:
+                furf=[int(line,16) for line in f]
+        finally:
+            os.environ['PATH']=path
+        assert commands==['iverilog','vvp'] and results['tb']['mem_data']==[]
+        assert 'altsyncram_component' not in ram and '$readmemh' in ram
+        assert furf[1]==sum(v<<(32*i) for i, v in enumerate(range(M,2*M)))
+    print("Passed test #27")
+
+testLocalSimulator()
+
+def testParallelSimulations():
+
+    # Jobs run in their own temporary folders, without changing the working directory
+    with tempfile.TemporaryDirectory() as directory:
+        bin_folder=fakeSimulator(directory,['iverilog','vvp'],'vvp')
+        path, current_folder = os.environ['PATH'], os.getcwd()
+        os.environ['PATH']=bin_folder+os.pathsep+path
+        try:
+            config=dict(globals(),DATA_WIDTH=32,DATA_TYPE='int',DEVICE_FAM='Cyclone V',SIMULATOR='icarus')
+            jobs=[(dict(config,N=n),firm.raw(compiler(n,M,MAX_CHAINS)),[[np.arange(n),False,False]]*i) for i, n in enumerate([8,16,8])]
+            results=runMany(jobs,steps=10,processes=2)
+            with open(os.path.join(directory,'commands.log')) as f:
+                commands=[line.split()[0] for line in f]
+        finally:
+            os.environ['PATH']=path
+        assert len(results)==3 and all(r['tb']['mem_data']==[] for r in results)
+        assert sorted(commands)==['iverilog']*3+['vvp']*3 and os.getcwd()==current_folder and not os.path.exists('rtl')
+        try:
+            runMany([jobs[0],(dict(config,SIMULATOR='verilator'),jobs[1][1],[])])
+            assert False
+        except AssertionError as e:
+            assert "same simulator" in str(e)
+
+    # Sessions sharing a container only stop it if they started it and no other session is still open in it
+    with tempfile.TemporaryDirectory() as directory:
+        container=localContainer(directory,log=False)
+        first, second = modelsimSession(container,vendor_libraries=()), modelsimSession(container,vendor_libraries=())
+        bin_folder=fakeSimulator(directory,['vlib'],None)
+        path=os.environ['PATH']
+        os.environ['PATH']=bin_folder+os.pathsep+path
+        try:
+            first.open()
+            second.open()
+            assert first.started and not second.started and sorted(first.openSessions())==sorted([first.workdir[1:],second.workdir[1:]])
+            first.close()
+            assert container.running and second.openSessions()==[second.workdir[1:]]
+            second.close()
+            assert container.running
+            container.stop()
+            with modelsimSession(container,vendor_libraries=()) as session:
+                assert session.started
+            assert not container.running
+        finally:
+            os.environ['PATH']=path
+
+    # Sessions of other processes can use containers with different names (a local container stands in for Docker)
+    docker_container=hardware.modelsimContainer
+    hardware.modelsimContainer=lambda log, name: localContainer(directory,log,name)
+    try:
+        hw_proc = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,32,MAX_CHAINS,BUILDING_BLOCKS,'int','Cyclone V')
+        assert hw_proc.session(log=False).container.name=='modelsim'
+        assert hw_proc.session(log=False,container='modelsim-1').container.name=='modelsim-1'
+    finally:
+        hardware.modelsimContainer=docker_container
+
+    # A run that fails closes the session it opened and removes its temporary folder
+    with tempfile.TemporaryDirectory() as directory:
+        os.mkdir(os.path.join(directory,'container'))
+        os.mkdir(os.path.join(directory,'tmp'))
+        containers=[]
+        hardware.modelsimContainer=lambda log, name: containers.append(localContainer(os.path.join(directory,'container'),log,name)) or containers[-1]
+        bin_folder=fakeSimulator(directory,['vlib','vlog'],None)
+        path, temporary_folder = os.environ['PATH'], tempfile.tempdir
+        os.environ['PATH'], tempfile.tempdir = bin_folder+os.pathsep+path, os.path.join(directory,'tmp')
+        try:
+            hw_proc = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,32,MAX_CHAINS,BUILDING_BLOCKS,'int','Cyclone V')
+            hw_proc.config(firm.raw(hw_proc.compiler))
+            try:
+                hw_proc.run(steps=10,log=False)
+                assert False
+            except FileNotFoundError:
+                pass
+        finally:
+            hardware.modelsimContainer=docker_container
+            os.environ['PATH'], tempfile.tempdir = path, temporary_folder
+        assert not containers[0].running and os.listdir(os.path.join(directory,'container'))==[]
+        assert os.listdir(os.path.join(directory,'tmp'))==[]
+    print("Passed test #28")
+
+testParallelSimulations()
+
+def testStimulusFile():
+
+    # The testbench is the same for any inputs and steps, which it reads from stimulus.hex and the STEPS plusarg
+    with tempfile.TemporaryDirectory() as directory:
+        bin_folder=fakeSimulator(directory,['iverilog','vvp'],'vvp')
+        path=os.environ['PATH']
+        os.environ['PATH']=bin_folder+os.pathsep+path
+        try:
+            testbenches=[]
+            hw_proc = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,32,MAX_CHAINS,BUILDING_BLOCKS,'int','Cyclone V',SIMULATOR='icarus')
+            hw_proc.config(firm.raw(hw_proc.compiler))
+            for steps in [10,30]:
+                hw_proc.push([np.arange(N),True,steps==30])
+                hw_proc.run(steps=steps,log=False,folder=os.path.join(directory,'rtl'))
+                with open(os.path.join(directory,'rtl','testbench.sv')) as f:
+                    testbenches.append(f.read())
+                with open(os.path.join(directory,'rtl','stimulus.hex')) as f:
+                    stimulus=f.read().split()
+            with open(os.path.join(directory,'commands.log')) as f:
+                commands=[line.split()[-1] for line in f if line.startswith('vvp')]
+        finally:
+            os.environ['PATH']=path
+        assert testbenches[0]==testbenches[1] and commands==['+STEPS=10','+STEPS=30']
+        assert stimulus[0::2]==['1','3'] and len(stimulus[1])==N*32//4
+        assert [int(stimulus[1],16)>>(32*i) & (2**32-1) for i in range(N)]==list(range(N))
+    print("Passed test #29")
+
+testStimulusFile()
+
+def testSignalProbes():
+
+    # Only the probed signals of the cycles in the window are dumped, as 32-bit words that are loaded into typed arrays
+    with tempfile.TemporaryDirectory() as directory:
+        cycles, first_cycle = 3, 2
+        vector_out=np.arange(cycles*N,dtype=np.uint32).reshape(cycles,N)
+        samples=np.hstack((np.ones((cycles,1)),vector_out,np.arange(cycles)[:,None]%MAX_CHAINS,np.zeros((cycles,1+N)))).astype(np.uint32)
+        samples.tofile(os.path.join(directory,'dump.bin'))
+        bin_folder=fakeSimulator(directory,['iverilog','vvp'],'vvp',dump=os.path.join(directory,'dump.bin'))
+        path=os.environ['PATH']
+        os.environ['PATH']=bin_folder+os.pathsep+path
+        try:
+            hw_proc = rtlHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,32,MAX_CHAINS,BUILDING_BLOCKS,'int','Cyclone V',SIMULATOR='icarus')
+            hw_proc.config(firm.raw(hw_proc.compiler))
+            hw_proc.probe(instances=['ib','dp'],signals=['valid_out','vector_out','chainId_out'],cycles=(first_cycle,first_cycle+cycles-1))
+            results=hw_proc.run(steps=10,log=False,folder=os.path.join(directory,'rtl'))
+            with open(os.path.join(directory,'rtl','testbench.sv')) as f:
+                dumped=[line.split('dbg.')[1].split('[')[0].split(')')[0] for line in f if '$fwrite(write_data, "%u"' in line]
+            with open(os.path.join(directory,'commands.log')) as f:
+                commands=[line.split()[1:] for line in f if line.startswith('vvp')]
+        finally:
+            os.environ['PATH']=path
+        assert dumped==['ib.valid_out','ib.vector_out','ib.chainId_out','dp.valid_out','dp.vector_out']
+        assert commands==[['-n','testbench.vvp','+STEPS=10','+FIRST_CYCLE=2','+LAST_CYCLE=4']]
+        assert sorted(results)==['dp','ib','tb'] and list(results['ib']['cycle'])==[2,3,4]
+        assert results['ib']['valid_out'].dtype==np.uint8 and results['ib']['vector_out'].dtype==np.uint32
+        assert np.array_equal(results['ib']['vector_out'],vector_out) and list(results['ib']['chainId_out'])==[0,1,2]
+        assert results['dp']['vector_out'].shape==(cycles,N) and not results['dp']['valid_out'].any()
+
+    # Probing an instance that does not exist fails when the testbench is generated
+    hw_proc.probe(instances=['ib','alu'])
+    try:
+        hw_proc.testbench()
+        assert False
+    except AssertionError as e:
+        assert "alu" in str(e)
+    print("Passed test #30")
+
+testSignalProbes()
@@ -1,4 +1,4 @@
-import docker, subprocess, sys, shlex
+import docker, subprocess, sys, shlex, os, shutil, hashlib, uuid
 
 class modelsimContainer():
 
@@ -16,12 +16,12 @@ class modelsimContainer():
     def cleanLog(self):
         # Current script only works for MacOs
         if sys.platform=='darwin':
-            log_path=self.runSubprocess(['docker','inspect','--format=\'{{.LogPath}}\'','modelsim'],log=False)[0].decode("utf-8")
+            log_path=self.runSubprocess(['docker','inspect','--format=\'{{.LogPath}}\'',self.name],log=False)[0].decode("utf-8")
             self.runSubprocess(['bash','-c',"docker run -it --rm --privileged --pid=host alpine:latest nsenter -t 1 -m -u -n -i -- truncate -s0 "+log_path])
 
     # Execute a command on a running container
-    def exec(self,cmd,working_directory="/"):
-      self.runSubprocess(['docker','exec','-w'+working_directory,self.container.name]+shlex.split(cmd))
+    def exec(self,cmd,working_directory="/",log=True):
+      return self.runSubprocess(['docker','exec','-w'+working_directory,self.container.name]+shlex.split(cmd),log=log)
       #exec_log=self.apiClient.exec_start(self.apiClient.exec_create(self.container.name, cmd))
     
     # Copy files to/from container
@@ -37,11 +37,16 @@ class modelsimContainer():
         self.container.stop(timeout=0)
         self.cleanLog()
 
+    def isRunning(self):
+        self.container.reload()
+        return self.container.status=='running'
+
     # Open Gui
     def gui(self):
         self.exec('vsim -gui')
 
-    def __init__(self,log):
+    # Processes that must not share a container (e.g. one stopping it while another simulates) can use different names
+    def __init__(self,log,name='modelsim'):
         # Start docker dockerClient
         self.dockerClient = docker.from_env()
         try:
@@ -51,10 +56,11 @@ class modelsimContainer():
             exit()
         self.apiClient = docker.APIClient(base_url='unix://var/run/docker.sock')
         self.log=log
+        self.name=name
 
         # Check whether we already have the container
         try:
-            self.container = self.dockerClient.containers.get('modelsim')
+            self.container = self.dockerClient.containers.get(name)
         # If we don't, download it
         except: 
             print("Downloading modelsim image - This might take 5-10min")
@@ -64,7 +70,149 @@ class modelsimContainer():
             elif sys.platform=="linux":
                 env = ["DISPLAY=:0"]
                 net = "host"
-            self.dockerClient.containers.run('goldensniper/modelsim-docker',stdin_open = True, tty = True,detach=True,environment=env,network=net,name='modelsim')
-            self.container = self.dockerClient.containers.get('modelsim')
+            self.dockerClient.containers.run('goldensniper/modelsim-docker',stdin_open = True, tty = True,detach=True,environment=env,network=net,name=name)
+            self.container = self.dockerClient.containers.get(name)
             print("Download complete")
 
+
+
+# Stand-in for the ModelSim container that runs commands on the host, with root playing the role of the container's
+# file system (e.g. to use a local ModelSim installation or to test sessions without Docker)
+class localContainer():
+
+    def runSubprocess(self,cmd,working_directory,log=True):
+        proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE,cwd=working_directory)
+        proc.wait()
+        result = proc.stdout.readlines()+proc.stderr.readlines()
+        if self.log and log:
+            [ print(r.decode("utf-8"), end = '') for r in result]
+        return result
+
+    # Paths prefixed with the container name are relative to root
+    def path(self,path):
+        if path.startswith(self.name+':'):
+            return os.path.join(self.root,path[len(self.name)+1:].lstrip('/'))
+        return path
+
+    def exec(self,cmd,working_directory="/",log=True):
+        return self.runSubprocess(shlex.split(cmd),self.path(self.name+':'+working_directory),log)
+
+    def copy(self,src,dst):
+        src, dst = self.path(src), self.path(dst)
+        if os.path.isdir(src):
+            shutil.copytree(src,os.path.join(dst,os.path.basename(os.path.normpath(src))),dirs_exist_ok=True)
+        else:
+            shutil.copy(src,dst)
+
+    def start(self):
+        self.running=True
+
+    def stop(self):
+        self.running=False
+
+    def isRunning(self):
+        return self.running
+
+    def __init__(self,root,log=True,name='modelsim'):
+        self.root=root
+        self.log=log
+        self.name=name
+        self.running=False
+
+# Keeps a container running across simulations
+# The vendor libraries are compiled once into a work library that persists in the container, and files are only copied
+# to the container when their contents change, so each run only recompiles the testbench and the debug processor
+# Each session has its own working directory, so several sessions (e.g. of different processes) can share a container.
+# A session only stops the container when it is closed if it started the container and no other session still has a
+# working directory in it, and sessions created with stop=False always leave it running. Processes that must not share
+# a container can use containers with different names.
+#   session=modelsimSession(modelsimContainer(log))
+#   hw_proc.run(steps,session=session)
+#   session.close()
+class modelsimSession():
+    vendor_rams=True
+
+    # Copies to the container the files of a folder that changed since they were last copied
+    def sync(self,folder):
+        changed=[]
+        for name in sorted(os.listdir(folder)):
+            path=os.path.join(folder,name)
+            if not os.path.isfile(path):
+                continue
+            with open(path,'rb') as f:
+                digest=hashlib.sha256(f.read()).hexdigest()
+            if self.files.get(name)!=digest:
+                self.container.copy(path,self.container.name+':'+self.workdir+'/'+name)
+                self.files[name]=digest
+                changed.append(name)
+        return changed
+
+    # Compiles the files of a folder, skipping the vendor libraries and the top file if none of them changed
+    # Other files (memory initialization files and stimulus) are only read when simulating
+    def compile(self,folder,top='testbench.sv'):
+        self.open()
+        changed=self.sync(folder)
+        libraries=[lib for lib in self.vendor_libraries if lib in changed]
+        if libraries:
+            self.vlog(libraries)
+        sources=[name for name in changed if name.endswith(('.v','.sv')) and name not in self.vendor_libraries]
+        if self.compiled is None or sources:
+            self.vlog([top])
+            self.compiled=top
+
+    def vlog(self,files):
+        self.container.exec('vlog '+' '.join(files),working_directory=self.workdir)
+        self.compilations.append(files)
+
+    def simulate(self,top='testbench',gui=False,plusargs=()):
+        mode='-gui' if gui else '-c'
+        self.container.exec(' '.join(['vsim',mode,'-do "run -all"',top]+list(plusargs)),working_directory=self.workdir)
+
+    # Copies files from the working directory of the container to a folder
+    def fetch(self,names,folder):
+        for name in names:
+            self.container.copy(self.container.name+':'+self.workdir+'/'+name,os.path.join(folder,name))
+
+    def open(self):
+        if self.running:
+            return
+        self.started=not self.container.isRunning()
+        if self.started:
+            self.container.start()
+        self.container.exec('mkdir -p '+self.workdir.lstrip('/'))
+        self.container.exec('vlib work',working_directory=self.workdir)
+        self.running=True
+
+    # Working directories of the sessions that are open in the container (named /rtl-* by default)
+    def openSessions(self):
+        names=[line.decode("utf-8").strip() for line in self.container.exec('ls',log=False)]
+        return [name for name in names if name.startswith('rtl-')]
+
+    # Removes the working directory (and the compiled libraries with it) and stops the container if no one else uses it
+    def close(self):
+        if not self.running:
+            return
+        self.container.exec('rm -r '+self.workdir.lstrip('/'))
+        if self.stop and self.started and not self.openSessions():
+            self.container.stop()
+        self.running=False
+        self.files={}
+        self.compiled=None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def __init__(self,container,vendor_libraries=('altera_mf.v','altera_lnsim.sv'),workdir=None,stop=True):
+        self.container=container
+        self.vendor_libraries=list(vendor_libraries)
+        self.workdir='/rtl-'+uuid.uuid4().hex[:8] if workdir is None else workdir
+        self.stop=stop
+        self.started=False
+        self.running=False
+        self.files={}
+        self.compiled=None
+        self.compilations=[]
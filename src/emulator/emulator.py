@@ -1,7 +1,8 @@
 import logging as log
-import sys, math
+import sys, math, asyncio
+from collections import deque
 import numpy as np
-from firmware.compiler import compiler
+from firmware.compiler import compiler, encodeCond, failedConditions
 from misc.misc import *
 
 # Setting Debug level (can be debug, info, warning, error and critical)
@@ -10,17 +11,295 @@ log.basicConfig(stream=sys.stderr, level=log.INFO)
 ''' Emulation settings '''
 DEBUG=True
 
+# Formats in which the filter unit hands its results to the matrix vector reduce unit
+FILTER_PASS=0   # Filter disabled, the input vector is passed through
+FILTER_BINS=1   # Index of the range each element falls into (-1 or M if it is outside of all ranges)
+FILTER_MASK=2   # uint8 M x N matrix indicating whether each element is within each range
+FILTER_EDGES=3  # bool (M+1) x N matrix indicating whether each element is above each range limit (sorted limits only)
+
+# Mask of the conditions that do not hold for each combination of eof and bof flags (indexed by eof | bof<<2)
+# A chain executes if none of the conditions in its mask fails (note that the hardware executes if any of them holds,
+# which is equivalent as long as instructions use a single condition)
+CONDITION_FAILS=[failedConditions(flags&3,flags>>2) for flags in range(16)]
+
+# Lowers a firmware into tables of integers indexed by chainId, with conditions encoded as 8-bit masks
+# Chain 0 is a pass through that does not commit any values
+def lowerFirmware(fw=None):
+    chains=[] if fw is None else range(fw['valid_chains'])
+    table = lambda block,field,encode=None: [0]+[getattr(fw[block][idx],field) if encode is None else encode(fw[block][idx]) for idx in chains]
+    return struct(num_chains=len(chains)+1,
+                  fu=struct(filter=table('fu','filter'),addr=table('fu','addr')),
+                  mvru=struct(axis=table('mvru','axis')),
+                  vsru=struct(op=table('vsru','op')),
+                  vvalu=struct(op=table('vvalu','op'),
+                               addr=table('vvalu','addr'),
+                               cond=table('vvalu',None,lambda chain: encodeCond(chain.cond1,chain.cond2)),
+                               cache=table('vvalu','cache'),
+                               cache_addr=table('vvalu','cache_addr'),
+                               cache_cond=table('vvalu',None,lambda chain: encodeCond(chain.cache_cond1,chain.cache_cond2)),
+                               minicache=table('vvalu','minicache')),
+                  dp=struct(size=table('dp',None,lambda chain: chain.size if chain.commit else 0),
+                            cond=table('dp',None,lambda chain: encodeCond(chain.cond1,chain.cond2))))
+
+# Number format of the values held by the building blocks
+# 'float' computes in float64. 'int' and 'fixed_point' are bit accurate with the RTL: values are DATA_WIDTH-bit words
+# (kept unsigned in int64 arrays, as the RTL logic vectors) that wrap around on overflow in the ALU, adder trees and
+# accumulators. Fixed-point words use the Q(DATA_WIDTH/2).(DATA_WIDTH/2) format of misc.encode.
+class dataFormat():
+    def __init__(self,DATA_TYPE='float',DATA_WIDTH=32):
+        assert DATA_TYPE in ['float','int','fixed_point'], "Unknown data type "+str(DATA_TYPE)
+        assert DATA_TYPE=='float' or (DATA_WIDTH%2==0 and 2<=DATA_WIDTH<=32), "DATA_WIDTH must be even and at most 32 bits"
+        self.DATA_TYPE=DATA_TYPE
+        self.DATA_WIDTH=DATA_WIDTH
+        self.exact=DATA_TYPE!='float'
+        self.dtype=float if DATA_TYPE=='float' else np.int64
+        self.mask=(1<<DATA_WIDTH)-1
+        self.frac_bits=DATA_WIDTH//2 if DATA_TYPE=='fixed_point' else 0
+        # Ops that can be accumulated with a NumPy ufunc before wrapping the result (fixed-point mul and max are not)
+        self.accumulable=(1,) if DATA_TYPE=='fixed_point' else (1,2,4)
+
+    # Converts values into words (fixed-point values saturate as in misc.encode)
+    def encode(self,values):
+        if self.DATA_TYPE=='float':
+            return np.array(values,dtype=float)
+        elif self.DATA_TYPE=='int':
+            return np.array(values).astype(np.int64) & self.mask
+        return encodeArray(values,self.DATA_WIDTH,self.frac_bits).astype(np.int64)
+
+    # Converts words back into values (two's complement integers or fixed-point reals)
+    def decode(self,words):
+        if self.DATA_TYPE=='float':
+            return np.array(words,dtype=float)
+        return self.signed(words) if self.DATA_TYPE=='int' else decodeArray(words,self.DATA_WIDTH,self.frac_bits)
+
+    # Interprets words as two's complement integers
+    def signed(self,words):
+        return toSigned(words,self.DATA_WIDTH)
+
+    # Truncates words to DATA_WIDTH bits in place
+    def wrap(self,words):
+        if self.exact:
+            np.bitwise_and(words,self.mask,out=words)
+        return words
+
+    # Converts the number of elements counted by the filter reduce unit into words in place
+    def count(self,words):
+        if self.frac_bits:
+            np.left_shift(words,self.frac_bits,out=words)
+        return self.wrap(words)
+
+    # Applies a vector-vector ALU operation (writing the result to out if given)
+    # Fixed-point products are computed with sign extended operands and shifted back by DATA_WIDTH/2 bits, and
+    # fixed-point max compares operands as signed words, while integer max compares them as unsigned words
+    def alu(self,op,operator,operand,out=None):
+        if op==1:
+            result=np.add(operator,operand,out=out)
+        elif op==2 and self.DATA_TYPE=='fixed_point':
+            result=np.right_shift(self.signed(operator)*self.signed(operand),self.frac_bits,out=out)
+        elif op==2:
+            result=np.multiply(operator,operand,out=out)
+        elif op==3:
+            result=np.subtract(operator,operand,out=out)
+        elif op==4 and self.DATA_TYPE=='fixed_point':
+            result=np.where(self.signed(operator)>self.signed(operand),operator,operand)
+            if out is not None:
+                np.copyto(out,result)
+                result=out
+        elif op==4:
+            result=np.maximum(operator,operand,out=out)
+        elif out is not None:
+            np.copyto(out,operator)
+            return out
+        else:
+            return operator
+        return self.wrap(result)
+
+# Bounded log of the values seen by a set of probes
+# Each probed field is stored as a column of a NumPy ring buffer that keeps the last `window` samples, and a sample is
+# taken every `interval` cycles, so memory does not grow with the number of cycles emulated
+class probeLog():
+
+    # Log of the fields probed in a building block
+    # log[block][field] returns the samples of a field in chronological order and log[block][i] returns the i-th sample of
+    # the first field of the block (e.g. log['tb'][-1] is the last trace buffer memory sampled)
+    class BlockLog():
+        def __init__(self,parent,fields,window):
+            self.parent=parent
+            self.fields=fields
+            self.columns={name: np.zeros((window,)+shape,dtype=dtype) for name, (attr,shape,dtype) in fields.items()}
+            self.rows={name: list(column) for name, column in self.columns.items() if column.ndim>1}
+
+        def record(self,block,position):
+            for name, (attr,shape,dtype) in self.fields.items():
+                if name in self.rows:
+                    np.copyto(self.rows[name][position],getattr(block,attr))
+                else:
+                    self.columns[name][position]=getattr(block,attr)
+
+        def __len__(self):
+            return min(self.parent.samples,self.parent.window)
+
+        def __getitem__(self,key):
+            if key=='cycle':
+                return self.parent.unroll(self.parent.cycles)
+            elif isinstance(key,str):
+                assert key in self.columns, "Field "+key+" is not being probed"
+                return self.parent.unroll(self.columns[key])
+            return self.parent.unroll(self.columns[next(iter(self.columns))])[key]
+
+        def keys(self):
+            return ['cycle']+list(self.columns)
+
+    # Current values of the fields of a block that is not probed, copied when they are read instead of on every cycle
+    # It has the interface of BlockLog with a single sample (e.g. log['tb'][-1] is the current trace buffer memory)
+    class LiveLog():
+        def __init__(self,proc,block,fields):
+            self.proc=proc
+            self.block=block
+            self.fields=fields
+
+        def __len__(self):
+            return 1
+
+        def __getitem__(self,key):
+            if key=='cycle':
+                return np.array([self.proc.cycle])
+            elif isinstance(key,str):
+                assert key in self.fields, "Field "+key+" is not being probed"
+                return np.array([getattr(getattr(self.proc,self.block),self.fields[key][0])])
+            return self[next(iter(self.fields))][key]
+
+        def keys(self):
+            return ['cycle']+list(self.fields)
+
+    # live maps the names of blocks that are read when accessed to their LiveLog
+    def __init__(self,fields,window,interval,live=None):
+        assert window>0 and interval>0, "Window and interval must be positive"
+        self.window=window
+        self.interval=interval
+        self.samples=0
+        self.cycles=np.zeros(window,dtype=int)
+        self.blocks={block: self.BlockLog(self,block_fields,window) for block, block_fields in fields.items()}
+        self.live={} if live is None else live
+
+    # Returns True if the values of a given cycle should be sampled
+    def sampling(self,cycle):
+        return bool(self.blocks) and cycle%self.interval==0
+
+    def record(self,name,block):
+        if name in self.blocks:
+            self.blocks[name].record(block,self.samples%self.window)
+
+    # Moves on to the next sample once all blocks have been recorded
+    def advance(self,cycle):
+        self.cycles[self.samples%self.window]=cycle
+        self.samples=self.samples+1
+
+    def __getitem__(self,block):
+        if block in self.live:
+            return self.live[block]
+        assert block in self.blocks, "Block "+block+" is not being probed"
+        return self.blocks[block]
+
+    # Unrolls a column of the ring buffer in chronological order
+    def unroll(self,column):
+        if self.samples<=self.window:
+            return column[:self.samples]
+        position=self.samples%self.window
+        return np.concatenate((column[position:],column[:position]))
+
+    def __contains__(self,block):
+        return block in self.blocks or block in self.live
+
+    def keys(self):
+        return list(self.blocks)+list(self.live)
+
 class emulatedHw():
 
+    # Pipeline register between two building blocks
+    # Each block owns a ring of preallocated registers that it writes in place and hands the register itself to the next
+    # block, so values are never copied between blocks. The ring is long enough for a register not to be overwritten
+    # before the next block consumes it. eof and bof flags are packed into the bits of an int (bit 0 is eof1/bof1).
+    class StageRegister():
+        def __init__(self,N,M,dtype=float):
+            self.v=np.zeros(N,dtype=dtype)
+            self.eof=0
+            self.bof=3
+            self.chainId=0
+            # Views of the first element, first M elements and remaining elements of the vector
+            self.first=self.v[:1]
+            self.head=self.v[:M]
+            self.tail=self.v[M:]
+            self.prefix={1:self.first,M:self.head,N:self.v}
+
+    # Register between the filter unit and the matrix vector reduce unit
+    # Besides the input vector, it holds the comparison of each element against the range limits (as 0s and 1s)
+    class FilterRegister(StageRegister):
+        def __init__(self,N,M,dtype=float):
+            super().__init__(N,M,dtype)
+            self.kind=FILTER_PASS
+            self.above=np.zeros((M+1,N),dtype=dtype)
+            self.mask=np.zeros((M,N),dtype=dtype)
+            self.above_rows=list(self.above)
+            self.mask_first=self.mask[0]
+
     # Input buffer class 
+    # Implemented as a circular queue of IB_DEPTH vectors. The two eof flags of each entry are packed into the bits of a byte.
     class InputBuffer():
-        def __init__(self,N,IB_DEPTH):
-            self.buffer=[]
+        def __init__(self,N,M,IB_DEPTH,fmt):
+            self.fmt=fmt
+            self.mem=np.zeros((IB_DEPTH,N),dtype=fmt.dtype)
+            self.rows=list(self.mem)
+            self.eof=bytearray(IB_DEPTH)
+            self.head=0
+            self.count=0
             self.N = N
             self.size=IB_DEPTH
             self.config=None
             self.chainId_out = 0
-            self.bof_out=[True,True]
+            self.bof_out=3
+            self.regs=[emulatedHw.StageRegister(N,M,fmt.dtype) for _ in range(2)]
+            self.phase=0
+            self.policy='assert'
+            self.interval=1
+            # Number of vectors dropped, cycles in which a producer was waiting for space, and pushes to a full buffer
+            self.dropped=0
+            self.stalled=0
+            self.overflows=0
+            # Number of producers currently waiting for space (see emulatedHw.push and emulatedHw.pushAsync)
+            self.blocked=0
+            # Cycle in which each entry was pushed, and performance counters (see emulatedHw.measure)
+            self.pushed_at=np.zeros(IB_DEPTH,dtype=np.int64)
+            self.cycle=0
+            self.stats=None
+
+        # Returns True if there is no space left in the input buffer
+        def full(self):
+            return self.count==self.size
+
+        # Makes room for a vector pushed to a full input buffer according to the overflow policy
+        # Returns False if the pushed vector is dropped instead. The RTL does not enqueue vectors while the buffer is full,
+        # which corresponds to 'drop_newest'. With 'sample', one of every `interval` vectors pushed while the buffer is full
+        # replaces the oldest vector, so bursts are subsampled instead of truncated.
+        def overflow(self):
+            assert self.policy not in ['assert','block'], "Input buffer overflowed"
+            self.overflows=self.overflows+1
+            self.dropped=self.dropped+1
+            if self.policy=='drop_newest' or (self.policy=='sample' and self.overflows%self.interval!=0):
+                return False
+            # The vector being dispatched stays in the buffer, so the one after it is dropped instead
+            if self.chainId_out!=0:
+                if self.count==1:
+                    return False
+                after=(self.head+1)%self.size
+                np.copyto(self.rows[after],self.rows[self.head])
+                self.eof[after]=self.eof[self.head]
+                self.pushed_at[after]=self.pushed_at[self.head]
+                self.head=after
+            else:
+                self.head=(self.head+1)%self.size
+            self.count=self.count-1
+            return True
 
         def push(self,pushed_vals):
             eof_in = [False,False]
@@ -28,25 +307,72 @@ class emulatedHw():
                 pushed_vals.append(False)
             v_in, eof_in[0], eof_in[1] = pushed_vals
             assert list(v_in.shape)==[self.N], "Input must be Nx1"
-            assert len(self.buffer)<=self.size, "Input buffer overflowed"
+            if self.count==self.size and not self.overflow():
+                return
             log.debug('Vector inserted into input buffer\n'+str(v_in))
-            self.buffer.append([v_in,eof_in])
+            tail=(self.head+self.count)%self.size
+            self.mem[tail]=self.fmt.encode(v_in) if self.fmt.exact else v_in
+            self.eof[tail]=int(eof_in[0]) | int(eof_in[1])<<1
+            self.pushed_at[tail]=self.cycle
+            self.count=self.count+1
+
+        # Pushes multiple vectors at once (eof1 and eof2 can be either a single flag or one flag per vector)
+        def push_many(self,vectors,eof1=False,eof2=False):
+            vectors=np.asarray(vectors)
+            num_vectors=len(vectors)
+            assert vectors.ndim==2 and vectors.shape[1]==self.N, "Input must be a batch of Nx1 vectors"
+            # Vectors that do not fit are handled one at a time by the overflow policy
+            if self.count+num_vectors>self.size:
+                eof1, eof2 = np.broadcast_to(eof1,(num_vectors,)), np.broadcast_to(eof2,(num_vectors,))
+                fits=self.size-self.count
+                self.push_many(vectors[:fits],eof1[:fits],eof2[:fits])
+                for v_in, e1, e2 in zip(vectors[fits:],eof1[fits:],eof2[fits:]):
+                    self.push([v_in,e1,e2])
+                return
+            log.debug('Inserting '+str(num_vectors)+' vectors into input buffer')
+            if self.fmt.exact:
+                vectors=self.fmt.encode(vectors)
+            eof=np.asarray(eof1,dtype=np.uint8) | np.asarray(eof2,dtype=np.uint8)<<1
+            eof=np.broadcast_to(eof,(num_vectors,)).tobytes()
+
+            # Copy vectors in at most two slices, since the queue may wrap around
+            tail=(self.head+self.count)%self.size
+            first=min(num_vectors,self.size-tail)
+            self.mem[tail:tail+first]=vectors[:first]
+            self.mem[:num_vectors-first]=vectors[first:]
+            self.eof[tail:tail+first]=eof[:first]
+            self.pushed_at[tail:tail+first]=self.cycle
+            self.pushed_at[:num_vectors-first]=self.cycle
+            self.eof[:num_vectors-first]=eof[first:]
+            self.count=self.count+num_vectors
+
+        # Returns True if there are vectors waiting to be processed
+        def valid(self):
+            return self.count>0
+
+        # Unpacks the eof flags of a given entry
+        def unpackEof(self,idx):
+            return [bool(self.eof[idx]&1),bool(self.eof[idx]&2)]
 
         def pop(self):
             log.debug("Removing element from input buffer")
-            assert len(self.buffer)>0, "Input buffer is empty"
-            self.bof_out=self.buffer[0][1]
-            return self.buffer.pop(0)
+            assert self.count>0, "Input buffer is empty"
+            self.bof_out=self.eof[self.head]
+            self.head=(self.head+1)%self.size
+            self.count=self.count-1
 
         def step(self):
+            if self.blocked and self.count==self.size:
+                self.stalled=self.stalled+1
+
             # Dispatch a new chain if the input buffer is not empty
             # Note that if our FW has 3 chains num_chains will be 4, since we need one "chain" (chainId 0) to work as a pass through
-            if len(self.buffer)>0:
+            if self.count>0:
                 if self.chainId_out<self.config.num_chains:
                     # Go to next element in the input buffer once we dispatched all chains for the previous element
                     if self.chainId_out==self.config.num_chains-1:
                         self.pop()
-                        self.chainId_out = 0 if len(self.buffer)==0 else 1 
+                        self.chainId_out = 0 if self.count==0 else 1 
                     else:
                         self.chainId_out=self.chainId_out+1
 
@@ -54,339 +380,863 @@ class emulatedHw():
             else:
                 self.chainId_out=0
 
-            if len(self.buffer)>0:
-                v_out, eof_out = self.buffer[0]
+            # Vectors are tracked from the moment their last chain is dispatched until it reaches the data packer
+            if self.stats is not None:
+                self.stats.occupancy[self.count]+=1
+                if self.count>0 and self.chainId_out==self.config.num_chains-1 and self.chainId_out!=0:
+                    self.stats.in_flight.append(int(self.pushed_at[self.head]))
+
+            reg=self.regs[self.phase]
+            self.phase=self.phase^1
+            if self.count>0:
+                np.copyto(reg.v,self.rows[self.head])
+                reg.eof=self.eof[self.head]
             else:
-                v_out, eof_out = np.zeros(self.N), False
-            return v_out, eof_out, self.bof_out, self.chainId_out
+                reg.v.fill(0)
+                reg.eof=0
+            reg.bof, reg.chainId = self.bof_out, self.chainId_out
+            return reg
 
     # Filter Unit
     class FilterUnit():
-        def __init__(self,N,M,FUVRF_SIZE):
-            self.v_in=np.zeros(N)
-            self.m_out=np.zeros((M,N))
-            self.eof_in = [False,False]
-            self.eof_out = [False,False]
-            self.bof_in = [True,True]
-            self.bof_out = [True,True]
-            self.chainId_in = 0
-            self.chainId_out = 0
+        def __init__(self,N,M,FUVRF_SIZE,fmt):
+            self.fmt=fmt
             self.vrf=np.zeros(FUVRF_SIZE*M)
             self.config=None
             self.M = M
             self.N = N
+            self.reg=emulatedHw.StageRegister(N,M,fmt.dtype)
+            self.regs=[emulatedHw.FilterRegister(N,M,fmt.dtype) for _ in range(2)]
+            self.phase=0
+            # Scratchpad used to compare the input vector against all range limits at once
+            self.tiled=np.zeros((M+1,N),dtype=fmt.dtype)
+            self.tiled_M=self.tiled[:M]
+            self.above=np.zeros((M+1,N),dtype=bool)
+            self.above_low=np.zeros((M,N),dtype=bool)
+            self.mask=np.zeros((M,N),dtype=bool)
+
+        # The ranges of each FUVRF address are only computed once every time the FUVRF is written
+        # Note that the FUVRF must be assigned (instead of modified in place) for new values to take effect
+        @property
+        def vrf(self):
+            return self._vrf
+
+        @vrf.setter
+        def vrf(self,vals):
+            self._vrf=self.fmt.encode(vals)
+            self.bin_edges={}
+
+        # Returns the M (low,high] ranges stored at a given FUVRF address
+        def ranges(self,addr):
+            low = self.vrf[addr*self.M:addr*self.M+self.M]
+            high = np.empty(self.M,dtype=low.dtype)
+            high[:-1] = low[1:]
+            # The RTL assumes the last range of an address is as wide as the first one (or 1 LSB wide if M is 1)
+            if self.fmt.exact:
+                high[-1] = low[-1]+1 if self.M==1 else low[-1]+low[1]-low[0]
+                self.fmt.wrap(high)
+            elif addr*self.M+self.M<len(self.vrf):
+                high[-1] = self.vrf[addr*self.M+self.M]
+            else:
+                high[-1] = low[-1]+(low[-1]-self.vrf[addr*self.M+self.M-2])
+            return low, high
+
+        # Returns the ranges of a given FUVRF address and whether their limits are sorted
+        def binEdges(self,addr):
+            if addr not in self.bin_edges:
+                low, high = self.ranges(addr)
+                edges = np.append(low,high[-1])
+                tile = lambda x: np.repeat(x[:,None],self.N,axis=1)
+                self.bin_edges[addr] = struct(low=low,high=high,edges=edges,sorted=bool(np.all(edges[1:]>=edges[:-1])),
+                                              low_tiled=tile(low),high_tiled=tile(high),edges_tiled=tile(edges))
+            return self.bin_edges[addr]
+
+        # Bins every element of a vector (or of a batch of vectors) into the M ranges of a given FUVRF address
+        # Consecutive ranges share their limits, so if the limits are sorted a binary search finds the range of each element
+        # Otherwise ranges may overlap and each element is compared against all ranges at once
+        def bin(self,addr,v):
+            e = self.binEdges(addr)
+            if e.sorted:
+                return FILTER_BINS, np.searchsorted(e.edges,v,side='left')-1
+            v = v[...,None,:]
+            return FILTER_MASK, ((v>e.low[:,None]) & (v<=e.high[:,None])).astype(np.uint8)
+
+        # Bins a single vector into a filter register without allocating memory
+        # If the limits are sorted, comparing each element against the M+1 limits is enough to find its range
+        # The vector is tiled beforehand since broadcasting inside a comparison allocates temporary buffers
+        def binInto(self,addr,v,reg):
+            e = self.binEdges(addr)
+            np.copyto(self.tiled,v)
+            if e.sorted:
+                reg.kind=FILTER_EDGES
+                np.less(e.edges_tiled,self.tiled,out=self.above)
+                np.copyto(reg.above,self.above)
+            else:
+                reg.kind=FILTER_MASK
+                np.greater(self.tiled_M,e.low_tiled,out=self.above_low)
+                np.less_equal(self.tiled_M,e.high_tiled,out=self.mask)
+                np.logical_and(self.mask,self.above_low,out=self.mask)
+                np.copyto(reg.mask,self.mask)
 
-        def step(self,input_value):
+        # Returns True if the input register holds a chain that still has to be processed
+        def valid(self):
+            return self.reg.chainId!=0
+
+        def step(self,reg_in):
             # Check if the vector is within M ranges
-            cfg=self.config[self.chainId_in]
-            log.debug('Filter input:'+str(self.v_in))
-            log.debug('Filtering using the following ranges:'+str(self.vrf[cfg.addr*self.M:cfg.addr*self.M+self.M+1]))
-            if cfg.filter==1:
-                for i in range(self.M):
-                    low_range = self.vrf[cfg.addr*self.M+i]
-                    if cfg.addr*self.M+i+1<len(self.vrf):
-                        high_range = self.vrf[cfg.addr*self.M+i+1]
-                    else:
-                        high_range = low_range+(low_range-self.vrf[cfg.addr*self.M+i-1])
-                    within_range = np.all([self.v_in>low_range, self.v_in<=high_range],axis=0)
-                    self.m_out[i]=within_range[:]
+            reg_out=self.regs[self.phase]
+            self.phase=self.phase^1
+            chainId=self.reg.chainId
+            log.debug('Filter input: %s',self.reg.v)
+            if self.config.filter[chainId]==1:
+                addr=self.config.addr[chainId]
+                log.debug('Filtering using the following ranges: %s',self.binEdges(addr).edges)
+                self.binInto(addr,self.reg.v,reg_out)
             # If we are not filtering, just pass the value through 
             else:
-                for i in range(self.M):
-                    self.m_out[i] = self.v_in if i==0 else np.zeros(self.N)
+                reg_out.kind=FILTER_PASS
+                np.copyto(reg_out.v,self.reg.v)
 
-            self.eof_out, self.bof_out, self.chainId_out = self.eof_in, self.bof_in, self.chainId_in
-            self.v_in, self.eof_in, self.bof_in, self.chainId_in = copy(input_value)
-            return self.m_out, self.eof_out, self.bof_out, self.chainId_out
+            reg_out.eof, reg_out.bof, reg_out.chainId = self.reg.eof, self.reg.bof, self.reg.chainId
+            self.reg=reg_in
+            return reg_out
 
     # This block will reduce the matrix along a given axis
     # If M<N, then the results will be padded with zeros
     class MatrixVectorReduce():
-        def __init__(self,N,M):
-            self.m_in=np.zeros((M,N))
-            self.v_out=np.zeros(N)
-            self.eof_in = [False,False]
-            self.eof_out = [False,False]
-            self.bof_in = [True,True]
-            self.bof_out = [True,True]
-            self.chainId_in = 0
-            self.chainId_out = 0
+        def __init__(self,N,M,fmt):
+            self.fmt=fmt
             self.config=None
             self.N = N
             self.M = M
+            self.reg=emulatedHw.FilterRegister(N,M,fmt.dtype)
+            self.regs=[emulatedHw.StageRegister(N,M,fmt.dtype) for _ in range(2)]
+            self.phase=0
+            self.ones_M=np.ones(M,dtype=fmt.dtype)
+            self.ones_N=np.ones(N,dtype=fmt.dtype)
+            self.above_count=np.zeros(M+1,dtype=fmt.dtype)
+            self.above_low=self.above_count[:-1]
+            self.above_high=self.above_count[1:]
+
+        def valid(self):
+            return self.reg.chainId!=0
+
+        # Reduces the results of the filter unit for a vector (or for a batch of vectors) along a given axis
+        # The matrix reduced is never built: the first row, sum along M (axis=1) or sum along N (axis=2) are computed directly
+        def reduce(self,m_in,axis):
+            kind, data = m_in
+            dtype = self.fmt.dtype
+            if kind==FILTER_PASS:
+                if axis!=2:
+                    return data
+                v_out=np.zeros(data.shape,dtype=dtype)
+                v_out[...,0]=np.sum(data,axis=-1)
+                return self.fmt.wrap(v_out)
+            elif kind==FILTER_BINS:
+                within_range=(data>=0) & (data<self.M)
+                if axis==0:
+                    v_out=(data==0).astype(dtype)
+                elif axis==1:
+                    v_out=within_range.astype(dtype)
+                else:
+                    v_out=np.zeros(data.shape,dtype=dtype)
+                    bins=data.reshape(-1,self.N)
+                    rows=np.arange(len(bins))[:,None]*self.M+bins
+                    counts=np.bincount(rows[within_range.reshape(-1,self.N)],minlength=len(bins)*self.M)
+                    v_out.reshape(-1,self.N)[:,:self.M]=counts.reshape(-1,self.M)
+            else:
+                if axis==0:
+                    v_out=data[...,0,:].astype(dtype)
+                elif axis==1:
+                    v_out=np.sum(data,axis=-2,dtype=dtype)
+                else:
+                    v_out=np.zeros(data.shape[:-2]+(self.N,),dtype=dtype)
+                    v_out[...,:self.M]=np.sum(data,axis=-1)
+            return self.fmt.count(v_out)
 
-        def step(self,input_value):
+        # Reduces a filter register into a stage register without allocating memory
+        # An element is within range j if it is above limit j but not above limit j+1
+        def reduceInto(self,m,axis,reg):
+            if m.kind==FILTER_PASS:
+                if axis!=2:
+                    np.copyto(reg.v,m.v)
+                else:
+                    reg.v.fill(0)
+                    np.sum(m.v,keepdims=True,out=reg.first)
+                    self.fmt.wrap(reg.first)
+                return
+            elif m.kind==FILTER_EDGES:
+                if axis==0:
+                    np.subtract(m.above_rows[0],m.above_rows[1],out=reg.v)
+                elif axis==1:
+                    np.subtract(m.above_rows[0],m.above_rows[self.M],out=reg.v)
+                else:
+                    np.matmul(m.above,self.ones_N,out=self.above_count)
+                    np.subtract(self.above_low,self.above_high,out=reg.head)
+                    reg.tail.fill(0)
+            else:
+                if axis==0:
+                    np.copyto(reg.v,m.mask_first)
+                elif axis==1:
+                    np.matmul(self.ones_M,m.mask,out=reg.v)
+                else:
+                    np.matmul(m.mask,self.ones_N,out=reg.head)
+                    reg.tail.fill(0)
+            self.fmt.count(reg.v)
+
+        def step(self,reg_in):
             # Reduce matrix along a given axis
-            cfg=self.config[self.chainId_in]
-            if cfg.axis==0:
-                log.debug('Passing first vector through reduce unit')
-                self.v_out=self.m_in[0]
-            elif cfg.axis==1:
-                log.debug('Reducing matrix along N axis (axis = '+str(cfg.axis)+')')
-                self.v_out=np.sum(self.m_in,axis=0)
-            elif cfg.axis==2:
-                log.debug('Reducing matrix along M axis (axis = '+str(cfg.axis)+')')
-                self.v_out=np.sum(self.m_in,axis=1)
-                if self.N!=self.M:
-                    log.debug('Padding results with '+str(self.N-self.M)+' zeros')
-                    self.v_out=np.concatenate((self.v_out,np.zeros(self.N-self.M)))
-
-            self.eof_out, self.bof_out, self.chainId_out    = self.eof_in, self.bof_in, self.chainId_in
-            self.m_in, self.eof_in, self.bof_in, self.chainId_in = copy(input_value)
-            return self.v_out, self.eof_out, self.bof_out, self.chainId_out
+            reg_out=self.regs[self.phase]
+            self.phase=self.phase^1
+            axis=self.config.axis[self.reg.chainId]
+            log.debug('Reducing filter results along axis %d',axis)
+            self.reduceInto(self.reg,axis,reg_out)
+
+            reg_out.eof, reg_out.bof, reg_out.chainId = self.reg.eof, self.reg.bof, self.reg.chainId
+            self.reg=reg_in
+            return reg_out
 
     # This block will reduce a vector to a scalar and pad with zeros
     class VectorScalarReduce():
-        def __init__(self,N):
-            self.v_in=np.zeros(N)
-            self.v_out=np.zeros(N)
-            self.eof_in = [False,False]
-            self.eof_out = [False,False]
-            self.bof_in = [True,True]
-            self.bof_out = [True,True]
-            self.chainId_in = 0
-            self.chainId_out = 0
+        def __init__(self,N,M,fmt):
+            self.fmt=fmt
             self.config=None
             self.N = N
+            self.reg=emulatedHw.StageRegister(N,M,fmt.dtype)
+            self.regs=[emulatedHw.StageRegister(N,M,fmt.dtype) for _ in range(2)]
+            self.phase=0
+
+        def valid(self):
+            return self.reg.chainId!=0
 
-        def step(self,input_value):
+        def step(self,reg_in):
             # Reduce matrix along a given axis
-            cfg=self.config[self.chainId_in]
+            reg_out=self.regs[self.phase]
+            self.phase=self.phase^1
+            op=self.config.op[self.reg.chainId]
             
-            if cfg.op==0:
+            if op==0:
                 log.debug('Passing first vector through vs reduce unit')
-                self.v_out=self.v_in
-            elif cfg.op==1:
+                np.copyto(reg_out.v,self.reg.v)
+            elif op==1:
                 log.debug('Sum vector scalar reduce')
-                self.v_out=np.concatenate(([np.sum(self.v_in)],np.zeros(self.N-1))) 
+                reg_out.v.fill(0)
+                np.sum(self.reg.v,keepdims=True,out=reg_out.first)
+                self.fmt.wrap(reg_out.first)
               
-            self.eof_out, self.bof_out, self.chainId_out = self.eof_in, self.bof_in, self.chainId_in
-            self.v_in, self.eof_in, self.bof_in, self.chainId_in = copy(input_value)
-            return self.v_out, self.eof_out, self.bof_out, self.chainId_out
+            reg_out.eof, reg_out.bof, reg_out.chainId = self.reg.eof, self.reg.bof, self.reg.chainId
+            self.reg=reg_in
+            return reg_out
 
     # This block will reduce the matrix along a given axis
     class VectorVectorALU():
-        def __init__(self,N,VVVRF_SIZE):
-            self.v_in=np.zeros(N)
-            self.v_out=np.zeros(N)
-            self.eof_in = [False,False]
-            self.eof_out = [False,False]
-            self.bof_in = [False,False]
-            self.bof_out = [False,False]
-            self.chainId_in = 0
-            self.chainId_out = 0
+        def __init__(self,N,M,VVVRF_SIZE,fmt):
+            self.fmt=fmt
+            self.N = N
             self.vrf=np.zeros(N*VVVRF_SIZE)
             self.config=None
-            self.v_out_d1=np.zeros(N)
-            self.v_out_d2=np.zeros(N)
-            self.eof_out_d1 = [False,False]
-            self.eof_out_d2 = [False,False]
-            self.bof_out_d1 = [True,True]
-            self.bof_out_d2 = [True,True]
-            self.chainId_out_d2 = 0
-            self.chainId_out_d1 = 0
-            self.N = N
-            self.minicache = np.zeros(N)
+            self.minicache = np.zeros(N,dtype=fmt.dtype)
+            self.reg=emulatedHw.StageRegister(N,M,fmt.dtype)
+            # Results take two extra cycles to leave the ALU, so it needs a ring of 4 registers
+            self.regs=[emulatedHw.StageRegister(N,M,fmt.dtype) for _ in range(4)]
+            self.phase=0
+
+        # The VVVRF is kept as a flat array, but each address is also accessible as a view
+        @property
+        def vrf(self):
+            return self._vrf
 
-        def step(self,input_value):
+        @vrf.setter
+        def vrf(self,vals):
+            self._vrf=self.fmt.encode(vals)
+            self.vrf_rows=[self._vrf[addr*self.N:addr*self.N+self.N] for addr in range(len(self._vrf)//self.N)]
+
+        # The ALU also holds chains in its two delay slots
+        def valid(self):
+            return self.reg.chainId!=0 or self.regs[self.phase].chainId!=0 or self.regs[self.phase-1].chainId!=0
+
+        def step(self,reg_in):
             # Delay for 2 cycles, so this FU takes 3 cycles (read, calculate, write)
-            self.v_out    = self.v_out_d2
-            self.v_out_d2 = self.v_out_d1
-            self.eof_out  = self.eof_out_d2
-            self.eof_out_d2  = self.eof_out_d1
-            self.eof_out_d1  = self.eof_in
-            self.bof_out  = self.bof_out_d2
-            self.bof_out_d2  = self.bof_out_d1
-            self.bof_out_d1  = self.bof_in
-            self.chainId_out  = self.chainId_out_d2
-            self.chainId_out_d2  = self.chainId_out_d1
-            self.chainId_out_d1  = self.chainId_in
-            cfg=self.config[self.chainId_in]
-            condition_met = ((not cfg.cond1['last']     or (cfg.cond1['last']     and     self.eof_in[0])) and
-                    		 (not cfg.cond1['notlast']  or (cfg.cond1['notlast']  and not self.eof_in[0])) and
-                    		 (not cfg.cond1['first']    or (cfg.cond1['first']    and     self.bof_in[0])) and
-                    		 (not cfg.cond1['notfirst'] or (cfg.cond1['notfirst'] and not self.bof_in[0])) and
-                             (not cfg.cond2['last']     or (cfg.cond2['last']     and     self.eof_in[1])) and
-                             (not cfg.cond2['notlast']  or (cfg.cond2['notlast']  and not self.eof_in[1])) and
-                             (not cfg.cond2['first']    or (cfg.cond2['first']    and     self.bof_in[1])) and
-                             (not cfg.cond2['notfirst'] or (cfg.cond2['notfirst'] and not self.bof_in[1])))
+            self.phase=(self.phase+1)%4
+            reg_out=self.regs[self.phase-2]
+            reg=self.regs[self.phase]
+            cfg, chainId = self.config, self.reg.chainId
+            eof, bof = self.reg.eof, self.reg.bof
+            fails = CONDITION_FAILS[eof|bof<<2]
+            op, minicache = cfg.op[chainId], cfg.minicache[chainId]
 
             # Checking if we should use minicache or input vector as operator
-            if cfg.minicache == 1 or cfg.minicache==3:
+            if minicache == 1 or minicache==3:
                 operator = self.minicache
             else:
-                operator = self.v_in
+                operator = self.reg.v
 
-            if cfg.op==0 or not condition_met:
+            operand = self.vrf_rows[cfg.addr[chainId]]
+            if op==0 or cfg.cond[chainId]&fails:
                 log.debug('ALU is passing values through')
-                self.v_out_d1 = operator
-            elif cfg.op==1:
-                log.debug('Adding using vector-vector ALU')
-                self.v_out_d1 = operator + self.vrf[cfg.addr*self.N:cfg.addr*self.N+self.N]
-            elif cfg.op==2:
-                log.debug('Multiplying using vector-vector ALU')
-                self.v_out_d1 = operator * self.vrf[cfg.addr*self.N:cfg.addr*self.N+self.N]
-            elif cfg.op==3:
-                log.debug('Subtracting using vector-vector ALU')
-                self.v_out_d1 = operator - self.vrf[cfg.addr*self.N:cfg.addr*self.N+self.N]
-            elif cfg.op==4:
-                log.debug('Subtracting using vector-vector ALU')
-                self.v_out_d1 = np.maximum(operator, self.vrf[cfg.addr*self.N:cfg.addr*self.N+self.N])
-
-            cache_condition_met = ((not cfg.cache_cond1['last']     or (cfg.cache_cond1['last']     and     self.eof_in[0])) and
-                             (not cfg.cache_cond1['notlast']  or (cfg.cache_cond1['notlast']  and not self.eof_in[0])) and
-                             (not cfg.cache_cond1['first']    or (cfg.cache_cond1['first']    and     self.bof_in[0])) and
-                             (not cfg.cache_cond1['notfirst'] or (cfg.cache_cond1['notfirst'] and not self.bof_in[0])) and
-                             (not cfg.cache_cond2['last']     or (cfg.cache_cond2['last']     and     self.eof_in[1])) and
-                             (not cfg.cache_cond2['notlast']  or (cfg.cache_cond2['notlast']  and not self.eof_in[1])) and
-                             (not cfg.cache_cond2['first']    or (cfg.cache_cond2['first']    and     self.bof_in[1])) and
-                             (not cfg.cache_cond2['notfirst'] or (cfg.cache_cond2['notfirst'] and not self.bof_in[1])))
-            if cfg.cache & cache_condition_met:
-                self.vrf[cfg.cache_addr*self.N:cfg.cache_addr*self.N+self.N] = self.v_out_d1 
-            if cfg.minicache==2 or cfg.minicache==3:
-                self.minicache = copy(self.v_out_d1) 
-            
-            self.v_in, self.eof_in, self.bof_in, self.chainId_in = copy(input_value)
-            return self.v_out, self.eof_out, self.bof_out, self.chainId_out
+                np.copyto(reg.v,operator)
+            else:
+                log.debug('Applying op %d using vector-vector ALU',op)
+                self.fmt.alu(op,operator,operand,out=reg.v)
+
+            if cfg.cache[chainId] and not cfg.cache_cond[chainId]&fails:
+                np.copyto(self.vrf_rows[cfg.cache_addr[chainId]],reg.v)
+            if minicache==2 or minicache==3:
+                np.copyto(self.minicache,reg.v)
+
+            reg.eof, reg.bof, reg.chainId = eof, bof, chainId
+            self.reg=reg_in
+            return reg_out
 
     # Packs data efficiently
+    # Values are packed in place into a vector of N elements, which is pushed to the trace buffer once it is full
     class DataPacker():
-        def __init__(self,N,M):
-            self.v_in=np.zeros(N)
-            self.v_out=np.zeros(N)
-            self.eof_in = [False,False]
-            self.bof_in = [True,True]
-            self.chainId_in = 0
+        def __init__(self,N,M,fmt):
+            self.packed=np.zeros(N,dtype=fmt.dtype)
+            # Views of the packed vector where each commit size can be written
+            self.packed_views={(offset,size): self.packed[offset:offset+size] for size in {1,M,N} for offset in range(N-size+1)}
             self.v_out_valid=0
             self.v_out_size=0
             self.config=None
             self.N = N
+            self.reg=emulatedHw.StageRegister(N,M,fmt.dtype)
+            self.stats=None
 
-        def step(self,input_value):
-            cfg=self.config[self.chainId_in]
-            if (cfg.commit and 
-                (not cfg.cond1['last']     or (cfg.cond1['last']     and     self.eof_in[0])) and
-                (not cfg.cond1['notlast']  or (cfg.cond1['notlast']  and not self.eof_in[0])) and
-                (not cfg.cond1['first']    or (cfg.cond1['first']    and     self.bof_in[0])) and
-                (not cfg.cond1['notfirst'] or (cfg.cond1['notfirst'] and not self.bof_in[0])) and
-                (not cfg.cond2['last']     or (cfg.cond2['last']     and     self.eof_in[1])) and
-                (not cfg.cond2['notlast']  or (cfg.cond2['notlast']  and not self.eof_in[1])) and
-                (not cfg.cond2['first']    or (cfg.cond2['first']    and     self.bof_in[1])) and
-                (not cfg.cond2['notfirst'] or (cfg.cond2['notfirst'] and not self.bof_in[1]))):
-                if self.v_out_size==0:
-                    self.v_out = self.v_in[:cfg.size]
-                else:
-                    self.v_out = np.append(self.v_out,self.v_in[:cfg.size])
-                self.v_out_size=self.v_out_size+cfg.size
+        # Values packed so far (or the last vector pushed to the trace buffer if no values are waiting)
+        @property
+        def v_out(self):
+            return self.packed[:self.v_out_size] if 0<self.v_out_size<self.N else self.packed
+
+        def valid(self):
+            return self.reg.chainId!=0
+
+        def step(self,reg_in):
+            chainId=self.reg.chainId
+            size=self.config.size[chainId]
+            self.v_out_valid=0
+            if size and not self.config.cond[chainId]&CONDITION_FAILS[self.reg.eof|self.reg.bof<<2]:
+                # A commit that does not fit leaves the data packer stuck, so its values are not stored
+                if self.v_out_size+size<=self.N:
+                    np.copyto(self.packed_views[self.v_out_size,size],self.reg.prefix[size])
+                self.v_out_size=self.v_out_size+size
                 if self.v_out_size==self.N:
                     log.debug('Data Packer full. Pushing values to Trace Buffer')
                     self.v_out_valid=1
                     self.v_out_size = 0
-                else:
-                    self.v_out_valid=0
-            else:
-                self.v_out_valid=0
-            self.v_in, self.eof_in, self.bof_in, self.chainId_in = copy(input_value)
-            return self.v_out, self.v_out_valid
+            # The last chain of a vector reaching the data packer means that all its values were committed
+            if self.stats is not None and chainId!=0 and chainId==len(self.config.size)-1:
+                self.stats.latency.append(self.stats.cycle-self.stats.in_flight.popleft())
+            self.reg=reg_in
 
     # Packs data efficiently
     class TraceBuffer():
-        def __init__(self,N,TB_SIZE):
-            self.input=np.zeros(N)
-            self.mem=np.zeros((TB_SIZE,N))
+        def __init__(self,N,TB_SIZE,fmt):
+            self.mem=np.zeros((TB_SIZE,N),dtype=fmt.dtype)
+            self.rows=list(self.mem)
             self.size=0
             self.TB_SIZE=TB_SIZE
 
-        def step(self,packed_data):
-            output, output_valid = packed_data
-            if output_valid:
+        def step(self,dp):
+            if dp.v_out_valid:
                 if self.size==self.TB_SIZE:
                     self.size=0
-                self.mem[self.size]=output
+                np.copyto(self.rows[self.size],dp.packed)
                 self.size=self.size+1
-            self.input=copy(packed_data)
 
     def step(self):
         log.debug('New step')
+        self.cycle=self.cycle+1
+        if self.ib.stats is not None:
+            self.ib.stats.cycle=self.cycle
 
         # Perform operations according to how building blocks are connected
+        # Blocks hand their output registers to the next block, so probes copy them as they go
+        sampled = self.log.sampling(self.cycle)
         for b in self.BUILDING_BLOCKS:
             if b=='InputBuffer':
-                chain = self.ib.step()
-                self.log['ib'].append(chain)
+                reg = self.ib.step()
+                if sampled:
+                    self.log.record('ib',reg)
             elif b=='FilterReduceUnit':
-                chain = self.fu.step(chain)
-                self.log['fu'].append(chain)
-                chain = self.mvru.step(chain)
-                self.log['mvru'].append(chain)
+                reg = self.fu.step(reg)
+                if sampled:
+                    self.log.record('fu',reg)
+                reg = self.mvru.step(reg)
+                if sampled:
+                    self.log.record('mvru',reg)
             elif b=='VectorVectorALU':
-                chain = self.vvalu.step(chain)
-                self.log['vvalu'].append(chain)
+                reg = self.vvalu.step(reg)
+                if sampled:
+                    self.log.record('vvalu',reg)
             elif b=='VectorScalarReduce':
-                chain = self.vsru.step(chain)
-                self.log['vsru'].append(chain)
+                reg = self.vsru.step(reg)
+                if sampled:
+                    self.log.record('vsru',reg)
             elif b=='DataPacker':
-                packed_data = self.dp.step(chain)
-                self.log['dp'].append(packed_data)
+                self.dp.step(reg)
+                if sampled:
+                    self.log.record('dp',self.dp)
             elif b=='TraceBuffer':
-                self.tb.step(packed_data)
-                self.log['tb'].append(self.tb.mem)
+                self.tb.step(self.dp)
+                if sampled:
+                    self.log.record('tb',self.tb)
             else:
                 assert False, "Unknown building block "+b
-        
+        if sampled:
+            self.log.advance(self.cycle)
+
+    # Selects which values are logged while stepping through the circuit (this also clears the log)
+    # blocks and fields default to all of them. Only the last `window` samples are kept, with one sample every `interval` cycles
+    # Until probe is called, nothing is logged and the log reads the current trace buffer when it is accessed
+    def probe(self,blocks=None,fields=None,window=1024,interval=1):
+        available = self.probes()
+        blocks = list(available) if blocks is None else blocks
+        for b in blocks:
+            assert b in available, "Unknown probe "+b
+        if fields is not None:
+            for f in fields:
+                assert any(f in available[b] for b in blocks), "Unknown field "+f
+        probed = {b: {f: spec for f, spec in available[b].items() if fields is None or f in fields} for b in blocks}
+        self.log = probeLog({b: f for b, f in probed.items() if f},window,interval)
+
+    # Fields that can be probed in each block, as (attribute, shape, dtype)
+    def probes(self):
+        N, M, dtype = self.N, self.M, self.fmt.dtype
+        stage = {'v':('v',(N,),dtype),'eof':('eof',(),np.uint8),'bof':('bof',(),np.uint8),'chainId':('chainId',(),int)}
+        available = {'ib':    stage,
+                     'fu':    {**stage,'kind':('kind',(),np.uint8),'above':('above',(M+1,N),dtype),'mask':('mask',(M,N),dtype)},
+                     'mvru':  stage,
+                     'vvalu': stage,
+                     'vsru':  stage,
+                     'dp':    {'v':('packed',(N,),dtype),'valid':('v_out_valid',(),np.uint8),'size':('v_out_size',(),int)},
+                     'tb':    {'mem':('mem',(self.tb.TB_SIZE,N),dtype),'size':('size',(),int)}}
+        return available
+
+    # Selects what happens when values are pushed to a full input buffer
+    #   'assert': fail (default)
+    #   'block': the producer waits while the processor keeps stepping (counted in ib.stalled)
+    #   'drop_newest', 'drop_oldest' and 'sample': vectors are dropped (counted in ib.dropped), see InputBuffer.overflow
+    def overflowPolicy(self,policy,interval=2):
+        assert policy in ['assert','block','drop_newest','drop_oldest','sample'], "Unknown overflow policy "+policy
+        assert interval>0, "Sampling interval must be positive"
+        self.ib.policy, self.ib.interval = policy, interval
+        self.ib.dropped, self.ib.stalled, self.ib.overflows = 0, 0, 0
+
+    # Steps through the circuit until there is space in the input buffer, as a blocked producer would wait for it
+    def waitForSpace(self):
+        self.ib.blocked=self.ib.blocked+1
+        while self.ib.full():
+            self.step()
+        self.ib.blocked=self.ib.blocked-1
 
     # Pushes values to the input of the chain
     def push(self,pushed_vals):
+        if self.ib.policy=='block':
+            self.waitForSpace()
+        self.ib.cycle=self.cycle
+        self.ib.push(pushed_vals)
+
+    # Pushes a batch of vectors to the input of the chain at once
+    def push_many(self,vectors,eof1=False,eof2=False):
+        self.ib.cycle=self.cycle
+        if self.ib.policy=='block':
+            vectors=np.asarray(vectors)
+            eof1, eof2 = np.broadcast_to(eof1,(len(vectors),)), np.broadcast_to(eof2,(len(vectors),))
+            while len(vectors)>0:
+                self.waitForSpace()
+                self.ib.cycle=self.cycle
+                fits=self.ib.size-self.ib.count
+                self.ib.push_many(vectors[:fits],eof1[:fits],eof2[:fits])
+                vectors, eof1, eof2 = vectors[fits:], eof1[fits:], eof2[fits:]
+        else:
+            self.ib.push_many(vectors,eof1,eof2)
+
+    # Pushes values to the input of the chain from a coroutine
+    # With the 'block' policy, it resolves once the buffer drains enough to take the values, which requires another
+    # coroutine to step the processor (see runAsync)
+    async def pushAsync(self,pushed_vals):
+        if self.ib.policy=='block':
+            self.ib.blocked=self.ib.blocked+1
+            while self.ib.full():
+                await asyncio.sleep(0)
+            self.ib.blocked=self.ib.blocked-1
+        self.ib.cycle=self.cycle
         self.ib.push(pushed_vals)
 
+    # Streams tensors to the input of the chain (see misc.tensorStream), stepping whenever the input buffer is full
+    def pushTensors(self,tensors,batched=True):
+        for pushed_vals in tensorStream(tensors,self.N,batched):
+            if self.ib.policy=='assert':
+                while self.ib.full():
+                    self.step()
+            self.push(pushed_vals)
+
     def config(self,fw=None):
         # Configure processor
-        # Fixme - For some reason I need to append a chain of zeros here
-        no_cond={'last':False,'notlast':False,'first':False,'notfirst':False}
-        self.fu.config=[struct(filter=0,addr=0)]
-        self.mvru.config=[struct(axis=0)]
-        self.vsru.config=[struct(op=0)]
-        self.vvalu.config=[struct(op=0,addr=0,cache=0,cache_addr=0,cond1=copy(no_cond),cond2=copy(no_cond),minicache=0,cache_cond1=copy(no_cond),cache_cond2=copy(no_cond))]
-        self.dp.config=[struct(commit=0,size=0,cond1=copy(no_cond),cond2=copy(no_cond))]
-        self.ib.config=struct(num_chains=1)
-        if fw is not None:
-            self.ib.config=struct(num_chains=fw['valid_chains']+1)
-            for idx in range(fw['valid_chains']):
-                self.fu.config.append(fw['fu'][idx])
-                self.mvru.config.append(fw['mvru'][idx])
-                self.vsru.config.append(fw['vsru'][idx])
-                self.vvalu.config.append(fw['vvalu'][idx])
-                self.dp.config.append(fw['dp'][idx])
+        tables=lowerFirmware(fw)
+        self.ib.config=struct(num_chains=tables.num_chains)
+        self.fu.config=tables.fu
+        self.mvru.config=tables.mvru
+        self.vsru.config=tables.vsru
+        self.vvalu.config=tables.vvalu
+        self.dp.config=tables.dp
 
     def initialize_fu(vals):
         self.fu.vrf=vals
 
+    # Starts collecting performance counters (this clears them)
+    # Vectors are matched with their results in order, so no chain may be in the pipeline when counters are started
+    def measure(self):
+        assert not (self.fu.valid() or self.mvru.valid() or self.vvalu.valid() or self.vsru.valid() or self.dp.valid()), "Performance counters must be started while the pipeline is empty"
+        self.ib.stats=self.dp.stats=struct(start=self.cycle,cycle=self.cycle,occupancy=np.zeros(self.ib.size+1,dtype=np.int64),
+                                            in_flight=deque(),latency=[],dropped=self.ib.dropped,stalled=self.ib.stalled)
+
+    # Returns the performance measured since measure() was called
+    #   vectors_per_cycle: vectors fully processed per cycle (at most 1/cycles_per_vector, the dispatch rate of the firmware)
+    #   latency: percentiles of the number of cycles from pushing a vector until its last chain reaches the data packer
+    #   ib_occupancy: number of cycles in which the input buffer held 0, 1, ..., IB_DEPTH vectors
+    #   stalled and dropped: cycles in which a producer was blocked and vectors dropped by the overflow policy
+    def report(self):
+        stats=self.ib.stats
+        assert stats is not None, "Performance counters are not enabled (see measure)"
+        cycles=self.cycle-stats.start
+        latency=np.array(stats.latency)
+        percentiles=[float(x) for x in np.percentile(latency,[0,50,90,99,100])] if len(latency) else 5*[float('nan')]
+        return struct(cycles=cycles,
+                      vectors=len(latency),
+                      vectors_per_cycle=len(latency)/cycles if cycles else 0.0,
+                      cycles_per_vector=max(1,self.ib.config.num_chains-1),
+                      latency=struct(**dict(zip(['min','p50','p90','p99','max'],percentiles))),
+                      ib_occupancy=stats.occupancy.copy(),
+                      stalled=self.ib.stalled-stats.stalled,
+                      dropped=self.ib.dropped-stats.dropped)
+
+    # Pushes each vector at a given cycle (relative to the current one) and runs until all of them are processed
+    # Returns the performance report of the schedule
+    def runSchedule(self,vectors,push_cycles,eof1=False,eof2=False):
+        vectors=np.asarray(vectors)
+        eof1, eof2 = np.broadcast_to(eof1,(len(vectors),)), np.broadcast_to(eof2,(len(vectors),))
+        start=self.cycle
+        self.measure()
+        for v_in, push_cycle, e1, e2 in zip(vectors,push_cycles,eof1,eof2):
+            if start+push_cycle>self.cycle:
+                self.run(steps=start+push_cycle-self.cycle)
+            self.push([v_in,bool(e1),bool(e2)])
+        self.run(steps=None)
+        return self.report()
+
+    # Returns True if two firmware commit the same values and leave the same state in the VVVRF and minicache for an input stream
+    # Both run on copies of this processor (with its current VRFs), so this can be used to check that an optimized firmware
+    # is equivalent to the unoptimized one (see compiler.optimizeChains)
+    def equivalent(self,fw_a,fw_b,vectors,eof1=False,eof2=False):
+        vectors=np.asarray(vectors).reshape(-1,self.N)
+        procs=[]
+        for fw in [fw_a,fw_b]:
+            # The trace buffer is sized so that it never wraps around
+            N, M, IB_DEPTH, FUVRF_SIZE, VVVRF_SIZE, TB_SIZE, MAX_CHAINS, BUILDING_BLOCKS, DATA_TYPE, DATA_WIDTH = self.arch
+            TB_SIZE=max(1,math.ceil(len(vectors)*sum(lowerFirmware(fw).dp.size)/N))
+            proc=emulatedHw(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DATA_WIDTH)
+            proc.fu.vrf=self.fmt.decode(self.fu.vrf)
+            proc.vvalu.vrf=self.fmt.decode(self.vvalu.vrf)
+            proc.vvalu.minicache[:]=self.vvalu.minicache
+            proc.config(fw)
+            proc.overflowPolicy('block')
+            proc.push_many(vectors,eof1,eof2)
+            proc.run(steps=None)
+            procs.append(proc)
+        a, b = procs
+        return (a.tb.size==b.tb.size and np.array_equal(a.tb.mem,b.tb.mem) and a.dp.v_out_size==b.dp.v_out_size
+                and np.array_equal(a.dp.packed[:a.dp.v_out_size],b.dp.packed[:b.dp.v_out_size])
+                and np.array_equal(a.vvalu.vrf,b.vvalu.vrf) and np.array_equal(a.vvalu.minicache,b.vvalu.minicache))
+
+    # Returns True once the input buffer is empty and no building block holds a chain that still has to be processed
+    def drained(self):
+        return not (self.ib.valid() or self.fu.valid() or self.mvru.valid() or self.vvalu.valid() or self.vsru.valid() or self.dp.valid())
+
+    # Same as run, but yields to other coroutines after every cycle so that producers can push values while it runs
+    # If steps is None, it returns once the processor is drained and no producer is waiting for space
+    async def runAsync(self,steps=50):
+        last_cycle = None if steps is None else self.cycle+steps
+        while last_cycle is None or self.cycle<last_cycle:
+            if self.drained() and not self.ib.blocked:
+                if last_cycle is None:
+                    break
+                self.cycle=self.cycle+1
+            else:
+                self.step()
+            await asyncio.sleep(0)
+        return self.log
+
     def run(self,steps=50):
         # Keep stepping through the circuit as long as we have instructions to execute
-        for i in range(steps):
+        # If steps is None, we run until all vectors in the input buffer have been processed
+        last_cycle = None if steps is None else self.cycle+steps
+        while last_cycle is None or self.cycle<last_cycle:
+            # Idle cycles only dispatch pass-through chains, so we skip them instead of stepping through them
+            if self.drained():
+                log.debug('Processor drained at cycle '+str(self.cycle))
+                if last_cycle is not None:
+                    if self.ib.stats is not None:
+                        self.ib.stats.occupancy[0]+=last_cycle-self.cycle
+                    self.cycle=last_cycle
+                break
             self.step()
         return self.log
 
-    def __init__(self,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS):
+    # Evaluates the condition mask of a chain for a batch of eof/bof flags
+    def batchCondition(self,cond,eof,bof):
+        flags = eof[:,0] | eof[:,1]<<1 | bof[:,0]<<2 | bof[:,1]<<3
+        return (np.array(CONDITION_FAILS)[flags] & cond)==0
+
+    # Filter Unit and Matrix Vector Reduce applied to all vectors of a chain at once
+    def batchFilterReduce(self,chain,v_in):
+        cfg, axis = self.fu.config, self.mvru.config.axis[chain]
+        m = self.fu.bin(cfg.addr[chain],v_in) if cfg.filter[chain]==1 else (FILTER_PASS,v_in)
+        return self.mvru.reduce(m,axis)
+
+    # Vector Scalar Reduce applied to all vectors of a chain at once
+    def batchVectorScalarReduce(self,chain,v_in):
+        if self.vsru.config.op[chain]==1:
+            v_out = np.zeros(v_in.shape,dtype=self.fmt.dtype)
+            v_out[:,0] = np.sum(v_in,axis=1)
+            return self.fmt.wrap(v_out)
+        return v_in
+
+    # Applies a vector-vector ALU operation
+    def alu(self,op,operator,operand):
+        return self.fmt.alu(op,operator,operand)
+
+    # Vector Vector ALU applied to a batch
+    # Chains are processed one at a time in dependency order. A value read from the VVVRF or minicache is the last
+    # one written before the (vector,chain) pair that reads it, so it comes either from the same vector (writer
+    # dispatched earlier) or from the previous vector (writer dispatched later). Firmware in which chains depend
+    # on each other cyclically falls back to processing the (vector,chain) pairs in dispatch order.
+    def batchVectorVectorALU(self,chains,v_in,eof,bof):
+        N, V = self.N, len(eof)
+        cfg = self.vvalu.config
+        cond = {c: self.batchCondition(cfg.cond[c],eof,bof) for c in chains}
+        cache_cond = {c: self.batchCondition(cfg.cache_cond[c],eof,bof) & (cfg.cache[c]==1) for c in chains}
+        vrf = np.array(self.vvalu.vrf)
+        writers, savers = {}, [c for c in chains if cfg.minicache[c] in (2,3)]
+        for c in chains:
+            if cfg.cache[c]:
+                writers.setdefault(cfg.cache_addr[c],[]).append(c)
+
+        # Minicache is read from the closest chain that saved to it before this one (possibly on the previous vector)
+        def minicacheSource(c):
+            before = [s for s in savers if s<c]
+            return before[-1] if before else savers[-1]
+
+        deps = {}
+        for c in chains:
+            deps[c] = set()
+            if cfg.op[c]!=0:
+                deps[c].update(writers.get(cfg.addr[c],[]))
+            if cfg.minicache[c] in (1,3) and savers:
+                deps[c].add(minicacheSource(c))
+
+        # Sort chains so that every chain is processed after the chains it reads from
+        order, pending = [], [c for c in chains]
+        while pending:
+            ready = [c for c in pending if not (deps[c]-{c}-set(order))]
+            if not ready:
+                break
+            order.append(ready[0])
+            pending.remove(ready[0])
+        if pending or any(len(w)>1 for w in writers.values()):
+            return self.batchVectorVectorALUInOrder(chains,v_in,cond,cache_cond)
+
+        # Returns the value a chain sees when reading what "src" wrote in the previous (vector,chain) pairs
+        def lastWritten(src,written,same_vector,initial):
+            idx = np.maximum.accumulate(np.where(written,np.arange(V),-1))
+            if not same_vector:
+                idx = np.concatenate(([-1],idx[:-1]))
+            return np.where((idx>=0)[:,None],v_out[src][np.maximum(idx,0)],initial)
+
+        v_out = {}
+        for c in order:
+            op, addr = cfg.op[c], cfg.addr[c]
+            load = cfg.minicache[c] in (1,3) and len(savers)>0
+            reads_self = op!=0 and c in writers.get(addr,[])
+            mc_self = load and minicacheSource(c)==c
+            operator = v_in[c]
+            if load and not mc_self:
+                operator = lastWritten(minicacheSource(c),np.ones(V,dtype=bool),minicacheSource(c)<c,self.vvalu.minicache)
+            elif cfg.minicache[c] in (1,3):
+                operator = np.tile(self.vvalu.minicache,(V,1))
+            operand = vrf[addr*N:addr*N+N]
+            if op!=0 and addr in writers and not reads_self:
+                operand = lastWritten(writers[addr][0],cache_cond[writers[addr][0]],writers[addr][0]<c,operand)
+
+            # Chains that do not depend on their own results are fully vectorized
+            if not reads_self and not mc_self:
+                v_out[c] = np.where(cond[c][:,None],self.alu(op,operator,operand),operator) if op!=0 else operator
+            # Accumulations with an unconditional cache are computed one segment at a time
+            elif reads_self and not mc_self and op in self.fmt.accumulable and cache_cond[c].all():
+                ufunc = {1:np.add,2:np.multiply,4:np.maximum}[op]
+                v_out[c] = np.empty((V,N),dtype=self.fmt.dtype)
+                starts = [0]+list(np.nonzero(~cond[c][1:])[0]+1)+[V]
+                for start, end in zip(starts[:-1],starts[1:]):
+                    segment = operator[start:end]
+                    if cond[c][start]:
+                        v_out[c][start:end] = self.fmt.wrap(ufunc.accumulate(np.vstack((operand,segment)),axis=0)[1:])
+                    else:
+                        v_out[c][start:end] = self.fmt.wrap(ufunc.accumulate(segment,axis=0))
+            # Any other chain that depends on its own results is processed one vector at a time
+            else:
+                v_out[c] = np.empty((V,N),dtype=self.fmt.dtype)
+                state, minicache = operand, np.array(self.vvalu.minicache)
+                for k in range(V):
+                    operator_k = minicache if mc_self else operator[k]
+                    operand_k = state if reads_self else (operand[k] if operand.ndim==2 else operand)
+                    v_out[c][k] = self.alu(op,operator_k,operand_k) if op!=0 and cond[c][k] else operator_k
+                    if reads_self and cache_cond[c][k]:
+                        state = v_out[c][k]
+                    if mc_self:
+                        minicache = v_out[c][k]
+
+        # Update scratchpad and minicache with the last values written
+        if V>0:
+            for addr, (c,) in writers.items():
+                if cache_cond[c].any():
+                    self.vvalu.vrf[addr*N:addr*N+N] = v_out[c][np.nonzero(cache_cond[c])[0][-1]]
+            if savers:
+                np.copyto(self.vvalu.minicache,v_out[savers[-1]][-1])
+        return v_out
+
+    # Vector Vector ALU applied to a batch by processing (vector,chain) pairs in the order they are dispatched
+    def batchVectorVectorALUInOrder(self,chains,v_in,cond,cache_cond):
+        N, V = self.N, len(v_in[chains[0]])
+        v_out = {c: np.empty((V,N),dtype=self.fmt.dtype) for c in chains}
+        for k in range(V):
+            for c in chains:
+                cfg = self.vvalu.config
+                operator = self.vvalu.minicache if cfg.minicache[c] in (1,3) else v_in[c][k]
+                if cfg.op[c]!=0 and cond[c][k]:
+                    v_out[c][k] = self.alu(cfg.op[c],operator,self.vvalu.vrf_rows[cfg.addr[c]])
+                else:
+                    v_out[c][k] = operator
+                if cache_cond[c][k]:
+                    self.vvalu.vrf_rows[cfg.cache_addr[c]][:] = v_out[c][k]
+                if cfg.minicache[c] in (2,3):
+                    np.copyto(self.vvalu.minicache,v_out[c][k])
+        return v_out
+
+    # Data Packer and Trace Buffer applied to a batch
+    def batchDataPackerTraceBuffer(self,chains,v_in,eof,bof):
+        N, V = self.N, len(eof)
+
+        # Find all (vector,chain) pairs that commit values in the order they are dispatched
+        committed = np.zeros((V,len(chains)),dtype=bool)
+        sizes = np.zeros(len(chains),dtype=int)
+        for i, c in enumerate(chains):
+            if self.dp.config.size[c]:
+                committed[:,i] = self.batchCondition(self.dp.config.cond[c],eof,bof)
+                sizes[i] = self.dp.config.size[c]
+        vector_idx, chain_idx = np.nonzero(committed)
+        if len(vector_idx)==0:
+            return
+        values = np.stack([v_in[c] for c in chains],axis=1)[vector_idx,chain_idx]
+        commit_sizes = sizes[chain_idx]
+        stream = values[np.arange(N)[None,:]<commit_sizes[:,None]]
+
+        # A data packer that is already stuck only keeps counting the values committed to it
+        if self.dp.v_out_size>N:
+            self.dp.v_out_size += int(np.sum(commit_sizes))
+            return
+
+        # Values that were already waiting in the data packer come first
+        if self.dp.v_out_size>0:
+            stream = np.concatenate((self.dp.v_out[:self.dp.v_out_size],stream))
+        commit_sizes = np.concatenate(([self.dp.v_out_size],commit_sizes))
+
+        # The data packer only pushes values when it is filled with exactly N values
+        # A commit that overflows the packer leaves it stuck (same behavior as the cycle-accurate model)
+        filled = np.cumsum(commit_sizes)
+        overflow = (filled-commit_sizes)%N+commit_sizes>N
+        if overflow.any():
+            valid_elements = (filled-commit_sizes)[np.argmax(overflow)]//N*N
+        else:
+            valid_elements = filled[-1]//N*N
+        rows = stream[:valid_elements].reshape(-1,N)
+        if valid_elements==len(stream):
+            self.dp.packed[:], self.dp.v_out_size = rows[-1], 0
+        else:
+            pending = stream[valid_elements:valid_elements+N]
+            self.dp.packed[:len(pending)], self.dp.v_out_size = pending, len(stream)-valid_elements
+
+        # Write rows to the circular trace buffer
+        if len(rows)>0:
+            TB_SIZE = self.tb.TB_SIZE
+            position = (self.tb.size+np.arange(len(rows)))%TB_SIZE
+            self.tb.mem[position[-TB_SIZE:]] = rows[-TB_SIZE:]
+            self.tb.size = int(position[-1])+1
+
+    # Transaction-level execution of a batch of input vectors
+    # Produces the same trace buffer contents as stepping the cycle-accurate model until all vectors are processed,
+    # but each chain is evaluated over the whole batch at once. Cycle timing is not modeled and the probe log is not updated.
+    def runBatch(self,vectors,eof1=None,eof2=None):
+        assert self.drained(), "Processor must be drained before running a batch"
+        v_in = self.fmt.encode(vectors).reshape(-1,self.N)
+        V = len(v_in)
+        eof = np.zeros((V,2),dtype=bool)
+        eof[:,0] = False if eof1 is None else eof1
+        eof[:,1] = False if eof2 is None else eof2
+        if V==0:
+            return self.tb.mem
+
+        # The beginning of frame of a vector is the end of frame of the previous vector
+        bof = np.empty((V,2),dtype=bool)
+        bof[0], bof[1:] = [self.ib.bof_out&1,self.ib.bof_out&2], eof[:-1]
+        self.ib.bof_out = int(eof[-1,0]) | int(eof[-1,1])<<1
+
+        # Chain 0 is a pass through, so only chains 1 to num_chains-1 have an effect
+        chains = list(range(1,self.ib.config.num_chains))
+        if not chains:
+            return self.tb.mem
+        chain_values = {c: v_in for c in chains}
+        for b in self.BUILDING_BLOCKS:
+            if b=='FilterReduceUnit':
+                chain_values = {c: self.batchFilterReduce(c,chain_values[c]) for c in chains}
+            elif b=='VectorVectorALU':
+                chain_values = self.batchVectorVectorALU(chains,chain_values,eof,bof)
+            elif b=='VectorScalarReduce':
+                chain_values = {c: self.batchVectorScalarReduce(c,chain_values[c]) for c in chains}
+            elif b=='DataPacker':
+                self.batchDataPackerTraceBuffer(chains,chain_values,eof,bof)
+            elif b not in ['InputBuffer','TraceBuffer']:
+                assert False, "Unknown building block "+b
+        return self.tb.mem
+
+    # DATA_TYPE can be 'float', 'int' or 'fixed_point' (see dataFormat), and DATA_WIDTH only applies to the last two
+    def __init__(self,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE='float',DATA_WIDTH=32):
         ''' Verifying parameters '''
         assert math.log(N, 2).is_integer(), "N must be a power of 2" 
         assert math.log(M, 2).is_integer(), "N must be a power of 2" 
         assert M<=N, "M must be less or equal to N" 
 
         # hardware building blocks   
+        self.N=N
+        self.M=M
+        self.arch=(N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DATA_WIDTH)
         self.BUILDING_BLOCKS=BUILDING_BLOCKS
         self.MAX_CHAINS=MAX_CHAINS
-        self.ib   = self.InputBuffer(N,IB_DEPTH)
-        self.fu   = self.FilterUnit(N,M,FUVRF_SIZE)
-        self.mvru = self.MatrixVectorReduce(N,M)
-        self.vsru = self.VectorScalarReduce(N)
-        self.vvalu= self.VectorVectorALU(N,VVVRF_SIZE)
-        self.dp   = self.DataPacker(N,M)
-        self.tb   = self.TraceBuffer(N,TB_SIZE)
+        self.fmt=dataFormat(DATA_TYPE,DATA_WIDTH)
+        self.ib   = self.InputBuffer(N,M,IB_DEPTH,self.fmt)
+        self.fu   = self.FilterUnit(N,M,FUVRF_SIZE,self.fmt)
+        self.mvru = self.MatrixVectorReduce(N,M,self.fmt)
+        self.vsru = self.VectorScalarReduce(N,M,self.fmt)
+        self.vvalu= self.VectorVectorALU(N,M,VVVRF_SIZE,self.fmt)
+        self.dp   = self.DataPacker(N,M,self.fmt)
+        self.tb   = self.TraceBuffer(N,TB_SIZE,self.fmt)
         self.config()
 
         # Firmware compiler
-        self.compiler = compiler(N,M,MAX_CHAINS)
+        self.compiler = compiler(N,M,MAX_CHAINS,TB_SIZE)
+
+        # Number of clock cycles emulated so far
+        self.cycle=0
 
         # used to simulate a trace buffer to match results with simulation
-        self.log={k: [] for k in ['ib','fu','mvru','vsru','vvalu','dp','tb']}
+        # By default nothing is copied while stepping, and the log only reads the current trace buffer (see probe)
+        self.log = probeLog({},1,1,live={'tb':probeLog.LiveLog(self,'tb',self.probes()['tb'])})
@@ -0,0 +1,327 @@
+import logging as log
+import math
+import numpy as np
+from firmware.compiler import compiler
+from emulator.emulator import lowerFirmware, CONDITION_FAILS
+from misc.misc import *
+
+# Mask of the conditions that do not hold, indexed by the packed eof/bof flags of each processor
+CONDITION_FAILS_TABLE=np.array(CONDITION_FAILS)
+
+# Emulates B independent debug processors at once
+# Every block keeps the state of all processors with a leading batch dimension, so a single step() advances all of
+# them with vectorized operations. Processors share the architecture, but each one has its own firmware, FUVRF,
+# VVVRF and input buffer. Pipeline registers are tuples (v, eof, bof, chainId) of arrays with one entry per processor.
+class multiEmulatedHw():
+
+    # Input buffer class (one circular queue per processor)
+    class InputBuffer():
+        def __init__(self,B,N,IB_DEPTH):
+            self.mem=np.zeros((B,IB_DEPTH,N))
+            self.eof=np.zeros((B,IB_DEPTH),dtype=int)
+            self.head=np.zeros(B,dtype=int)
+            self.count=np.zeros(B,dtype=int)
+            self.chainId_out=np.zeros(B,dtype=int)
+            self.bof_out=np.full(B,3)
+            self.num_chains=np.ones(B,dtype=int)
+            self.B, self.N = B, N
+            self.size=IB_DEPTH
+
+        # Pushes multiple vectors to the input buffer of a given processor
+        def push_many(self,stream,vectors,eof1=False,eof2=False):
+            vectors=np.asarray(vectors)
+            num_vectors=len(vectors)
+            assert vectors.ndim==2 and vectors.shape[1]==self.N, "Input must be a batch of Nx1 vectors"
+            assert self.count[stream]+num_vectors<=self.size, "Input buffer overflowed"
+            tail=(self.head[stream]+self.count[stream]+np.arange(num_vectors))%self.size
+            self.mem[stream,tail]=vectors
+            self.eof[stream,tail]=np.asarray(eof1,dtype=int) | np.asarray(eof2,dtype=int)<<1
+            self.count[stream]=self.count[stream]+num_vectors
+
+        def valid(self):
+            return self.count>0
+
+        def step(self):
+            # Dispatch the next chain of processors that have vectors waiting, going to the next vector after the last chain
+            waiting=self.count>0
+            dispatching=waiting & (self.chainId_out<self.num_chains)
+            popping=dispatching & (self.chainId_out==self.num_chains-1)
+            streams=np.nonzero(popping)[0]
+            self.bof_out[streams]=self.eof[streams,self.head[streams]]
+            self.head[streams]=(self.head[streams]+1)%self.size
+            self.count[streams]=self.count[streams]-1
+            self.chainId_out=np.where(popping,(self.count>0).astype(int),np.where(dispatching,self.chainId_out+1,self.chainId_out))
+            self.chainId_out[~waiting]=0
+
+            streams=np.arange(self.B)
+            waiting=self.count>0
+            v_out=np.where(waiting[:,None],self.mem[streams,self.head],0.)
+            eof_out=np.where(waiting,self.eof[streams,self.head],0)
+            return v_out, eof_out, self.bof_out.copy(), self.chainId_out.copy()
+
+    # Filter Unit
+    class FilterUnit():
+        def __init__(self,B,N,M,FUVRF_SIZE):
+            self.B, self.N, self.M = B, N, M
+            self.FUVRF_SIZE=FUVRF_SIZE
+            self.vrf=np.zeros((B,FUVRF_SIZE*M))
+            self.reg=emptyRegister(B,N)
+            self.config=None
+
+        # The FUVRF of all processors must be assigned at once (either one row per processor or a single row for all of them)
+        @property
+        def vrf(self):
+            return self._vrf
+
+        @vrf.setter
+        def vrf(self,vals):
+            self._vrf=np.array(np.broadcast_to(np.asarray(vals,dtype=float),(self.B,self.FUVRF_SIZE*self.M)))
+            # Low and high limits of the M ranges of each address (the last high limit follows the same rule as emulatedHw)
+            self.low=self._vrf.reshape(self.B,self.FUVRF_SIZE,self.M)
+            self.high=np.empty(self.low.shape)
+            self.high[:,:,:-1]=self.low[:,:,1:]
+            self.high[:,:-1,-1]=self.low[:,1:,0]
+            self.high[:,-1,-1]=self.low[:,-1,-1]+(self.low[:,-1,-1]-self._vrf[:,-2])
+
+        def valid(self):
+            return self.reg[3]!=0
+
+        def step(self,reg_in):
+            # Every element is compared against the ranges of the address used by the chain of each processor
+            v, eof, bof, chainId = self.reg
+            streams=np.arange(self.B)
+            addr=self.config.addr[streams,chainId]
+            low, high = self.low[streams,addr][:,:,None], self.high[streams,addr][:,:,None]
+            mask=(v[:,None,:]>low) & (v[:,None,:]<=high)
+            filtering=self.config.filter[streams,chainId]==1
+            self.reg=reg_in
+            return (filtering,mask,v), eof, bof, chainId
+
+    # This block will reduce the matrix along a given axis
+    class MatrixVectorReduce():
+        def __init__(self,B,N,M):
+            self.B, self.N, self.M = B, N, M
+            self.reg=((np.zeros(B,dtype=bool),np.zeros((B,M,N),dtype=bool),np.zeros((B,N))),)+emptyRegister(B,N)[1:]
+            self.config=None
+
+        def valid(self):
+            return self.reg[3]!=0
+
+        def step(self,reg_in):
+            (filtering,mask,v), eof, bof, chainId = self.reg
+            axis=self.config.axis[np.arange(self.B),chainId]
+            sums=np.zeros((self.B,self.N))
+            sums[:,:self.M]=np.sum(mask,axis=2)
+            sums[:,0]=np.where(filtering,sums[:,0],np.sum(v,axis=1))
+            sums[:,1:]=np.where(filtering[:,None],sums[:,1:],0)
+            first=np.where(filtering[:,None],mask[:,0,:],v)
+            within=np.where(filtering[:,None],np.sum(mask,axis=1),v)
+            v_out=np.stack((first,within,sums))[axis,np.arange(self.B)]
+            self.reg=reg_in
+            return v_out, eof, bof, chainId
+
+    # This block will reduce a vector to a scalar and pad with zeros
+    class VectorScalarReduce():
+        def __init__(self,B,N):
+            self.B, self.N = B, N
+            self.reg=emptyRegister(B,N)
+            self.config=None
+
+        def valid(self):
+            return self.reg[3]!=0
+
+        def step(self,reg_in):
+            v, eof, bof, chainId = self.reg
+            reducing=self.config.op[np.arange(self.B),chainId]==1
+            v_out=np.where(reducing[:,None],0.,v)
+            v_out[:,0]=np.where(reducing,np.sum(v,axis=1),v[:,0])
+            self.reg=reg_in
+            return v_out, eof, bof, chainId
+
+    # Vector-vector ALU (takes 3 cycles: read, calculate, write)
+    class VectorVectorALU():
+        def __init__(self,B,N,VVVRF_SIZE):
+            self.B, self.N = B, N
+            self.VVVRF_SIZE=VVVRF_SIZE
+            self.vrf=np.zeros((B,N*VVVRF_SIZE))
+            self.minicache=np.zeros((B,N))
+            self.reg=emptyRegister(B,N)
+            self.d1=emptyRegister(B,N)
+            self.d2=emptyRegister(B,N)
+            self.config=None
+
+        # The VVVRF of each processor is a flat array of N*VVVRF_SIZE elements, but each address is also accessible as a row
+        @property
+        def vrf(self):
+            return self._vrf
+
+        @vrf.setter
+        def vrf(self,vals):
+            self._vrf=np.array(np.broadcast_to(np.asarray(vals,dtype=float),(self.B,self.N*self.VVVRF_SIZE)))
+            self.vrf_rows=self._vrf.reshape(self.B,self.VVVRF_SIZE,self.N)
+
+        def valid(self):
+            return (self.reg[3]!=0) | (self.d1[3]!=0) | (self.d2[3]!=0)
+
+        def step(self,reg_in):
+            v, eof, bof, chainId = self.reg
+            cfg, streams = self.config, np.arange(self.B)
+            op, minicache = cfg.op[streams,chainId], cfg.minicache[streams,chainId]
+            fails=CONDITION_FAILS_TABLE[eof|bof<<2]
+
+            # Compute every operation and keep the one selected by the chain of each processor
+            operator=np.where(((minicache==1) | (minicache==3))[:,None],self.minicache,v)
+            operand=self.vrf_rows[streams,cfg.addr[streams,chainId]]
+            executing=(op!=0) & ((cfg.cond[streams,chainId] & fails)==0)
+            with np.errstate(over='ignore',invalid='ignore'):
+                results=np.stack((operator,operator+operand,operator*operand,operator-operand,np.maximum(operator,operand)))
+            result=results[np.where(executing,op,0),streams]
+
+            caching=np.nonzero((cfg.cache[streams,chainId]==1) & ((cfg.cache_cond[streams,chainId] & fails)==0))[0]
+            self.vrf_rows[caching,cfg.cache_addr[caching,chainId[caching]]]=result[caching]
+            saving=(minicache==2) | (minicache==3)
+            self.minicache[saving]=result[saving]
+
+            # Delay for 2 cycles
+            v_out=self.d2
+            self.d2=self.d1
+            self.d1=(result,eof,bof,chainId)
+            self.reg=reg_in
+            return v_out
+
+    # Packs data efficiently
+    class DataPacker():
+        def __init__(self,B,N):
+            self.B, self.N = B, N
+            self.packed=np.zeros((B,N))
+            self.v_out_size=np.zeros(B,dtype=int)
+            self.v_out_valid=np.zeros(B,dtype=bool)
+            self.reg=emptyRegister(B,N)
+            self.config=None
+
+        def valid(self):
+            return self.reg[3]!=0
+
+        def step(self,reg_in):
+            v, eof, bof, chainId = self.reg
+            streams=np.arange(self.B)
+            size=self.config.size[streams,chainId]
+            committing=(size>0) & ((self.config.cond[streams,chainId] & CONDITION_FAILS_TABLE[eof|bof<<2])==0)
+
+            # A commit that does not fit leaves the data packer stuck, so its values are not stored
+            fits=committing & (self.v_out_size+size<=self.N)
+            rows, cols = np.nonzero(fits[:,None] & (np.arange(self.N)[None,:]<size[:,None]))
+            self.packed[rows,self.v_out_size[rows]+cols]=v[rows,cols]
+            self.v_out_size=np.where(committing,self.v_out_size+size,self.v_out_size)
+            self.v_out_valid=committing & (self.v_out_size==self.N)
+            self.v_out_size[self.v_out_valid]=0
+            self.reg=reg_in
+
+    # Trace buffer of each processor
+    class TraceBuffer():
+        def __init__(self,B,N,TB_SIZE):
+            self.mem=np.zeros((B,TB_SIZE,N))
+            self.size=np.zeros(B,dtype=int)
+            self.TB_SIZE=TB_SIZE
+
+        def step(self,dp):
+            streams=np.nonzero(dp.v_out_valid)[0]
+            self.size[streams]=np.where(self.size[streams]==self.TB_SIZE,0,self.size[streams])
+            self.mem[streams,self.size[streams]]=dp.packed[streams]
+            self.size[streams]=self.size[streams]+1
+
+    def step(self):
+        log.debug('New step')
+        self.cycle=self.cycle+1
+
+        # Perform operations according to how building blocks are connected
+        for b in self.BUILDING_BLOCKS:
+            if b=='InputBuffer':
+                reg = self.ib.step()
+            elif b=='FilterReduceUnit':
+                reg = self.fu.step(reg)
+                reg = self.mvru.step(reg)
+            elif b=='VectorVectorALU':
+                reg = self.vvalu.step(reg)
+            elif b=='VectorScalarReduce':
+                reg = self.vsru.step(reg)
+            elif b=='DataPacker':
+                self.dp.step(reg)
+            elif b=='TraceBuffer':
+                self.tb.step(self.dp)
+            else:
+                assert False, "Unknown building block "+b
+
+    # Pushes values to the input of the chain of a given processor
+    def push(self,stream,pushed_vals):
+        if len(pushed_vals)==2:
+            pushed_vals.append(False)
+        v_in, eof1, eof2 = pushed_vals
+        assert list(np.shape(v_in))==[self.N], "Input must be Nx1"
+        self.ib.push_many(stream,[v_in],eof1,eof2)
+
+    # Pushes a batch of vectors to the input of the chain of a given processor
+    def push_many(self,stream,vectors,eof1=False,eof2=False):
+        self.ib.push_many(stream,vectors,eof1,eof2)
+
+    # Configures the processors either with a single firmware or with a list of B firmware (None leaves a processor idle)
+    def config(self,fw=None):
+        fws=fw if isinstance(fw,list) else self.B*[fw]
+        assert len(fws)==self.B, "A firmware must be given for each processor"
+        tables=[lowerFirmware(f) for f in fws]
+
+        # Tables are padded to MAX_CHAINS+1 chains, so they can be indexed by [processor,chainId]
+        stack = lambda block,field: np.array([getattr(getattr(t,block),field)+[0]*(self.MAX_CHAINS+1-t.num_chains) for t in tables])
+        fields = {'fu':['filter','addr'],'mvru':['axis'],'vsru':['op'],'dp':['size','cond'],
+                  'vvalu':['op','addr','cond','cache','cache_addr','cache_cond','minicache']}
+        for block, block_fields in fields.items():
+            getattr(self,block).config=struct(**{field: stack(block,field) for field in block_fields})
+        self.ib.num_chains=np.array([t.num_chains for t in tables])
+
+    # Returns True once all processors are drained
+    def drained(self):
+        return not np.any(self.ib.valid() | self.fu.valid() | self.mvru.valid() | self.vvalu.valid() | self.vsru.valid() | self.dp.valid())
+
+    def run(self,steps=50):
+        # Keep stepping through the circuit as long as we have instructions to execute
+        # If steps is None, we run until all vectors in the input buffers have been processed
+        last_cycle = None if steps is None else self.cycle+steps
+        while last_cycle is None or self.cycle<last_cycle:
+            if self.drained():
+                log.debug('Processors drained at cycle '+str(self.cycle))
+                if last_cycle is not None:
+                    self.cycle=last_cycle
+                break
+            self.step()
+        return self.tb.mem
+
+    def __init__(self,B,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS):
+        ''' Verifying parameters '''
+        assert math.log(N, 2).is_integer(), "N must be a power of 2"
+        assert math.log(M, 2).is_integer(), "N must be a power of 2"
+        assert M<=N, "M must be less or equal to N"
+
+        # hardware building blocks (one of each for all processors)
+        self.B=B
+        self.N=N
+        self.M=M
+        self.BUILDING_BLOCKS=BUILDING_BLOCKS
+        self.MAX_CHAINS=MAX_CHAINS
+        self.ib   = self.InputBuffer(B,N,IB_DEPTH)
+        self.fu   = self.FilterUnit(B,N,M,FUVRF_SIZE)
+        self.mvru = self.MatrixVectorReduce(B,N,M)
+        self.vsru = self.VectorScalarReduce(B,N)
+        self.vvalu= self.VectorVectorALU(B,N,VVVRF_SIZE)
+        self.dp   = self.DataPacker(B,N)
+        self.tb   = self.TraceBuffer(B,N,TB_SIZE)
+        self.config()
+
+        # Firmware compiler (processors with different firmware need one compiler per firmware)
+        self.compiler = compiler(N,M,MAX_CHAINS,TB_SIZE)
+
+        # Number of clock cycles emulated so far
+        self.cycle=0
+
+# Pipeline register holding no chain for all processors
+def emptyRegister(B,N):
+    return np.zeros((B,N)), np.zeros(B,dtype=int), np.full(B,3), np.zeros(B,dtype=int)
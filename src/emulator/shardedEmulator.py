@@ -0,0 +1,97 @@
+import math
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from firmware.compiler import compiler, encodeCond
+from emulator.emulator import emulatedHw, lowerFirmware
+from misc.misc import *
+
+# Runs a shard of the input stream on its own processor and returns all values committed to the data packer in order
+# This is a module level function so it can be sent to the worker processes
+def runShard(arch,fw,fu_vrf,vectors,eof1,eof2):
+    N, M, FUVRF_SIZE, VVVRF_SIZE, MAX_CHAINS, BUILDING_BLOCKS = arch
+
+    # The trace buffer is sized so that it never wraps around
+    commits_per_vector=sum(lowerFirmware(fw).dp.size)
+    TB_SIZE=max(1,math.ceil(len(vectors)*commits_per_vector/N))
+    proc = emulatedHw(N,M,1,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+    proc.fu.vrf=fu_vrf
+    proc.config(fw)
+    proc.runBatch(vectors,eof1,eof2)
+    pending=proc.dp.packed[:proc.dp.v_out_size] if proc.dp.v_out_size<N else proc.dp.packed[:0]
+    return np.concatenate((proc.tb.mem[:proc.tb.size].ravel(),pending))
+
+# Splits a long input stream into consecutive shards and runs each of them on a separate worker process
+# Results are merged with the rule declared by the firmware function (see firmware.mergeable), so only firmware
+# whose results do not depend on vectors from other shards can be used
+class shardedEmulatedHw():
+    def __init__(self,N,M,FUVRF_SIZE,VVVRF_SIZE,MAX_CHAINS,BUILDING_BLOCKS,workers=None):
+        assert math.log(N, 2).is_integer(), "N must be a power of 2"
+        assert math.log(M, 2).is_integer(), "M must be a power of 2"
+        assert M<=N, "M must be less or equal to N"
+        self.N=N
+        self.M=M
+        self.MAX_CHAINS=MAX_CHAINS
+        self.arch=(N,M,FUVRF_SIZE,VVVRF_SIZE,MAX_CHAINS,BUILDING_BLOCKS)
+        self.workers=os.cpu_count() if workers is None else workers
+        self.fu=struct(vrf=np.zeros(FUVRF_SIZE*M))
+        self.fw=None
+        self.merge_rule=None
+        self.pending=np.zeros(0)
+
+    # Compiles a firmware function from firmware.py (e.g. config(distribution,16,M))
+    def config(self,fw_function,*args):
+        assert hasattr(fw_function,'merge_rule'), "Firmware "+fw_function.__name__+" does not declare a merge rule, so it cannot be sharded"
+        fw=fw_function(compiler(self.N,self.M,self.MAX_CHAINS),*args)
+
+        # Partial frames can only be added if every value is committed at the last vector of a frame
+        if fw_function.merge_rule=='add':
+            last=encodeCond({'last':True,'notlast':False,'first':False,'notfirst':False},{'last':False,'notlast':False,'first':False,'notfirst':False})
+            for chain in fw['dp'][:fw['valid_chains']]:
+                assert not chain.commit or encodeCond(chain.cond1,chain.cond2)==last, "Firmware "+fw_function.__name__+" must only commit at the last vector of a frame to be added"
+        self.fw=fw
+        self.merge_rule=fw_function.merge_rule
+        self.record_size=sum(lowerFirmware(fw).dp.size)
+
+    # Runs the whole input stream and returns the rows the trace buffer of a single processor would receive
+    # Values that were committed but did not fill a complete row are left in self.pending
+    def run(self,vectors,eof1=None,eof2=None,shards=None):
+        assert self.fw is not None, "Processor must be configured before running"
+        vectors=np.asarray(vectors,dtype=float).reshape(-1,self.N)
+        V=len(vectors)
+        eof1=np.broadcast_to(np.asarray(False if eof1 is None else eof1,dtype=bool),(V,))
+        eof2=np.broadcast_to(np.asarray(False if eof2 is None else eof2,dtype=bool),(V,))
+        shards=self.workers if shards is None else shards
+        bounds=np.unique(np.linspace(0,V,max(1,min(shards,V))+1).astype(int))
+        starts, ends = bounds[:-1], bounds[1:]
+
+        # When adding partial frames, every shard commits the frame that is open at its last vector
+        shard_eof1=[eof1[start:end].copy() for start, end in zip(starts,ends)]
+        if self.merge_rule=='add':
+            for e in shard_eof1:
+                e[-1]=True
+
+        jobs=[(self.arch,self.fw,self.fu.vrf,vectors[start:end],shard_eof1[i],eof2[start:end]) for i, (start, end) in enumerate(zip(starts,ends))]
+        with ProcessPoolExecutor(max(1,min(self.workers,len(jobs)))) as pool:
+            results=list(pool.map(runShard,*zip(*jobs))) if jobs else []
+
+        if self.merge_rule=='add' and self.record_size>0:
+            records=[]
+            for start, result in zip(starts,results):
+                shard_records=list(result.reshape(-1,self.record_size))
+
+                # A frame that crosses the shard boundary was committed in parts by both shards
+                if start>0 and not eof1[start-1]:
+                    records[-1]=records[-1]+shard_records.pop(0)
+                records.extend(shard_records)
+
+            # A single processor never commits the last frame if it was not closed
+            if V>0 and not eof1[-1]:
+                records.pop()
+            values=np.concatenate(records) if records else np.zeros(0)
+        else:
+            values=np.concatenate(results) if results else np.zeros(0)
+
+        num_rows=len(values)//self.N
+        self.pending=values[num_rows*self.N:]
+        return values[:num_rows*self.N].reshape(num_rows,self.N)
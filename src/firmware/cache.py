@@ -0,0 +1,79 @@
+import os, inspect, hashlib, pickle
+from emulator.emulator import lowerFirmware
+from misc.misc import *
+
+# Content-addressed cache of compiled firmware
+# Entries are keyed by the source of the firmware function, its arguments and the parameters of the compiler (N, M,
+# MAX_CHAINS, TB_SIZE and optimize), so editing a firmware function invalidates its entries. Each entry holds the
+# firmware, the tables the emulator is configured with, the RTL initial firmware strings and the bytes of the reconfig
+# unit image (without FUVRF contents, see compiler.image). Entries are kept in memory
+# and, if a directory is given, pickled to disk so that they can be reused by other processes.
+#   cache=firmwareCache('.fw_cache')
+#   proc.config(cache.compile(proc.compiler,firm.distribution,16,M).firmware)
+# Entries are shared by everyone who compiles the same firmware, so they must not be modified
+class firmwareCache():
+    def __init__(self,directory=None):
+        self.directory=directory
+        if directory is not None:
+            os.makedirs(directory,exist_ok=True)
+        self.entries={}
+        self.hits=0
+        self.misses=0
+
+    # Returns the key of a firmware function compiled with the given arguments
+    # Several lambdas may be defined in the same line, so their code and the variables they capture are also part of the key
+    # (global variables they read are not)
+    def key(self,cp,fw_function,*args):
+        def encode(value):
+            try:
+                return pickle.dumps(value)
+            except Exception:
+                return repr(value).encode()
+        try:
+            source=inspect.getsource(fw_function)
+        except (OSError,TypeError):
+            source=fw_function.__module__+'.'+fw_function.__qualname__
+        # Code objects are encoded by their bytecode and the names they use, since the repr of nested ones holds a memory address
+        def encodeCode(code):
+            return code.co_code+repr(code.co_names).encode()+b''.join(encodeCode(c) if inspect.iscode(c) else repr(c).encode() for c in code.co_consts)
+        code=getattr(fw_function,'__code__',None)
+        code=b'' if code is None else encodeCode(code)
+        closure=[cell.cell_contents for cell in getattr(fw_function,'__closure__',None) or []]
+        params=(cp.N,cp.M,cp.MAX_CHAINS,cp.TB_SIZE,cp.optimize)
+        return hashlib.sha256(b'\0'.join([source.encode(),code,encode(closure),encode(args),encode(params)])).hexdigest()
+
+    def path(self,key):
+        return os.path.join(self.directory,key+'.pkl')
+
+    # Returns the cache entry of a firmware function (e.g. compile(cp,firm.distribution,16,M)), compiling it on a miss
+    # The compiler is reset before and after compiling, so it can be used again
+    def compile(self,cp,fw_function,*args):
+        key=self.key(cp,fw_function,*args)
+        if key not in self.entries and self.directory is not None and os.path.isfile(self.path(key)):
+            with open(self.path(key),'rb') as f:
+                self.entries[key]=pickle.load(f)
+        if key in self.entries:
+            self.hits+=1
+            return self.entries[key]
+
+        self.misses+=1
+        cp.reset()
+        fw=fw_function(cp,*args)
+        entry=struct(key=key,firmware=fw,lowered=lowerFirmware(fw),rtl=cp.rtlFirmware(fw),image=cp.image(fw),unoptimized=cp.unoptimized)
+        cp.reset()
+        self.entries[key]=entry
+        if self.directory is not None:
+            # Entries are written to a temporary file first, so that concurrent readers never see a partial entry
+            tmp=self.path(key)+'.'+str(os.getpid())
+            with open(tmp,'wb') as f:
+                pickle.dump(entry,f)
+            os.replace(tmp,self.path(key))
+        return entry
+
+    # Removes all entries from memory and disk
+    def clear(self):
+        self.entries={}
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                if name.endswith('.pkl'):
+                    os.remove(os.path.join(self.directory,name))
@@ -1,5 +1,117 @@
 from misc.misc import *
 
+# Bit of each condition in the 8-bit condition masks shared by the emulator and the hardware
+# Bits 0-3 refer to eof1/bof1 and bits 4-7 to eof2/bof2
+COND_BITS={'last':0,'notlast':1,'first':2,'notfirst':3}
+
+# Encodes the conditions of an instruction as an 8-bit mask
+def encodeCond(cond1,cond2):
+    mask=0
+    for name, bit in COND_BITS.items():
+        if cond1[name]:
+            mask|=1<<bit
+        if cond2[name]:
+            mask|=1<<(bit+4)
+    return mask
+
+# Returns the mask of conditions that do not hold given the eof and bof flags (bit 0 for eof1/bof1 and bit 1 for eof2/bof2)
+def failedConditions(eof,bof):
+    mask=0
+    for i in range(2):
+        last, first = bool(eof>>i&1), bool(bof>>i&1)
+        holds={'last':last,'notlast':not last,'first':first,'notfirst':not first}
+        for name, bit in COND_BITS.items():
+            if not holds[name]:
+                mask|=1<<(bit+4*i)
+    return mask
+
+# Config IDs of the blocks that receive firmware from the reconfig unit and the commands that load an image
+# Images follow the fields each block's config logic stores, which is not yet what reconfig_unit.sv sends them: it only
+# implements CMD_UPDATE_ALL, with windows that do not match the image (see rtlHw.upload), and the blocks count clock
+# cycles instead of received bytes. Uploads are therefore only checked against a Python model of the reconfig unit.
+CONFIG_IDS={'InputBuffer':0,'FilterReduceUnit':1,'VectorVectorALU':2,'VectorScalarReduce':3,'DataPacker':4}
+CMD_UPDATE_ALL=42
+CMD_UPDATE_BLOCK=43
+
+# Bytes sent over the UART to upload a whole firmware image (see compiler.image)
+def fullUpload(image):
+    return bytes([CMD_UPDATE_ALL])+b''.join(image[config_id] for config_id in sorted(image))
+
+# Bytes sent over the UART to switch from a previous firmware image to a new one
+# Only blocks whose bytes changed are uploaded, and only up to their last changed byte
+def deltaUpload(previous,image):
+    upload=b''
+    for config_id in sorted(image):
+        old, new = previous.get(config_id,b''), image[config_id]
+        changed=[i for i in range(len(new)) if i>=len(old) or old[i]!=new[i]]
+        if changed:
+            size=changed[-1]+1
+            upload+=bytes([CMD_UPDATE_BLOCK,config_id,size>>8,size&255])+new[:size]
+    return upload
+
+# Seconds it takes to send bytes over a UART with one start and one stop bit
+def uploadTime(upload,baud=115200):
+    return len(upload)*10/baud
+
+# Static cost of a firmware, estimated without running it
+# Frame lengths (frame1 and frame2) are the number of vectors between consecutive eof1 and eof2 flags, or None if the flags
+# are never set. Each level is assumed to be independent from the other.
+class firmwareCost():
+    # Cycles each building block holds a chain in the emulator
+    BLOCK_LATENCY={'InputBuffer':1,'FilterReduceUnit':2,'VectorVectorALU':3,'VectorScalarReduce':1,'DataPacker':1}
+
+    def __init__(self,N,valid_chains,commits,TB_SIZE=None):
+        self.N=N
+        self.TB_SIZE=TB_SIZE
+        # Size and condition mask of the chains that commit values
+        self.commits=commits
+        # Each vector occupies the input buffer while all its chains are dispatched (one per cycle)
+        self.cycles_per_vector=max(1,valid_chains)
+        # Cycles from pushing a vector to an empty input buffer until its last chain reaches the data packer
+        self.latency=sum(self.BLOCK_LATENCY.values())+self.cycles_per_vector-1
+
+    # Fraction of the vectors in which any condition of a mask holds (as in the hardware, see vector_vector_alu.sv)
+    # Masks with no condition always hold
+    def conditionRate(self,mask,frame1=None,frame2=None):
+        if mask==0:
+            return 1.0
+        misses=1.0
+        for level, frame in enumerate([frame1,frame2]):
+            bits={name: bool(mask>>(bit+4*level)&1) for name, bit in COND_BITS.items()}
+            if frame is None:
+                misses*=0.0 if bits['notlast'] or bits['notfirst'] else 1.0
+                continue
+            holds=0
+            for i in range(frame):
+                last, first = i==frame-1, i==0
+                if (bits['last'] and last) or (bits['notlast'] and not last) or (bits['first'] and first) or (bits['notfirst'] and not first):
+                    holds+=1
+            misses*=1-holds/frame
+        return 1-misses
+
+    # Average number of values committed to the data packer per input vector
+    def valuesPerVector(self,frame1=None,frame2=None):
+        return sum(size*self.conditionRate(mask,frame1,frame2) for size, mask in self.commits)
+
+    # Average number of N-wide trace buffer words written per input vector
+    def wordsPerVector(self,frame1=None,frame2=None):
+        return self.valuesPerVector(frame1,frame2)/self.N
+
+    # Number of cycles until the trace buffer wraps around (by default when vectors arrive as fast as they are dispatched)
+    def cyclesUntilWrap(self,frame1=None,frame2=None,vectors_per_cycle=None,TB_SIZE=None):
+        TB_SIZE=self.TB_SIZE if TB_SIZE is None else TB_SIZE
+        assert TB_SIZE is not None, "TB_SIZE is needed to know when the trace buffer wraps around"
+        vectors_per_cycle=1/self.cycles_per_vector if vectors_per_cycle is None else min(vectors_per_cycle,1/self.cycles_per_vector)
+        words_per_cycle=self.wordsPerVector(frame1,frame2)*vectors_per_cycle
+        return float('inf') if words_per_cycle==0 else TB_SIZE/words_per_cycle
+
+    # Returns True if the trace buffer does not wrap around before being dumped every dump_interval cycles
+    def fitsTraceBuffer(self,dump_interval,frame1=None,frame2=None,vectors_per_cycle=None,TB_SIZE=None):
+        return self.cyclesUntilWrap(frame1,frame2,vectors_per_cycle,TB_SIZE)>=dump_interval
+
+    def __repr__(self):
+        return str({'cycles_per_vector':self.cycles_per_vector,'latency':self.latency,'commits':self.commits})
+
 #Hardware configurations (that can be done by VLIW instruction)
 class compiler():
     # ISA
@@ -27,28 +139,23 @@ class compiler():
     def vv_add(self,addr,condition1=None, condition2=None):
         self.vvalu.op=1
         self.vvalu.addr=addr
-        self.vvalu.cond1[condition1]=self.__process_condition(condition1)
-        self.vvalu.cond2[condition2]=self.__process_condition(condition2)
+        self.vvalu.cond1[condition1], self.vvalu.cond2[condition2] = self.__process_conditions(condition1,condition2)
     def vv_mul(self,addr,condition1=None, condition2=None):
         self.vvalu.op=2
         self.vvalu.addr=addr
-        self.vvalu.cond1[condition1]=self.__process_condition(condition1)
-        self.vvalu.cond2[condition2]=self.__process_condition(condition2)
+        self.vvalu.cond1[condition1], self.vvalu.cond2[condition2] = self.__process_conditions(condition1,condition2)
     def vv_sub(self,addr,condition1=None, condition2=None):
         self.vvalu.op=3
         self.vvalu.addr=addr
-        self.vvalu.cond1[condition1]=self.__process_condition(condition1)
-        self.vvalu.cond2[condition2]=self.__process_condition(condition2)
+        self.vvalu.cond1[condition1], self.vvalu.cond2[condition2] = self.__process_conditions(condition1,condition2)
     def vv_max(self,addr,condition1=None, condition2=None):
         self.vvalu.op=4
         self.vvalu.addr=addr
-        self.vvalu.cond1[condition1]=self.__process_condition(condition1)
-        self.vvalu.cond2[condition2]=self.__process_condition(condition2)
+        self.vvalu.cond1[condition1], self.vvalu.cond2[condition2] = self.__process_conditions(condition1,condition2)
     def v_cache(self,cache_addr,condition1=None, condition2=None):
         self.vvalu.cache=1
         self.vvalu.cache_addr=cache_addr
-        self.vvalu.cache_cond1[condition1]=self.__process_condition(condition1)
-        self.vvalu.cache_cond2[condition2]=self.__process_condition(condition2)
+        self.vvalu.cache_cond1[condition1], self.vvalu.cache_cond2[condition2] = self.__process_conditions(condition1,condition2)
     def v_mc_load(self):
         if self.vvalu.minicache==0:
             self.vvalu.minicache=1
@@ -67,8 +174,7 @@ class compiler():
             self.dp.size=size
         else:
             assert False, "Cannot commit "+str(size)+" elements"
-        self.dp.cond1[condition1]=self.__process_condition(condition1)
-        self.dp.cond2[condition2]=self.__process_condition(condition2)
+        self.dp.cond1[condition1], self.dp.cond2[condition2] = self.__process_conditions(condition1,condition2)
     def end_chain(self):
         self.firmware['fu'].append(copy(self.fu))
         self.firmware['mvru'].append(copy(self.mvru))
@@ -76,24 +182,178 @@ class compiler():
         self.firmware['vvalu'].append(copy(self.vvalu))
         self.firmware['dp'].append(copy(self.dp))
     def compile(self):
+        # The firmware as written is kept so that the optimized one can be checked against it (see emulatedHw.equivalent)
+        if self.optimize:
+            unoptimized=copy(self)
+            unoptimized.optimize=False
+            self.unoptimized=unoptimized.compile()
+            self.optimizeChains()
+
         # Make sure we are returning a firmware with MAX_CHAINS chains
         self.firmware['valid_chains'] = self.chains_created
+        commits=[(chain.size,encodeCond(chain.cond1,chain.cond2)) for chain in self.firmware['dp'] if chain.commit]
+        self.firmware['cost'] = firmwareCost(self.N,self.chains_created,commits,self.TB_SIZE)
         while self.chains_created!=self.MAX_CHAINS:
             self.begin_chain()
             self.end_chain()
         # Return final firmware    
         return self.firmware
 
+    # Optimization pass that reduces the number of chains (and so the cycles spent on each input vector)
+    #   1) Chains that do not cache, save to the minicache or commit have no observable effect and are removed
+    #   2) Chains that compute the same vector are merged if each of them stores it in a different place
+    #      A chain is only moved next to the one it is merged with if it does not depend on the chains in between
+    def optimizeChains(self):
+        blocks=['fu','mvru','vsru','vvalu','dp']
+        chains=[struct(**dict(zip(blocks,chain))) for chain in zip(*[self.firmware[b] for b in blocks])]
+        chains=[chain for chain in chains if self.__writes(chain)] or chains[:1]
+        i=0
+        while i<len(chains):
+            j=i+1
+            while j<len(chains):
+                if self.__mergeable(chains[i],chains[j]) and all(self.__independent(chains[k],chains[j]) for k in range(i+1,j)):
+                    chains[i]=self.__merge(chains[i],chains.pop(j))
+                else:
+                    j+=1
+            i+=1
+        for b in blocks:
+            self.firmware[b]=[getattr(chain,b) for chain in chains]
+        self.chains_created=len(chains)
+
+    # State read and written by a chain
+    def __reads(self,chain):
+        reads=set()
+        if chain.vvalu.op!=0:
+            reads.add(('vvvrf',chain.vvalu.addr))
+        if chain.vvalu.minicache&1:
+            reads.add('minicache')
+        return reads
+    def __writes(self,chain):
+        writes=set()
+        if chain.vvalu.cache:
+            writes.add(('vvvrf',chain.vvalu.cache_addr))
+        if chain.vvalu.minicache&2:
+            writes.add('minicache')
+        if chain.dp.commit:
+            writes.add('dp')
+        return writes
+
+    # Two chains can be swapped if neither writes what the other reads or writes (commits are never reordered)
+    def __independent(self,a,b):
+        return not (self.__writes(a)&(self.__reads(b)|self.__writes(b)) or self.__writes(b)&self.__reads(a))
+
+    # Configuration that determines the vector a chain computes
+    def __datapath(self,chain):
+        fu=(chain.fu.filter,chain.fu.addr if chain.fu.filter else None)
+        vvalu=(chain.vvalu.op,chain.vvalu.minicache&1)
+        if chain.vvalu.op!=0:
+            vvalu+=(chain.vvalu.addr,encodeCond(chain.vvalu.cond1,chain.vvalu.cond2))
+        return fu,chain.mvru.axis,chain.vsru.op,vvalu
+
+    # Chain b can be merged into chain a (which comes first) if both compute the same vector, a does not write what b
+    # reads and each chain block (cache, minicache and data packer) is only used by one of them
+    def __mergeable(self,a,b):
+        shared=(a.vvalu.cache and b.vvalu.cache) or (a.vvalu.minicache&2 and b.vvalu.minicache&2) or (a.dp.commit and b.dp.commit)
+        return self.__datapath(a)==self.__datapath(b) and not shared and not self.__writes(a)&self.__reads(b)
+    def __merge(self,a,b):
+        merged=copy(a)
+        if b.vvalu.cache:
+            merged.vvalu.cache, merged.vvalu.cache_addr = b.vvalu.cache, b.vvalu.cache_addr
+            merged.vvalu.cache_cond1, merged.vvalu.cache_cond2 = copy(b.vvalu.cache_cond1), copy(b.vvalu.cache_cond2)
+        merged.vvalu.minicache|=b.vvalu.minicache&2
+        if b.dp.commit:
+            merged.dp=copy(b.dp)
+        return merged
+
+    # Encodes a firmware as the Verilog initial values of the firmware registers of each block (see rtlHw.rtlLogicConfig)
+    def rtlFirmware(self,fw):
+        if fw is None:
+            EMPTY_FIRMWARE = "'{MAX_CHAINS{0}}"
+            rtl_fw = {name: EMPTY_FIRMWARE for name in ['VSRU','DP','VVALU_OP','VVALU_ADDR_RD','VVALU_COND','VVALU_CACHE','VVALU_CACHE_ADDR',
+                                                        'VVALU_MINICACHE','VVALU_CACHE_COND','FRU_OP','FRU_ADDR','FRU_REDUCE_AXIS','DP_COND']}
+            rtl_fw['IB'] = 0
+            return rtl_fw
+        array = lambda values: str(values).replace("[", "'{").replace("]", "}")
+        return {'IB': fw['valid_chains'],
+                'VSRU': array([chain.op for chain in fw['vsru']]),
+                'DP': array([self.encodeDpFirmware(chain.commit,chain.size) for chain in fw['dp']]),
+                'VVALU_OP': array([chain.op for chain in fw['vvalu']]),
+                'VVALU_ADDR_RD': array([chain.addr for chain in fw['vvalu']]),
+                'VVALU_COND': array([encodeCond(chain.cond1,chain.cond2) for chain in fw['vvalu']]),
+                'VVALU_CACHE': array([chain.cache for chain in fw['vvalu']]),
+                'VVALU_CACHE_ADDR': array([chain.cache_addr for chain in fw['vvalu']]),
+                'VVALU_MINICACHE': array([chain.minicache for chain in fw['vvalu']]),
+                'VVALU_CACHE_COND': array([encodeCond(chain.cache_cond1,chain.cache_cond2) for chain in fw['vvalu']]),
+                'FRU_OP': array([chain.filter for chain in fw['fu']]),
+                'FRU_ADDR': array([chain.addr for chain in fw['fu']]),
+                'FRU_REDUCE_AXIS': array([chain.axis for chain in fw['mvru']]),
+                'DP_COND': array([encodeCond(chain.cond1,chain.cond2) for chain in fw['dp']])}
+
+    # Encodes a firmware as the bytes each block reads from the reconfig unit, indexed by config ID
+    # The FUVRF contents are appended to the bytes of the filter reduce unit if fu_vrf is given, with the packed M values
+    # of each address sent MSB first (a full upload needs all FUVRF_SIZE*M values)
+    def image(self,fw,fu_vrf=None,DATA_WIDTH=32,DATA_TYPE='fixed_point'):
+        assert len(fw['dp'])==self.MAX_CHAINS, "Firmware must be compiled before building its image"
+        table = lambda block,field,encode=None: [getattr(chain,field) if encode is None else encode(chain) for chain in fw[block]]
+        fru = table('fu','filter')+table('fu','addr')+table('mvru','axis')
+        vvalu = (table('vvalu','op')+table('vvalu','addr')+table('vvalu',None,lambda chain: encodeCond(chain.cond1,chain.cond2))+
+                 table('vvalu','cache')+table('vvalu','cache_addr')+table('vvalu','minicache')+
+                 table('vvalu',None,lambda chain: encodeCond(chain.cache_cond1,chain.cache_cond2)))
+        dp = table('dp',None,lambda chain: encodeCond(chain.cond1,chain.cond2))+table('dp',None,lambda chain: self.encodeDpFirmware(chain.commit,chain.size))
+        fuvrf = b''
+        if fu_vrf is not None:
+            assert self.M*DATA_WIDTH%8==0, "FUVRF addresses must have a whole number of bytes"
+            if DATA_TYPE=='fixed_point':
+                words = encodeArray(fu_vrf,DATA_WIDTH)
+            else:
+                words = np.asarray(fu_vrf).astype(np.int64) & ((1<<DATA_WIDTH)-1)
+            for row in np.asarray(words).reshape(-1,self.M):
+                packed = sum(int(word)<<(DATA_WIDTH*idx) for idx, word in enumerate(row))
+                fuvrf += packed.to_bytes(self.M*DATA_WIDTH//8,'big')
+        return {CONFIG_IDS['InputBuffer']: bytes([fw['valid_chains']]),
+                CONFIG_IDS['FilterReduceUnit']: bytes(fru)+fuvrf,
+                CONFIG_IDS['VectorVectorALU']: bytes(vvalu),
+                CONFIG_IDS['VectorScalarReduce']: bytes(table('vsru','op')),
+                CONFIG_IDS['DataPacker']: bytes(dp)}
+
+    # Encodes how many elements a chain commits to the data packer (3 means the chain does not commit)
+    def encodeDpFirmware(self,commit,size):
+        if commit==0:
+            return 3
+        elif size==1:
+            return 2
+        elif size==self.M:
+            return 1
+        elif size==self.N:
+            return 0
+        else:
+            assert False
+
     def __process_condition(self,condition):
         if condition=="last" or condition=="notlast" or condition=="first" or condition=="notfirst" or condition is None :
             return True
         else:
             assert False, "Condition not understood"
 
-    def __init__(self,N,M,MAX_CHAINS):
+    # The hardware runs an instruction when any of its conditions holds, while the emulator needs all of them to hold
+    # Both agree on a single condition, so an instruction cannot have a condition on both eof1 and eof2
+    def __process_conditions(self,condition1,condition2):
+        assert condition1 is None or condition2 is None, "Instructions support a single condition"
+        return self.__process_condition(condition1), self.__process_condition(condition2)
+
+    # TB_SIZE is only used to estimate when the trace buffer wraps around (see firmwareCost)
+    # If optimize is True, compile() reduces the number of chains of the firmware (see optimizeChains)
+    def __init__(self,N,M,MAX_CHAINS,TB_SIZE=None,optimize=False):
         self.N = N
         self.M = M
         self.MAX_CHAINS=MAX_CHAINS
+        self.TB_SIZE=TB_SIZE
+        self.optimize=optimize
+        self.reset()
+
+    # Clears the firmware being compiled, so that the same compiler can be used for another firmware
+    def reset(self):
+        self.unoptimized=None
         self.fu, self.mvru, self.vsru, self.vvalu, self.dp = [],[],[],[],[]
         self.firmware ={"fu":[],"mvru":[],"vsru":[],"vvalu":[],"dp":[],"valid_chains":0}
         self.chains_created = 0
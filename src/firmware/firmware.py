@@ -1,6 +1,18 @@
 # This files contains some of the different firmware that can be used by the HW and emulator
 
+# Firmware whose results can be computed on consecutive shards of an input stream declares how shard results are merged
+#   'concat': values committed for a vector only depend on that vector, so the results of each shard are concatenated
+#   'add': values are accumulated over each frame and committed at its last vector (eof1), so partial frames are added
+# Firmware that does not declare a merge rule (e.g. because it compares each vector with the previous one) cannot be sharded
+def mergeable(rule):
+    assert rule in ['concat','add'], "Unknown merge rule "+rule
+    def declare(fw_function):
+        fw_function.merge_rule=rule
+        return fw_function
+    return declare
+
 # Firmware for a distribution with multiple sets of N values
+@mergeable('add')
 def distribution(cp,bins,M):
     assert bins%M==0, "Number of bins must be divisible by M for now"
     for i in range(int(bins/M)):
@@ -14,6 +26,7 @@ def distribution(cp,bins,M):
     return cp.compile()
 
 # Summary statistics - Number of non-sparse elements
+@mergeable('add')
 def summaryStats(cp):
     # Remember to properly initialize fu.vrf
 
@@ -37,6 +50,7 @@ def summaryStats(cp):
     return cp.compile()
 
 # Calculate spatial sparsity
+@mergeable('concat')
 def spatialSparsity(cp,N):
     # Remember to properly initialize fu.vrf
     cp.begin_chain()
@@ -88,12 +102,14 @@ def correlation(cp):
     return cp.compile()
 
 # Check if previous vector changed
+@mergeable('concat')
 def passThrough(cp):
     cp.begin_chain()
     cp.end_chain()
     return cp.compile()
 
 # Sum all input values
+@mergeable('concat')
 def sumAll(cp):
     cp.begin_chain()
     cp.v_reduce()
@@ -102,6 +118,7 @@ def sumAll(cp):
     return cp.compile()
 
 # Raw values
+@mergeable('concat')
 def raw(cp):
     cp.begin_chain()
     cp.v_commit()
@@ -118,6 +135,7 @@ def vvalu_simple(cp):
     return cp.compile()
 
 # Simple test for fru
+@mergeable('concat')
 def fru_simple(cp):
     cp.begin_chain()
     cp.vv_filter(0)
@@ -127,6 +145,7 @@ def fru_simple(cp):
     return cp.compile()
 
 # Multiple Chains
+@mergeable('concat')
 def multipleChains(cp):
     cp.begin_chain()
     cp.vv_filter(0)
@@ -212,6 +231,7 @@ def activationPredictiveness(cp):
 # Norm Check
 # To get better results, use FRU_reconfig_vector to change FRU's filter values according to the range of the percentiles (currently done via UART as a proof-of-concept)
 # A single 64 bin distribution is used to get a proxy of the three percentiles, calculated offline.
+@mergeable('add')
 def normCheck(cp,M):
     bins=64
     assert bins%M==0, "Number of bins must be divisible by M"
@@ -0,0 +1,178 @@
+from misc.misc import *
+
+# Instructions that read and write VVVRF addresses (the address is always their first argument)
+VVVRF_READS=['vv_add','vv_mul','vv_sub','vv_max']
+VVVRF_WRITES=['v_cache']
+
+# Declarative layer on top of the compiler
+# Each statistic adds the chains that compute it, using symbolic VVVRF and FUVRF registers and the minicache. compile()
+# then allocates the registers, reusing VVVRF addresses whose live ranges do not overlap, and fails if the statistics
+# need more chains, VVVRF or FUVRF addresses than the hardware has. Chains assume the default order of building blocks.
+#   prog=statistics(proc.compiler,FUVRF_SIZE,VVVRF_SIZE)
+#   prog.histogram(0,4,2*M)
+#   prog.runningSum()
+#   proc.config(prog.compile())
+#   proc.fu.vrf=prog.fu_vrf
+class statistics():
+    def __init__(self,cp,FUVRF_SIZE,VVVRF_SIZE):
+        self.cp=cp
+        self.FUVRF_SIZE=FUVRF_SIZE
+        self.VVVRF_SIZE=VVVRF_SIZE
+        self.chains=[]
+        self.vvvrf=[]
+        self.fuvrf=[]
+        self.minicache=[]
+        self.outputs=[]
+        self.fu_vrf=None
+
+    ''' Symbolic registers '''
+    def __register(self,registers,name,content=None):
+        reg=struct(name=name,content=content,addr=None)
+        registers.append(reg)
+        return reg
+
+    # Adds a chain given as (instruction,args) pairs, where args may hold symbolic registers
+    # Chains that follow the previous one are kept right after it when compile() reorders the commits
+    def __chain(self,name,*instructions,follows=False):
+        self.chains.append(struct(name=name,instructions=list(instructions),follows=follows))
+
+    ''' Statistics '''
+    # Counts of values in each of bins ranges (low+i*width,low+(i+1)*width] over each frame (eof1)
+    def histogram(self,low,high,bins):
+        M=self.cp.M
+        assert bins%M==0, "Number of bins must be divisible by M"
+        ranges=self.__register(self.fuvrf,'histogram',(low,(high-low)/bins,bins//M))
+        for i in range(bins//M):
+            counts=self.__register(self.vvvrf,'histogram')
+            self.__chain('histogram',('vv_filter',(ranges,i)),('m_reduce',('M',)),('vv_add',(counts,'notfirst')),
+                         ('v_cache',(counts,)),('v_commit',(M,'last')))
+
+    # Sum of all values of each frame (eof1)
+    def runningSum(self):
+        acc=self.__register(self.vvvrf,'runningSum')
+        self.__chain('runningSum',('vv_add',(acc,'notfirst')),('v_cache',(acc,)),('v_reduce',()),('v_commit',(1,'last')))
+
+    # Element-wise maximum of the vectors of each frame (eof1)
+    def maxOverBatch(self):
+        acc=self.__register(self.vvvrf,'maxOverBatch')
+        self.__chain('maxOverBatch',('vv_max',(acc,'notfirst')),('v_cache',(acc,)),('v_commit',(self.cp.N,'last')))
+
+    # Dot product of each vector with the previous one
+    def dotWithPrevious(self):
+        previous=self.__register(self.vvvrf,'dotWithPrevious')
+        self.__chain('dotWithPrevious',('vv_mul',(previous,)),('v_reduce',()),('v_commit',(1,)))
+        self.__chain('dotWithPrevious',('v_cache',(previous,)),follows=True)
+
+    # Sum of the squares of each vector
+    def sumOfSquares(self):
+        x=self.__register(self.vvvrf,'sumOfSquares')
+        self.__chain('sumOfSquares',('v_cache',(x,)))
+        self.__chain('sumOfSquares',('vv_mul',(x,)),('v_reduce',()),('v_commit',(1,)),follows=True)
+
+    # Squared distance between each vector and the previous one
+    # The difference is passed to the last chain through both a VVVRF address and the minicache, so that it can be squared
+    def distanceToPrevious(self):
+        previous=self.__register(self.vvvrf,'distanceToPrevious')
+        diff=self.__register(self.vvvrf,'distanceToPrevious')
+        mc=self.__register(self.minicache,'distanceToPrevious')
+        self.__chain('distanceToPrevious',('vv_sub',(previous,)),('v_cache',(diff,)),('v_mc_save',(mc,)))
+        self.__chain('distanceToPrevious',('v_cache',(previous,)),follows=True)
+        self.__chain('distanceToPrevious',('v_mc_load',(mc,)),('vv_mul',(diff,)),('v_reduce',()),('v_commit',(1,)),follows=True)
+
+    ''' Register allocation '''
+    # Chains in which a register holds a value that will still be read
+    # A value read before it is written in a chain comes from the previous vector, so it is live across vectors
+    def liveRange(self,reg,reads,writes):
+        accesses=lambda names: [c for c, chain in enumerate(self.chains) for ins, args in chain.instructions if ins in names and args and args[0] is reg]
+        r_chains, w_chains = accesses(reads), accesses(writes)
+        assert w_chains, "Register of "+reg.name+" is never written"
+        live=set(w_chains)
+        for r in r_chains:
+            before=[w for w in w_chains if w<r]
+            if before:
+                live.update(range(max(before),r+1))
+            else:
+                live.update(range(max(w_chains),len(self.chains)))
+                live.update(range(r+1))
+        return live
+
+    # Assigns to each register the lowest address not used by a register that is live at the same time
+    def allocate(self,registers,size,reads,writes,resource):
+        assigned=[]
+        for reg in registers:
+            live=self.liveRange(reg,reads,writes)
+            addr=0
+            while any(other.addr==addr and live&other_live for other, other_live in assigned):
+                addr+=1
+            assert addr<size, "Statistics need more than "+str(size)+" "+resource+" (failed to allocate "+reg.name+")"
+            reg.addr=addr
+            assigned.append((reg,live))
+
+    # A commit that does not fit in the data packer is lost. Commits of 1, M or N values never straddle a row if they start
+    # at a multiple of their size, so chains are ordered by commit size (largest first) and the commits that fire together
+    # are widened to the next size until their values fill whole rows of the largest size. Returns the chains in the
+    # new order and the number of values each of them commits.
+    def packCommits(self):
+        cp=self.cp
+        blocks=[]
+        for chain in self.chains:
+            if chain.follows and blocks:
+                blocks[-1].append(chain)
+            else:
+                blocks.append([chain])
+        commits=[[args for chain in block for ins, args in chain.instructions if ins=='v_commit'] for block in blocks]
+        assert all(len(c)<=1 for c in commits), "Chains that follow each other can only commit once"
+        width=[c[0][0] if c else 0 for c in commits]
+        largest=max(width,default=0)
+        sizes=[size for size in sorted({1,cp.M,cp.N}) if size<=largest]
+        for conditions in dict.fromkeys(tuple(c[0][1:]) for c in commits if c):
+            group=[b for b, c in enumerate(commits) if c and tuple(c[0][1:])==conditions]
+            for size, next_size in zip(sizes,sizes[1:]):
+                assert next_size%size==0, "Commit sizes must divide each other"
+                members=[b for b in group if width[b]==size]
+                for b in members[len(members)-len(members)%(next_size//size):]:
+                    width[b]=next_size
+        order=sorted(range(len(blocks)),key=lambda b: -width[b])
+        return [chain for b in order for chain in blocks[b]], [width[b] for b in order for chain in blocks[b]]
+
+    def compile(self):
+        cp=self.cp
+        assert len(self.chains)+cp.chains_created<=cp.MAX_CHAINS, "Statistics need "+str(len(self.chains))+" chains, but only "+str(cp.MAX_CHAINS-cp.chains_created)+" are available"
+        self.chains, widths = self.packCommits()
+
+        # VVVRF addresses are reused when live ranges do not overlap
+        self.allocate(self.vvvrf,self.VVVRF_SIZE,VVVRF_READS,VVVRF_WRITES,'VVVRF addresses')
+        self.allocate(self.minicache,1,['v_mc_load'],['v_mc_save'],'minicaches')
+
+        # Identical histograms share their FUVRF addresses
+        # The emulator takes the upper limit of the last range of an address from the next address, so a histogram that is
+        # followed by another one needs an address that continues its ranges (unless the next histogram continues them)
+        contents=list(dict.fromkeys(reg.content for reg in self.fuvrf))
+        self.fu_vrf=np.zeros(self.FUVRF_SIZE*cp.M)
+        addr=0
+        for i, (low, width, rows) in enumerate(contents):
+            assert addr+rows<=self.FUVRF_SIZE, "Statistics need more than "+str(self.FUVRF_SIZE)+" FUVRF addresses"
+            limits=low+width*np.arange(min(rows+1,self.FUVRF_SIZE-addr)*cp.M)
+            self.fu_vrf[addr*cp.M:addr*cp.M+len(limits)]=limits
+            for reg in self.fuvrf:
+                if reg.content==(low,width,rows):
+                    reg.addr=addr
+            addr+=rows
+            if i+1<len(contents) and contents[i+1][:2]!=(low+width*rows*cp.M,width):
+                addr+=1
+
+        # Widened commits are zero padded, since the reduce units pad their results with zeros
+        self.outputs=[]
+        for chain, commit_width in zip(self.chains,widths):
+            cp.begin_chain()
+            for ins, args in chain.instructions:
+                if ins=='v_commit':
+                    self.outputs.append(struct(name=chain.name,values=args[0],size=commit_width,conditions=args[1:]))
+                    args=(commit_width,)+args[1:]
+                if ins in ['v_mc_load','v_mc_save']:
+                    args=()
+                if ins=='vv_filter':
+                    args=(args[0].addr+args[1],)
+                getattr(cp,ins)(*[arg.addr if isinstance(arg,struct) else arg for arg in args])
+            cp.end_chain()
+        return cp.compile()
@@ -0,0 +1,87 @@
+import numpy as np
+from firmware.compiler import encodeCond
+from emulator.emulator import CONDITION_FAILS
+from misc.misc import *
+
+# Returns a raw trace dump as an array of rows of N words without reading it into memory
+# .npy files are memory-mapped with their own dtype, and other files are read as raw words of the given dtype
+def loadTrace(path,N,dtype=np.float64):
+    if str(path).endswith('.npy'):
+        return np.load(path,mmap_mode='r').reshape(-1,N)
+    return np.memmap(path,dtype=dtype,mode='r').reshape(-1,N)
+
+# Maps the rows of a trace buffer dump back to the values committed by each chain of a firmware
+# Chains are named by the order in which they commit (chain0, chain1, ...) unless names are given for the chains that
+# commit. Chains with the same name must commit at the same vectors, and their values are concatenated (for example,
+# the M bins committed by each chain of a distribution).
+#   decoder=traceDecoder(fw,N,names=['histogram']*2)
+#   results=decoder.decode(proc.tb.mem,eof1,eof2,tb_size=proc.tb.size)
+#   results['histogram'] holds the bins of each frame, and decoder.vectors['histogram'] the last vector of each frame
+class traceDecoder():
+    def __init__(self,fw,N,names=None):
+        self.N=N
+        self.chains=[c for c in range(fw['valid_chains']) if fw['dp'][c].commit]
+        self.sizes=np.array([fw['dp'][c].size for c in self.chains],dtype=np.int64)
+        self.masks=np.array([encodeCond(fw['dp'][c].cond1,fw['dp'][c].cond2) for c in self.chains],dtype=np.int64)
+        self.names=['chain'+str(c) for c in range(len(self.chains))] if names is None else list(names)
+        assert len(self.names)==len(self.chains), "Firmware has "+str(len(self.chains))+" chains that commit, but "+str(len(self.names))+" names were given"
+        self.vectors={}
+
+    # Returns which chains commit at each input vector and the position of their values in the stream sent to the trace buffer
+    # The beginning of frame of the first vector is set by bof (the processor starts with both frames beginning)
+    def schedule(self,eof1,eof2=None,bof=3):
+        eof1=np.asarray(eof1,dtype=bool)
+        eof2=np.zeros(len(eof1),dtype=bool) if eof2 is None else np.broadcast_to(np.asarray(eof2,dtype=bool),eof1.shape)
+        eof=eof1.astype(np.int64) | eof2.astype(np.int64)<<1
+        prev=np.empty_like(eof)
+        prev[:1], prev[1:] = bof, eof[:-1]
+        fails=np.array(CONDITION_FAILS)[eof | prev<<2]
+        committed=(fails[:,None] & self.masks[None,:])==0
+        sizes=(committed*self.sizes).ravel()
+        offsets=(np.cumsum(sizes)-sizes).reshape(committed.shape)
+        return committed, offsets
+
+    # Decodes a trace buffer dump given the eof flags of every vector pushed since the processor was configured
+    # trace holds the TB_SIZE rows of the trace buffer, as an array, a memory-mapped file or the strings of the RTL dump
+    # (results['tb']['mem_data']). The RTL dump holds unsigned DATA_WIDTH-bit words, which are converted to signed
+    # integers or to floats depending on DATA_TYPE ('int' or 'fixed_point'). tb_size is the number of rows written, which
+    # is derived from the eof flags if not given. Once the trace buffer wraps around, only values in rows that were not
+    # overwritten are returned
+    def decode(self,trace,eof1,eof2=None,tb_size=None,bof=3,DATA_WIDTH=32,DATA_TYPE='fixed_point'):
+        N=self.N
+        trace=np.asarray(trace) if not isinstance(trace,np.ndarray) else trace
+        if trace.dtype.kind in 'US':
+            assert DATA_TYPE in ['int','fixed_point'], "Unknown data type "+str(DATA_TYPE)
+            convert=(lambda w: toSigned(w,DATA_WIDTH)) if DATA_TYPE=='int' else (lambda w: decodeArray(w,DATA_WIDTH))
+        else:
+            convert=lambda w: w
+        TB_SIZE=len(trace)
+        words=trace.reshape(-1)
+        committed, offsets = self.schedule(eof1,eof2,bof)
+
+        # A commit that does not fit in the data packer leaves it stuck, so no value is stored from then on
+        commit_end=np.where(committed,offsets+self.sizes,0)
+        overflow=committed & (offsets%N+self.sizes>N)
+        stuck_at=offsets[overflow].min() if overflow.any() else None
+        total=int(commit_end.max()) if committed.any() else 0
+        rows=(total if stuck_at is None else int(stuck_at))//N
+
+        # Rows written so far, of which only the last TB_SIZE are kept
+        if tb_size is not None:
+            assert rows%TB_SIZE==tb_size%TB_SIZE, "eof flags do not match the number of rows written to the trace buffer"
+        first=max(0,rows-TB_SIZE)*N
+        kept=committed & (offsets>=first) & (commit_end<=rows*N)
+
+        results={}
+        self.vectors={}
+        for name in dict.fromkeys(self.names):
+            chains=[i for i, n in enumerate(self.names) if n==name]
+            assert all(np.array_equal(committed[:,i],committed[:,chains[0]]) for i in chains), "Chains named "+name+" do not commit at the same vectors"
+            vectors=np.nonzero(np.all(kept[:,chains],axis=1))[0]
+            values=[]
+            for i in chains:
+                positions=offsets[vectors,i][:,None]+np.arange(self.sizes[i])
+                values.append(convert(words[(positions//N)%TB_SIZE*N+positions%N]))
+            results[name]=np.concatenate(values,axis=1)
+            self.vectors[name]=vectors
+        return results
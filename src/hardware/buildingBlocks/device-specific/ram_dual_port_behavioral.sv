@@ -0,0 +1,97 @@
+//-----------------------------------------------------
+// Design Name : Ram Dual Port
+// Function    : Behavioral dual port ram for simulators without the Intel primitives
+//               Reads are registered and return the old data on read-during-write, like the
+//               altsyncram configuration of the device-specific rams. Memories are initialized
+//               from init_file with ".hex" appended (written next to each .mif file).
+//-----------------------------------------------------
+
+module ram_dual_port
+(
+  clk,
+  clken,
+  address_a,
+  address_b,
+  q_a,
+  q_b,
+  wren_a,
+  wren_b,
+  data_a,
+  data_b,
+  byteena_a,
+  byteena_b
+);
+
+parameter  width_a = 1'd0;
+parameter  width_b = 1'd0;
+parameter  widthad_a = 1'd0;
+parameter  widthad_b = 1'd0;
+parameter  numwords_a = 1'd0;
+parameter  numwords_b = 1'd0;
+parameter  latency = 1'd1;
+parameter  init_file = "UNUSED";
+parameter  width_be_a = 1'd0;
+parameter  width_be_b = 1'd0;
+
+input  clk;
+input  clken;
+input [(widthad_a-1):0] address_a;
+input [(widthad_b-1):0] address_b;
+output [(width_a-1):0] q_a;
+output [(width_b-1):0] q_b;
+input  wren_a;
+input  wren_b;
+input [(width_a-1):0] data_a;
+input [(width_b-1):0] data_b;
+input [width_be_a-1:0] byteena_a;
+input [width_be_b-1:0] byteena_b;
+reg [(width_a-1):0] q_a_wire;
+reg [(width_b-1):0] q_b_wire;
+
+  reg [(width_a-1):0] mem [0:numwords_a-1];
+
+  integer i;
+  initial begin
+    for (i = 0; i < numwords_a; i=i+1)
+      mem[i] = 0;
+    if (init_file != "UNUSED")
+      $readmemh({init_file,".hex"}, mem);
+    q_a_wire = 0;
+    q_b_wire = 0;
+  end
+
+  always @(posedge clk)
+  if (clken)
+  begin
+     q_a_wire <= mem[address_a];
+     q_b_wire <= mem[address_b];
+     if (wren_a && byteena_a)
+         mem[address_a] <= data_a;
+     if (wren_b && byteena_b)
+         mem[address_b] <= data_b;
+  end
+
+
+  integer j;
+  reg [(width_a-1):0] q_a_reg[latency:1], q_b_reg[latency:1];
+
+  always @(*)
+  begin
+     q_a_reg[1] <= q_a_wire;
+     q_b_reg[1] <= q_b_wire;
+  end
+
+  always @(posedge clk)
+  if (clken)
+  begin
+     for (j = 1; j < latency; j=j+1)
+     begin
+         q_a_reg[j+1] <= q_a_reg[j];
+         q_b_reg[j+1] <= q_b_reg[j];
+     end
+  end
+
+  assign q_a = (clken) ? q_a_reg[latency] : 0;
+  assign q_b = (clken) ? q_b_reg[latency] : 0;
+
+endmodule
@@ -1,11 +1,11 @@
 import logging as log
-import sys, math, os, shutil, textwrap, subprocess,shlex
+import sys, math, os, shutil, textwrap, subprocess, shlex, tempfile, inspect, multiprocessing
 from distutils.dir_util import copy_tree
 from shutil import copyfile
-from firmware.compiler import compiler
+from firmware.compiler import compiler, encodeCond, fullUpload
 from misc.misc import *
 import numpy as np
-from containers.modelsim.modelsimContainer import modelsimContainer
+from containers.modelsim.modelsimContainer import modelsimContainer, modelsimSession
 import time
 
 # Setting Debug level (can be debug, info, warning, error and critical)
@@ -24,6 +24,71 @@ def run(cmd,wait=True):
     result = proc.stdout.readlines()+proc.stderr.readlines()
     [ print(r.decode("utf-8"), end = '') for r in result]
 
+''' Simulator backends '''
+# A backend compiles the generated RTL folder and runs its testbench, which writes simulation_results.bin and
+# simulation_results_tb.txt. Backends have the interface of modelsimSession (compile, simulate, fetch, open and close),
+# and vendor_rams tells whether they simulate the Intel RAM primitives or need the behavioral ram_dual_port model
+
+# Open-source simulator installed on the host, which works directly on the RTL folder
+class localSimulator():
+    vendor_rams=False
+
+    def exec(self,cmd):
+        proc = subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE,cwd=self.folder)
+        proc.wait()
+        result = proc.stdout.readlines()+proc.stderr.readlines()
+        if self.log:
+            [ print(r.decode("utf-8"), end = '') for r in result]
+        assert proc.returncode==0, cmd[0]+" failed with return code "+str(proc.returncode)
+        return result
+
+    def compile(self,folder,top='testbench.sv'):
+        self.folder=folder
+        self.exec(self.compile_cmd(top))
+
+    def simulate(self,top='testbench',gui=False,plusargs=()):
+        assert not gui, "Only ModelSim supports the GUI"
+        self.exec(self.simulate_cmd(top)+list(plusargs))
+
+    # Results are already in the RTL folder
+    def fetch(self,names,folder):
+        pass
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        pass
+
+    # Local simulators work on the RTL folder of each run, so they take no working directory or container
+    def __init__(self,log=True,workdir=None,stop=True,container=None):
+        self.log=log
+        self.folder=None
+
+# Icarus Verilog
+class icarusSimulator(localSimulator):
+    def compile_cmd(self,top):
+        return ['iverilog','-g2012','-o','testbench.vvp','-s',top.split('.')[0],top]
+
+    def simulate_cmd(self,top):
+        return ['vvp','-n','testbench.vvp']
+
+# Verilator, which compiles the testbench into an executable (much faster than event-driven simulators for long traces)
+class verilatorSimulator(localSimulator):
+    def compile_cmd(self,top):
+        return ['verilator','--binary','--timing','-j','0','-Wno-fatal','--top-module',top.split('.')[0],'--Mdir','obj_dir','-o','testbench',top]
+
+    def simulate_cmd(self,top):
+        return ['obj_dir/testbench']
+
+SIMULATORS={'modelsim':lambda log, container='modelsim', **kwargs: modelsimSession(modelsimContainer(log,container),**kwargs), 'icarus':icarusSimulator, 'verilator':verilatorSimulator}
+
 class rtlHw():
 
     # This class describes an instantiated rtlModule
@@ -145,7 +210,8 @@ class rtlHw():
             self.inst.__dict__[instance_name]=self.parent.rtlInstance(module_class,instance_name)
 
         # Dump RTL class into readable RTL
-        def dump(self):
+        # Memory initialization files are written to mif_folder
+        def dump(self,mif_folder="rtl"):
 
             # Append with identation (apdi is apd shifted)
             ident=self.getDepth()*"    "
@@ -162,7 +228,7 @@ class rtlHw():
             def dumpMifFile(mem):
                 for mem_name in mem.keys():
                     m=mem[mem_name]
-                    f = open(f"rtl/{mem_name}.mif", "w")
+                    f = open(f"{mif_folder}/{mem_name}.mif", "w")
                     f.write(f"Depth = {m['depth']};\n")
                     f.write(f"Width = {m['width']};\n")
                     f.write("Address_radix = dec;\n")
@@ -186,6 +252,20 @@ class rtlHw():
                     f.write("End;")
                     f.close()
 
+                    # Same contents in the $readmemh format read by the behavioral ram
+                    f = open(f"{mif_folder}/{mem_name}.mif.hex", "w")
+                    for i in range(m['depth']):
+                        value=0
+                        if m['init_values']!=False:
+                            if m['packed_elements']!=False:
+                                element_width = int(m['width']/m['packed_elements'])
+                                for idx, val in enumerate(m['init_values'][i]):
+                                    value=value | (int(val)&(2**element_width-1))<<(element_width*idx)
+                            else:
+                                value=int(m['init_values'][i])
+                        f.write(f"{value&(2**m['width']-1):x}\n")
+                    f.close()
+
             # Add includes
             if self.includes!=[]:
                 for i in self.includes:
@@ -212,7 +292,7 @@ class rtlHw():
                 for m in self.mod.__dict__.keys():
                     mod=self.mod.__dict__[m]
                     if mod.included==False:
-                        rtlCode=rtlCode+mod.dump()
+                        rtlCode=rtlCode+mod.dump(mif_folder)
 
                 # Create mif file and output wires
                 for i in self.inst.__dict__.keys():
@@ -509,68 +589,21 @@ class rtlHw():
         top = self.top
 
         # Convert FW to RTL
-        EMPTY_FIRMWARE= "'{MAX_CHAINS{0}}"
-        if self.firmware is None:
-            IB_INITIAL_FIRMWARE=0
-            VSRU_INITIAL_FIRMWARE = EMPTY_FIRMWARE
-            DP_INITIAL_FIRMWARE = EMPTY_FIRMWARE
-            VVALU_INITIAL_FIRMWARE_OP = EMPTY_FIRMWARE
-            VVALU_INITIAL_FIRMWARE_ADDR_RD = EMPTY_FIRMWARE
-            VVALU_INITIAL_FIRMWARE_COND = EMPTY_FIRMWARE
-            VVALU_INITIAL_FIRMWARE_CACHE = EMPTY_FIRMWARE
-            VVALU_INITIAL_FIRMWARE_CACHE_ADDR = EMPTY_FIRMWARE
-            VVALU_INITIAL_FIRMWARE_MINICACHE = EMPTY_FIRMWARE
-            VVALU_INITIAL_FIRMWARE_CACHE_COND = EMPTY_FIRMWARE
-            FRU_INITIAL_FIRMWARE_OP = EMPTY_FIRMWARE
-            FRU_INITIAL_FIRMWARE_ADDR = EMPTY_FIRMWARE
-            FRU_INITIAL_FIRMWARE_REDUCE_AXIS = EMPTY_FIRMWARE
-            DP_INITIAL_FIRMWARE_COND = EMPTY_FIRMWARE
-        else:
-            
-            def encodeDpFirmware(commit,size):
-                if commit==0:
-                    return 3
-                elif size==1:
-                    return 2
-                elif size==self.M:
-                    return 1
-                elif size==self.N:
-                    return 0
-                else:
-                    assert False
-            def encodeCond(cond1,cond2):
-                if cond1['last']:
-                    return 1
-                elif cond1['notlast']:
-                    return 2
-                elif cond1['first']:
-                    return 4
-                elif cond1['notfirst']:
-                    return 8
-                elif cond2['last']:
-                    return 16
-                elif cond2['notlast']:
-                    return 32
-                elif cond2['first']:
-                    return 64
-                elif cond2['notfirst']:
-                    return 128
-                else:
-                    return 0
-            VSRU_INITIAL_FIRMWARE=str([chain.op for chain in self.firmware['vsru']]).replace("[", "'{").replace("]", "}")
-            DP_INITIAL_FIRMWARE = str([encodeDpFirmware(chain.commit,chain.size) for chain in self.firmware['dp']]).replace("[", "'{").replace("]", "}")
-            VVALU_INITIAL_FIRMWARE_OP=str([chain.op for chain in self.firmware['vvalu']]).replace("[", "'{").replace("]", "}")
-            VVALU_INITIAL_FIRMWARE_ADDR_RD=str([chain.addr for chain in self.firmware['vvalu']]).replace("[", "'{").replace("]", "}")
-            VVALU_INITIAL_FIRMWARE_COND=str([encodeCond(chain.cond1,chain.cond2) for chain in self.firmware['vvalu']]).replace("[", "'{").replace("]", "}")
-            VVALU_INITIAL_FIRMWARE_CACHE=str([chain.cache for chain in self.firmware['vvalu']]).replace("[", "'{").replace("]", "}")
-            VVALU_INITIAL_FIRMWARE_CACHE_ADDR=str([chain.cache_addr for chain in self.firmware['vvalu']]).replace("[", "'{").replace("]", "}")
-            VVALU_INITIAL_FIRMWARE_MINICACHE=str([chain.minicache for chain in self.firmware['vvalu']]).replace("[", "'{").replace("]", "}")
-            VVALU_INITIAL_FIRMWARE_CACHE_COND=str([encodeCond(chain.cache_cond1,chain.cache_cond2) for chain in self.firmware['vvalu']]).replace("[", "'{").replace("]", "}")
-            FRU_INITIAL_FIRMWARE_OP=str([chain.filter for chain in self.firmware['fu']]).replace("[", "'{").replace("]", "}")
-            FRU_INITIAL_FIRMWARE_ADDR=str([chain.addr for chain in self.firmware['fu']]).replace("[", "'{").replace("]", "}")
-            FRU_INITIAL_FIRMWARE_REDUCE_AXIS=str([chain.axis for chain in self.firmware['mvru']]).replace("[", "'{").replace("]", "}")
-            IB_INITIAL_FIRMWARE=self.firmware['valid_chains']
-            DP_INITIAL_FIRMWARE_COND = str([encodeCond(chain.cond1,chain.cond2) for chain in self.firmware['dp']]).replace("[", "'{").replace("]", "}")
+        rtl_fw = self.compiler.rtlFirmware(self.firmware)
+        IB_INITIAL_FIRMWARE = rtl_fw['IB']
+        VSRU_INITIAL_FIRMWARE = rtl_fw['VSRU']
+        DP_INITIAL_FIRMWARE = rtl_fw['DP']
+        VVALU_INITIAL_FIRMWARE_OP = rtl_fw['VVALU_OP']
+        VVALU_INITIAL_FIRMWARE_ADDR_RD = rtl_fw['VVALU_ADDR_RD']
+        VVALU_INITIAL_FIRMWARE_COND = rtl_fw['VVALU_COND']
+        VVALU_INITIAL_FIRMWARE_CACHE = rtl_fw['VVALU_CACHE']
+        VVALU_INITIAL_FIRMWARE_CACHE_ADDR = rtl_fw['VVALU_CACHE_ADDR']
+        VVALU_INITIAL_FIRMWARE_MINICACHE = rtl_fw['VVALU_MINICACHE']
+        VVALU_INITIAL_FIRMWARE_CACHE_COND = rtl_fw['VVALU_CACHE_COND']
+        FRU_INITIAL_FIRMWARE_OP = rtl_fw['FRU_OP']
+        FRU_INITIAL_FIRMWARE_ADDR = rtl_fw['FRU_ADDR']
+        FRU_INITIAL_FIRMWARE_REDUCE_AXIS = rtl_fw['FRU_REDUCE_AXIS']
+        DP_INITIAL_FIRMWARE_COND = rtl_fw['DP_COND']
 
         # Instantiate modules
         top.instantiateModule(top.mod.uart,"comm")
@@ -692,60 +725,65 @@ class rtlHw():
         top.output_assignment={'vector_out': 'vector_out_tb','uart_txd':'uart_txd_comm'}
 
 
-    def testbench(self):
-        # Prepare testbench inputs
-        tb_inputs=[]
-        for i, inp in enumerate(self.testbench_inputs):
-            tb_inputs.append("valid = 1;")
-            tb_inputs.append(f"eof[0] = {int(inp[1])};")
-            if len(inp)>2:
-                tb_inputs.append(f"eof[1] = {int(inp[2])};")
-            else:
-                tb_inputs.append(f"eof[1] = 0;")
+    # Selects what the testbench dumps on each cycle: the outputs of the given instances (e.g. ['ib','dp']) named in
+    # signals (e.g. ['valid_out','vector_out']), from cycle first to cycle last of cycles=(first,last). None selects
+    # everything. The cycle window is passed to the simulation as plusargs, so changing it does not change the testbench
+    def probe(self,instances=None,signals=None,cycles=None):
+        self.probes=struct(instances=instances,signals=signals,cycles=cycles)
+
+    # Number of bits or elements of a port declared with a parameter (e.g. DATA_WIDTH or $clog2(TB_SIZE))
+    def portSize(self,size):
+        if isinstance(size,int):
+            return size
+        if size.startswith('$clog2('):
+            return math.ceil(math.log2(getattr(self,size[len('$clog2('):-1])))
+        return int(size) if size.isnumeric() else getattr(self,size)
+
+    # Stimulus read by the testbench, with one line per input vector holding its eof flags and its packed elements in hex
+    def stimulus(self):
+        lines=[]
+        for inp in self.testbench_inputs:
+            eof=int(inp[1]) | (int(inp[2]) if len(inp)>2 else 0)<<1
+            packed=0
             for idx,ele in enumerate(inp[0]):
-                tb_inputs.append(f"vector[{idx}]=32'd{ele};")
-            tb_inputs.append("#half_period;")
-            tb_inputs.append("#half_period;")
-            if i!=0:
-                tb_inputs.append("toFile();")  
-            tb_inputs.append("")
-        tb_inputs=("\n"+"    "*4).join(tb_inputs)
-
-        # Prepare testbench steps
-        tb_steps=[]
-        for i in range(self.steps-len(self.testbench_inputs)+1):
-            tb_steps.append("valid = 0;")
-            tb_steps.append("#half_period;")
-            tb_steps.append("#half_period;")
-            tb_steps.append("toFile();")
-            tb_steps.append("")
-        tb_steps=("\n"+"    "*4).join(tb_steps)
-
-        # Prepare testbench values to save to file
+                packed=packed | (int(ele)&(2**self.DATA_WIDTH-1))<<(self.DATA_WIDTH*idx)
+            lines.append(f"{eof:x} {packed:0{self.DATA_WIDTH*self.N//4}x}")
+        return lines
+
+    # The testbench reads its inputs from stimulus.hex and the number of steps from the STEPS plusarg, so it does not
+    # change with the inputs and only needs to be compiled again when the hardware changes
+    def testbench(self,vendor_rams=True):
+        # Prepare testbench values to save to file (the probed signals of each instance, see probe)
         tb_store=[]
         tb_var_names={}
         for i in self.top.inst.__dict__.keys():
             inst=self.top.inst.__dict__[i]
-            tb_var_names[inst.name]=[]
+            if self.probes.instances is not None and inst.name not in self.probes.instances:
+                continue
             for o in inst.module_output:
-                tb_var_names[inst.name].append([o.name,o.elements])
+                if self.probes.signals is not None and o.name not in self.probes.signals:
+                    continue
+                tb_var_names.setdefault(inst.name,[]).append([o.name,self.portSize(o.elements),self.portSize(o.bits)])
                 if o.elements==1:
-                    tb_store.append(f'$fwrite(write_data, "%{"b" if o.bits==1 else "0d"} ",dbg.{inst.name}.{o.name});')
+                    tb_store.append(f'$fwrite(write_data, "%u", dbg.{inst.name}.{o.name});')
                 else:
                     if not o.elements.isnumeric():
                         tb_store.append(f"for (i=0; i<dbg.{inst.name}.{o.elements}; i=i+1) begin")
                     else:
                         tb_store.append(f"for (i=0; i<{o.elements}; i=i+1) begin")
-                    tb_store.append(f'\t$fwrite(write_data, "%{"b" if o.bits==1 else "0d"} ",dbg.{inst.name}.{o.name}[i]);')
+                    tb_store.append(f'\t$fwrite(write_data, "%u", dbg.{inst.name}.{o.name}[i]);')
                     tb_store.append("end")
-        tb_store.append('$fdisplay(write_data,"");')
-        tb_store=("\n"+"    "*4).join(tb_store)
+        for name in [] if self.probes.instances is None else self.probes.instances:
+            assert name in tb_var_names, "No probed signals in instance "+name
+        tb_store=("\n"+"    "*5).join(tb_store)
 
         # Add includes
         testbench='`include "debugProcessor.sv"\n'
 
         # Change altsyncram path depending on device family
-        if self.DEVICE_FAM == "Cyclone V":
+        if not vendor_rams:
+            altsyncram_data_path = "mem"
+        elif self.DEVICE_FAM == "Cyclone V":
             altsyncram_data_path = "altsyncram_component.altera_syncram_inst.mem_data"
         elif self.DEVICE_FAM == "Stratix 10":
             #altsyncram_data_path = "altsyncram_component.mem_data"
@@ -813,22 +851,53 @@ class rtlHw():
               .uart_txd(uart_txd)
             );
 
-            //Task to print all content to file
+            //Task to write the probed signals of the cycles in the window to file
             integer write_data,write_data2,i,j;
+            integer sample=0, first_cycle, last_cycle;
             task toFile;
                 begin
-                {tb_store}
+                if (sample>=first_cycle && sample<=last_cycle) begin
+                    {tb_store}
+                end
+                sample = sample+1;
                 end
             endtask
 
             // Test
+            integer stimulus, steps, inputs, step;
+            reg [1:0] eof_in;
+            reg [DATA_WIDTH*N-1:0] packed_in;
             initial begin
-                write_data = $fopen("simulation_results.txt");
-                
+                write_data = $fopen("simulation_results.bin", "wb");
+                if (!$value$plusargs("STEPS=%d", steps))
+                    steps = 0;
+                if (!$value$plusargs("FIRST_CYCLE=%d", first_cycle))
+                    first_cycle = 0;
+                if (!$value$plusargs("LAST_CYCLE=%d", last_cycle))
+                    last_cycle = steps;
+
                 $display("Test Started");
-                {tb_inputs}
-                
-                {tb_steps}
+                inputs = 0;
+                stimulus = $fopen("stimulus.hex", "r");
+                while ($fscanf(stimulus, "%h %h\\n", eof_in, packed_in) == 2) begin
+                    valid = 1;
+                    eof = eof_in;
+                    for (j=0; j<N; j=j+1)
+                        vector[j] = packed_in[DATA_WIDTH*j+:DATA_WIDTH];
+                    #half_period;
+                    #half_period;
+                    if (inputs!=0)
+                        toFile();
+                    inputs = inputs+1;
+                end
+                $fclose(stimulus);
+
+                valid = 0;
+                for (step=0; step<steps-inputs+1; step=step+1) begin
+                    #half_period;
+                    #half_period;
+                    toFile();
+                end
                 
                 $fclose(write_data);
                 write_data2 = $fopen("simulation_results_tb.txt");
@@ -851,15 +920,18 @@ class rtlHw():
         self.tb_var_names=tb_var_names
         return testbench
 
-    def generateRtl(self):
+    # Without vendor_rams, a behavioral model of ram_dual_port is used instead of the Intel RAM primitives
+    # All files are generated in rtl_folder, which is replaced if it exists
+    def generateRtl(self,rtl_folder,vendor_rams=True):
 
-        # Create subfolder where all files will be generated
-        rtl_folder=os.getcwd()+"/rtl"
+        # Create folder where all files will be generated
         if os.path.isdir(rtl_folder):
             shutil.rmtree(rtl_folder)
         os.mkdir(rtl_folder)
         copy_tree(self.hwFolder+"/buildingBlocks/general", rtl_folder)
-        if self.DEVICE_FAM == "Cyclone V":
+        if not vendor_rams:
+            copyfile(self.hwFolder+"/buildingBlocks/device-specific/ram_dual_port_behavioral.sv", rtl_folder+"/ram_dual_port.sv")
+        elif self.DEVICE_FAM == "Cyclone V":
             copyfile(self.hwFolder+"/buildingBlocks/device-specific/ram_dual_port_cycloneV.sv", rtl_folder+"/ram_dual_port.sv")
         elif self.DEVICE_FAM == "Stratix 10":
             copyfile(self.hwFolder+"/buildingBlocks/device-specific/ram_dual_port_stratix10.sv", rtl_folder+"/ram_dual_port.sv")
@@ -870,13 +942,19 @@ class rtlHw():
         # Writes debugProcessor to file
         f = open(rtl_folder+"/debugProcessor.sv", "w")
         self.rtlLogicConfig()
-        for l in self.top.dump():
+        for l in self.top.dump(rtl_folder):
             f.write(l+"\n")
         f.close()
 
         # Writes testbench to file
         f = open(rtl_folder+"/testbench.sv", "w")
-        for l in self.testbench():
+        for l in self.testbench(vendor_rams):
+            f.write(l+"\n")
+        f.close()
+
+        # Writes stimulus to file
+        f = open(rtl_folder+"/stimulus.hex", "w")
+        for l in self.stimulus():
             f.write(l+"\n")
         f.close()
 
@@ -884,65 +962,83 @@ class rtlHw():
         #Configure processor
         self.firmware=fw
 
-    # This will run the testbench of the generated hardware and return its results
-    def run(self,steps=50,gui=False,log=True):
-        # First, generate the RTL
-        self.steps=steps
-        self.generateRtl()
-
-        # Then, run simulation
-        current_folder=os.getcwd()
-        rtl_folder=current_folder+"/rtl/"
-        os.chdir(rtl_folder)
-
-        modelsim = modelsimContainer(log)
-        modelsim.start()
-        modelsim.exec('mkdir rtl')
-        modelsim.copy(rtl_folder,'modelsim:.')
-        modelsim.exec('vlib work',working_directory='/rtl')
-        modelsim.exec('vlog altera_mf.v altera_lnsim.sv testbench.sv',working_directory='/rtl')
-        if gui:
-            if sys.platform=="darwin":
-                print("Opening GUI\n\tMake sure to open socket using this command on your mac:\n\tsocat TCP-LISTEN:6000,reuseaddr,fork UNIX-CLIENT:\\\"$DISPLAY\\\"")
-            elif sys.platform=="linux":
-                print("Opening GUI, Linux detected\n\tMake sure to run this command:\n\txhost local:`whoami`")
-                modelsim.exec('vsim -gui -do "run -all" testbench',working_directory='/rtl')
-        else:
-            modelsim.exec('vsim -c -do "run -all" testbench',working_directory='/rtl')
-        modelsim.copy('modelsim:/rtl/simulation_results.txt','simulation_results.txt')
-        modelsim.copy('modelsim:/rtl/simulation_results_tb.txt','simulation_results_tb.txt')
-        modelsim.exec('rm -r rtl')
-        modelsim.stop()
+    # Bytes sent over the UART to load the current firmware and FUVRF contents with command 42 (see compiler.image)
+    # The image follows the fields each block stores, which reconfig_unit.sv does not route correctly yet (it expects
+    # 5*MAX_CHAINS VVALU bytes instead of 7*MAX_CHAINS, gives a single byte to the FRU and the blocks count clock cycles
+    # instead of received bytes), so the upload does not configure the generated RTL
+    def upload(self,fu_vrf):
+        log.warning("Firmware uploads do not match the byte layout reconfig_unit.sv expects (see rtlHw.upload)")
+        image=self.compiler.image(self.firmware,fu_vrf,self.DATA_WIDTH,'int' if self.DATA_TYPE==0 else 'fixed_point')
+        return image, fullUpload(image)
+
+    # Session of the simulator backend (see SIMULATORS)
+    # ModelSim sessions keep the container running and its vendor libraries compiled across runs (see modelsimSession)
+    # container is the name of the ModelSim container, which is shared by all sessions that use the same name
+    def session(self,log=True,container='modelsim',**kwargs):
+        return SIMULATORS[self.SIMULATOR](log,container=container,**kwargs)
 
-        # Get results from file back to python
+    # This will run the testbench of the generated hardware and return its results
+    # Without a session, one is opened for this run only (for ModelSim, the container is started and the vendor libraries
+    # are compiled again). Files are generated in folder, or in a temporary folder that is removed after the run, so the
+    # working directory is never changed and several runs can happen at once
+    def run(self,steps=50,gui=False,log=True,session=None,folder=None,container='modelsim'):
+        simulator = self.session(log,container) if session is None else session
+        rtl_folder = None
+        try:
+            rtl_folder = tempfile.mkdtemp(prefix='rtl-') if folder is None else os.path.abspath(folder)
+
+            # First, generate the RTL
+            self.steps=steps
+            self.generateRtl(rtl_folder,simulator.vendor_rams)
+
+            # Then, run simulation
+            plusargs=[f"+STEPS={steps}"]
+            if self.probes.cycles is not None:
+                plusargs+=[f"+FIRST_CYCLE={self.probes.cycles[0]}",f"+LAST_CYCLE={self.probes.cycles[1]}"]
+            simulator.compile(rtl_folder)
+            if gui:
+                if sys.platform=="darwin":
+                    print("Opening GUI\n\tMake sure to open socket using this command on your mac:\n\tsocat TCP-LISTEN:6000,reuseaddr,fork UNIX-CLIENT:\\\"$DISPLAY\\\"")
+                elif sys.platform=="linux":
+                    print("Opening GUI, Linux detected\n\tMake sure to run this command:\n\txhost local:`whoami`")
+                    simulator.simulate(gui=True,plusargs=plusargs)
+            else:
+                simulator.simulate(plusargs=plusargs)
+            simulator.fetch(['simulation_results.bin','simulation_results_tb.txt'],rtl_folder)
+            return self.readResults(rtl_folder)
+
+        # Sessions opened for this run and temporary folders are removed even if the run fails, since a leftover working
+        # directory would keep other sessions from stopping the container
+        finally:
+            if session is None:
+                simulator.close()
+            if folder is None and rtl_folder is not None:
+                shutil.rmtree(rtl_folder,ignore_errors=True)
+
+    # Get results from file back to python
+    # Each sample holds the probed signals in order, with every value written as 32-bit words (lowest word first)
+    def readResults(self,rtl_folder):
         results={}
-        for mod in self.tb_var_names.keys():
-                results[mod]={}
-                for var_name, elements in self.tb_var_names[mod]:
-                    results[mod][var_name]=[]
-        f = open("simulation_results.txt", "r")
-        for line in f:
-            count=0
-            l= line.replace("\n","").split(" ")
-            for mod in self.tb_var_names.keys():
-                for var_name, elements in self.tb_var_names[mod]:
-                    if elements=='N':
-                        elements=self.N
-                    results[mod][var_name].append(l[count:count+elements])
-                    count=count+elements
-
-        f = open("simulation_results_tb.txt", "r")
-        tb=[]
-        for line in f:
-            count=0
-            l= line.replace(" \n","").split(" ")
-            if len(l)>1:
-                tb.append(l)
-        results['tb']['mem_data']=tb
-
-        # Go back to main directory
-        os.chdir(current_folder)
+        signals=[(mod,var_name,elements,bits) for mod in self.tb_var_names for var_name, elements, bits in self.tb_var_names[mod]]
+        words=[elements*math.ceil(bits/32) for _, _, elements, bits in signals]
+        samples=np.fromfile(os.path.join(rtl_folder,"simulation_results.bin"),dtype=np.uint32).reshape(-1,max(sum(words),1))
+        first_cycle=0 if self.probes.cycles is None else self.probes.cycles[0]
+        offset=0
+        for (mod, var_name, elements, bits), size in zip(signals,words):
+            assert bits<=64, "Probed signals must have at most 64 bits"
+            values=samples[:,offset:offset+size].reshape(len(samples),elements,size//elements).astype(np.uint64)
+            values=(values[:,:,0] if values.shape[2]==1 else values[:,:,0] | values[:,:,1]<<np.uint64(32)).astype(np.min_scalar_type(2**bits-1))
+            results.setdefault(mod,{'cycle':np.arange(first_cycle,first_cycle+len(samples))})[var_name]=values[:,0] if elements==1 else values
+            offset+=size
 
+        tb=[]
+        with open(os.path.join(rtl_folder,"simulation_results_tb.txt"), "r") as f:
+            for line in f:
+                count=0
+                l= line.replace(" \n","").split(" ")
+                if len(l)>1:
+                    tb.append(l)
+        results.setdefault('tb',{})['mem_data']=tb
         return results
 
     def initialize_fu(vals):
@@ -960,7 +1056,14 @@ class rtlHw():
     def push(self,pushed_values):
         self.testbench_inputs.append(pushed_values)
 
-    def __init__(self,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,DATA_WIDTH,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DEVICE_FAM):
+    # Pushes tensors to the testbench (see misc.tensorStream), encoding them if we are dealing with fixed-point
+    def pushTensors(self,tensors,batched=True):
+        for v_in, eof1, eof2 in tensorStream(tensors,self.N,batched):
+            if self.DATA_TYPE==1:
+                v_in=floatToEncodedInt(v_in,self.DATA_WIDTH)
+            self.push([v_in,eof1,eof2])
+
+    def __init__(self,N,M,IB_DEPTH,FUVRF_SIZE,VVVRF_SIZE,TB_SIZE,DATA_WIDTH,MAX_CHAINS,BUILDING_BLOCKS,DATA_TYPE,DEVICE_FAM,SIMULATOR='modelsim'):
         ''' Verifying parameters '''
         assert math.log(N, 2).is_integer(), "N must be a power of 2" 
         assert math.log(M, 2).is_integer(), "N must be a power of 2" 
@@ -975,6 +1078,8 @@ class rtlHw():
         self.VVVRF_SIZE=VVVRF_SIZE
         self.FUVRF_SIZE=FUVRF_SIZE
         self.DEVICE_FAM=DEVICE_FAM
+        assert SIMULATOR in SIMULATORS, "Unknown simulator "+str(SIMULATOR)+" (supported: "+', '.join(SIMULATORS)+")"
+        self.SIMULATOR=SIMULATOR
         self.BUILDING_BLOCKS=BUILDING_BLOCKS
         if DATA_TYPE=='int':
             self.DATA_TYPE=0
@@ -987,7 +1092,40 @@ class rtlHw():
         self.testbench_inputs=[]    # Stores inputs to testbench
         self.steps=0 # Number of steps for testbench 
         self.tb_var_names = None
-        self.compiler = compiler(N,M,MAX_CHAINS)
+        self.probe()
+        self.compiler = compiler(N,M,MAX_CHAINS,TB_SIZE)
         self.firmware = None
         self.top=self.rtlLogicInit()
         
+
+''' Parallel simulations '''
+# Session of each worker process of runMany, with its own working directory inside the session of runMany
+worker_session=None
+
+def startWorker(SIMULATOR,container,workdir,log):
+    global worker_session
+    kwargs={} if workdir is None else {'workdir':workdir+'/'+str(os.getpid())}
+    worker_session=SIMULATORS[SIMULATOR](log,container=container,stop=False,**kwargs)
+
+def runJob(job):
+    config, fw, inputs, steps = job
+    hw_proc=rtlHw(**config)
+    hw_proc.config(fw)
+    for pushed_values in inputs:
+        hw_proc.push(pushed_values)
+    return hw_proc.run(steps=steps,log=False,session=worker_session)
+
+# Runs (config, firmware, inputs) jobs over a pool of worker processes and returns their results in order
+# config holds the parameters of rtlHw (other keys, such as those of the YAML configuration of the examples, are ignored)
+# and inputs the values pushed to the testbench. Each worker keeps a session across the jobs it runs, and for ModelSim
+# all workers share the given container, each in its own working directory.
+#   results=runMany([(conf,firm.raw(compiler(N,M,MAX_CHAINS)),inputs) for conf in sweep],steps=30)
+def runMany(jobs,steps=50,processes=None,log=False,container='modelsim'):
+    parameters=list(inspect.signature(rtlHw.__init__).parameters)[1:]
+    jobs=[({k: v for k, v in config.items() if k in parameters}, fw, inputs, steps) for config, fw, inputs in jobs]
+    simulators={config.get('SIMULATOR','modelsim') for config, _, _, _ in jobs}
+    assert len(simulators)<=1, "All jobs must use the same simulator"
+    SIMULATOR=simulators.pop() if simulators else 'modelsim'
+    with SIMULATORS[SIMULATOR](log,container=container) as session:
+        with multiprocessing.Pool(processes,initializer=startWorker,initargs=(SIMULATOR,container,getattr(session,'workdir',None),log)) as pool:
+            return pool.map(runJob,jobs)
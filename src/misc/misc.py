@@ -1,5 +1,6 @@
 from copy import deepcopy as copy
 import yaml
+import numpy as np
 
 ''' C-like struct '''
 class struct:
@@ -10,11 +11,11 @@ class struct:
 
 ''' Map list to int '''
 def toInt(lst):
-    return [list(map(int, l)) for l in lst]
+    return np.asarray(lst).astype(np.int64).tolist()
 
 ''' Encode vector of floats to ints '''
 def floatToEncodedInt(float_array,DATA_WIDTH):
-    return [encode(x,DATA_WIDTH) for x in float_array]
+    return encodeArray(float_array,DATA_WIDTH).tolist()
 
 ''' Encode vector of floats to ints '''    
 def encode(value,DATA_WIDTH):
@@ -30,8 +31,7 @@ def encode(value,DATA_WIDTH):
 
 ''' Decode vector of floats from encoded ints back to floats '''
 def encodedIntTofloat(encoded_int,DATA_WIDTH):
-    frac_bits=int(DATA_WIDTH/2)
-    return [[decode(encoded_value,DATA_WIDTH) for encoded_value in l] for l in encoded_int] 
+    return decodeArray(encoded_int,DATA_WIDTH).tolist()
 
 ''' Decode vector of floats from encoded ints back to floats '''
 def decode(value,DATA_WIDTH):
@@ -42,4 +42,58 @@ def decode(value,DATA_WIDTH):
     is_negative = value>max_value
     if is_negative:
         value = -((1<<DATA_WIDTH) - value)
-    return value / (1 << frac_bits)
\ No newline at end of file
+    return value / (1 << frac_bits)
+
+''' Encode an array of floats into DATA_WIDTH-bit two's complement fixed-point words (at most 64 bits) '''
+# Words are returned as uint64 and saturate the same way as encode. frac_bits defaults to DATA_WIDTH/2 (0 encodes integers).
+def encodeArray(values,DATA_WIDTH,frac_bits=None):
+    frac_bits=DATA_WIDTH//2 if frac_bits is None else frac_bits
+    assert 0<DATA_WIDTH<=64 and 0<=frac_bits<DATA_WIDTH, "Unsupported fixed-point format"
+    x=np.round(np.asarray(values,dtype=float)*2.0**frac_bits)
+    # Values are saturated before the conversion, since float64 cannot represent the largest 64-bit words
+    limit=2.0**(DATA_WIDTH-1)
+    max_value=(1<<(DATA_WIDTH-1))-1
+    words=np.where(np.abs(x)<limit,x,0).astype(np.int64)
+    words[x>=limit]=max_value
+    words[x<=-limit]=-max_value
+    return words.view(np.uint64) & np.uint64((1<<DATA_WIDTH)-1)
+
+''' Sign extend an array of DATA_WIDTH-bit two's complement words into int64 '''
+# Words can be unsigned or signed integers (e.g. a NumPy view of a raw buffer) or strings with their decimal values
+def toSigned(words,DATA_WIDTH):
+    words=np.asarray(words)
+    if words.dtype.kind not in 'ui':
+        words=words.astype(np.uint64)
+    shift=np.uint64(64-DATA_WIDTH)
+    return (words.astype(np.uint64) << shift).view(np.int64) >> np.int64(64-DATA_WIDTH)
+
+''' Decode an array of DATA_WIDTH-bit two's complement fixed-point words back into floats '''
+def decodeArray(words,DATA_WIDTH,frac_bits=None):
+    frac_bits=DATA_WIDTH//2 if frac_bits is None else frac_bits
+    assert 0<DATA_WIDTH<=64 and 0<=frac_bits<DATA_WIDTH, "Unsupported fixed-point format"
+    return toSigned(words,DATA_WIDTH)/2.0**frac_bits
+
+''' Split tensors into the N-wide vectors pushed to a processor '''
+# tensors is a single array or an iterable of arrays (e.g. a generator reading activations layer by layer). If batched, the
+# first axis of each array indexes the tensors of a batch, otherwise each array is a tensor that forms a batch on its own.
+# Arrays with less than two dimensions have no batch axis, so they are always a single tensor. Tensors are flattened and
+# split into N-wide tiles, which are views of the tensor if it is C-contiguous (np.ravel copies it once otherwise), and
+# their last tile is zero padded. Batches and tensors cannot be empty, since their eof flags would never be set. eof1 is
+# set on the last tile of each tensor and eof2 on the last tile of each batch. Yields [vector, eof1, eof2].
+def tensorStream(tensors,N,batched=True):
+    if isinstance(tensors,np.ndarray):
+        tensors=[tensors]
+    for batch in tensors:
+        batch=np.asarray(batch)
+        samples=batch if batched and batch.ndim>1 else batch[None]
+        assert len(samples)>0, "Cannot stream an empty batch (its eof flags would never be set)"
+        for i, tensor in enumerate(samples):
+            flat=np.ravel(tensor)
+            assert flat.size>0, "Cannot stream an empty tensor (its eof flags would never be set)"
+            num_tiles=-(-len(flat)//N)
+            for t in range(num_tiles):
+                tile=flat[t*N:t*N+N]
+                if len(tile)<N:
+                    tile=np.concatenate((tile,np.zeros(N-len(tile),dtype=tile.dtype)))
+                last=t==num_tiles-1
+                yield [tile,last,last and i==len(samples)-1]